@@ -1,8 +1,11 @@
 import scikits.audiolab
 import numpy as np
-import itertools
+import os
 import abc
 import time
+import threading
+import Queue
+import sys
 
 class CallHandler(object):
     __metaclass__ = abc.ABCMeta
@@ -21,6 +24,25 @@ class CallHandler(object):
     def __exit__(self, exception_type, exception_val, trace):
         return
 
+    def segment_done(self, offset, length):
+        """When a recording is parsed in segments (pika2.parse_mp3 with
+        workers), returns True if the segment of length seconds at offset was
+        completed in an earlier run and can be skipped.
+        """
+        return False
+
+    def start_segment(self, offset, length):
+        """Called before the calls of a segment are passed to handle_call,
+        e.g. to remove calls left from an interrupted run.
+        """
+        return
+
+    def segment_complete(self, offset, length):
+        """Called once all the calls of a segment have been passed to
+        handle_call, e.g. to checkpoint it.
+        """
+        return
+
 
 class ToDB(CallHandler):
     def __init__(self, recording, db, frequency):
@@ -58,27 +80,169 @@ class CallCounter(CallHandler):
     def handle_call(self, offset, audio):
         self.count += 1
 
+class CallList(CallHandler):
+    """Keeps the calls in a list of (offset, audio), e.g. for sending them
+    back from a worker process.
+    """
+    def __enter__(self):
+        self.calls = []
+        return self
+
+    def __exit__(self, exception_type, exception_val, trace):
+        return
+
+    def handle_call(self, offset, audio):
+        #copy since the audio may be a view of a buffer that gets reused
+        self.calls.append((offset, np.array(audio)))
+
+class ThreadedHandler(CallHandler):
+    """Passes the calls (and segment hooks) on to another handler from a
+    writer thread, so saving the calls overlaps with finding the next ones.
+    Everything the wrapped handler does, including __enter__ and __exit__,
+    happens in the writer thread and in the order it was called.  At most
+    depth calls wait to be written, the parser waits when the writer falls
+    that far behind.  An exception in the writer is raised in the parser at
+    the next call or on exit (unless the parser is already exiting with its
+    own exception).
+    """
+    def __init__(self, handler, depth=64):
+        self.handler = handler
+        self.depth = depth
+
+    def __enter__(self):
+        self.queue = Queue.Queue(maxsize=self.depth)
+        #exc_info of an exception in the writer, raised in the parser once
+        self.error = None
+        self.raised = False
+        self.thread = threading.Thread(target=self.write)
+        self.thread.daemon = True
+        self.thread.start()
+        self.put("__enter__")
+        return self
+
+    def handle_call(self, offset, audio):
+        #copy since the audio may be a view of a buffer that gets reused
+        self.put("handle_call", offset, np.array(audio))
+
+    def segment_done(self, offset, length):
+        #only reads, so it is asked straight away
+        return self.handler.segment_done(offset, length)
+
+    def start_segment(self, offset, length):
+        self.put("start_segment", offset, length)
+
+    def segment_complete(self, offset, length):
+        self.put("segment_complete", offset, length)
+
+    def __exit__(self, exception_type, exception_val, trace):
+        if self.error is None:
+            self.queue.put(("__exit__", exception_type, exception_val, trace))
+        #tells the writer to stop once it gets here
+        self.queue.put(None)
+        self.thread.join()
+        #an exception in the parser is passed on rather than the writer's
+        if (exception_type is None and self.error is not None and
+                not self.raised):
+            self.raise_error()
+        return False
+
+    def put(self, method, *args):
+        if self.error is not None and not self.raised:
+            self.raise_error()
+        self.queue.put((method,) + args)
+
+    def raise_error(self):
+        self.raised = True
+        raise self.error[0], self.error[1], self.error[2]
+
+    def write(self):
+        """Writer thread, calls the handler's methods in queue order.  After
+        an exception the handler is exited and the rest of the queue is
+        drained without writing, so the parser never blocks.
+        """
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                if self.error is not None:
+                    continue
+                method = item[0]
+                try:
+                    getattr(self.handler, method)(*item[1:])
+                except Exception:
+                    self.error = sys.exc_info()
+                    if method not in ("__enter__", "__exit__"):
+                        try:
+                            self.handler.__exit__(*self.error)
+                        except Exception:
+                            pass
+        finally:
+            #a handler saving to the database (e.g. process_records.ToDB)
+            #opened a connection for this thread, which Django doesn't close
+            if ("django.db" in sys.modules and
+                    sys.modules["django.conf"].settings.configured):
+                sys.modules["django.db"].connection.close()
+
 class ToFile(CallHandler):
-    def __init__(self, out_file, frequency):
+    """Writes the calls into the wav file out_file as they arrive.  By
+    default the calls are at their real time positions, with the gaps
+    between them written as blocks of zeros.  With condensed=True the calls
+    are written back to back and an index of where each one came from is
+    written alongside (see index_filename).
+    """
+    def __init__(self, out_file, frequency, condensed=False,
+            gap_block_length=1.0):
+        """
+        :condensed: if True leave out the gaps and write an index
+        :gap_block_length: seconds of zeros written at a time for gaps
+        """
         self.out_file = out_file
         self.frequency = frequency
-        self.current_end = 0.0
+        self.condensed = condensed
+        self.zeros = np.zeros(max(int(gap_block_length*frequency), 1))
 
     def __enter__(self):
-        self.output = []
         self.start_time = time.time()
+        #number of samples written so far
+        self.written = 0
+        self.output = scikits.audiolab.Sndfile(self.out_file, 'w',
+                scikits.audiolab.Format('wav', 'pcm16'), 1, self.frequency)
+        self.index = None
+        if self.condensed:
+            self.index = open(self.index_filename(), "w")
+            self.index.write("offset,position,duration\n")
         return self
 
     def handle_call(self, offset, audio):
         #print "offset: {}, audio length {}, current_end {}".format(
-                #offset, len(audio)*1.0/self.frequency, self.current_end)
-        self.output.append(np.zeros(
-            max(int((offset - self.current_end)*self.frequency), 0)))
-        self.output.append(audio)
-        self.current_end = offset + len(audio)*1.0/self.frequency
+                #offset, len(audio)*1.0/self.frequency, self.written)
+        if self.condensed:
+            self.index.write("{:.6f},{:.6f},{:.6f}\n".format(offset,
+                self.written*1.0/self.frequency,
+                len(audio)*1.0/self.frequency))
+        else:
+            self.write_gap(int(offset*self.frequency) - self.written)
+        self.output.write_frames(np.asarray(audio, dtype=np.float64))
+        self.written += len(audio)
 
     def __exit__(self, exception_type, exception_val, trace):
-        wav_data = list(itertools.chain.from_iterable(self.output))
-        scikits.audiolab.wavwrite(np.asarray(wav_data), self.out_file, 
-                self.frequency)
+        self.output.close()
+        if self.index is not None:
+            self.index.close()
         print "Total elapsed time: {}".format(time.time() - self.start_time)
+
+    def index_filename(self):
+        """Name of the csv index written with a condensed file, one line per
+        call with its offset in the recording, its position in the condensed
+        file and its duration (all in seconds).
+        """
+        return os.path.splitext(self.out_file)[0] + "_index.csv"
+
+    def write_gap(self, n_samples):
+        """Writes n_samples of silence one block at a time"""
+        while n_samples > 0:
+            block = self.zeros[:n_samples]
+            self.output.write_frames(block)
+            self.written += len(block)
+            n_samples -= len(block)
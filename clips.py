@@ -0,0 +1,337 @@
+"""
+Packed storage of call clips, one container per recording instead of one wav
+file per call.
+
+A ClipStore is three files sharing a base path:
+    <path>.pcm   the samples of every clip, float32, appended one after the
+                 other
+    <path>.idx   one (offset, start, length) entry per clip, appended after
+                 its samples so an entry never refers to missing data
+    <path>.json  the sample frequency and dtype of the samples
+
+A clip is referred to by the name of the .pcm file and its index, e.g.
+"recording3/calls/clips.pcm#17", which is what Call.filename holds for
+packed calls.  load_clip reads either kind of Call.filename (clip names or
+plain wav files), so code that only needs the audio of a call doesn't need
+to know how it is stored.  Clips are read as memory mapped slices of the
+.pcm file, so no samples are copied until they are used.
+
+Calls can also be saved without any audio (Call.filename None), load_call
+then decodes their audio from the recording when it is needed, through a
+BlockCache of decoded blocks so that neighbouring calls don't decode the
+same audio again.
+"""
+import numpy as np
+import scikits.audiolab
+import collections
+import json
+import os
+import processing
+
+INDEX_DTYPE = np.dtype([("offset", "<f8"), ("start", "<i8"), ("length", "<i8")])
+
+#stores opened by load_clip, by path
+_stores = {}
+#BlockCache used by load_call
+_block_cache = None
+
+
+def clip_name(path, index):
+    """Name of clip index in the store at path"""
+    return "{}.pcm#{}".format(path, index)
+
+def is_packed(filename):
+    """True if filename (e.g. a Call.filename) refers to a clip in a
+    ClipStore rather than a wav file.
+    """
+    return filename is not None and "#" in os.path.basename(filename)
+
+def parse_clip_name(filename):
+    """:returns (path of the store, index of the clip) for a clip name"""
+    data_file, index = filename.rsplit("#", 1)
+    return os.path.splitext(data_file)[0], int(index)
+
+def open_store(path):
+    """ClipStore at path, reusing the store if it was opened before"""
+    if path not in _stores:
+        _stores[path] = ClipStore(path)
+    return _stores[path]
+
+def close_store(path):
+    """Closes the store at path if open_store opened it (e.g. before its
+    files are deleted)
+    """
+    store = _stores.pop(path, None)
+    if store is not None:
+        store.close()
+
+def load_clip(filename):
+    """Audio of a call, either a packed clip name or a wav file (the left
+    channel if it is stereo).
+    :returns (audio, frequency), for a packed clip audio is a read only
+    memory map of the clip's samples
+    """
+    if is_packed(filename):
+        path, index = parse_clip_name(filename)
+        store = open_store(path)
+        return store.read(index), store.frequency
+    return processing.load_wav(filename)
+
+def clip_frequency(filename):
+    """Sample frequency of the audio of a call (see load_clip) without
+    reading the audio
+    """
+    if is_packed(filename):
+        return open_store(parse_clip_name(filename)[0]).frequency
+    return processing.wav_frequency(filename)
+
+def export_clip(filename, outfile):
+    """Writes the audio of a call (see load_clip) to the wav file outfile"""
+    audio, frequency = load_clip(filename)
+    scikits.audiolab.wavwrite(np.asarray(audio), outfile, frequency)
+
+def recording_path(recording):
+    """Path of the audio file of recording (a Django or SQLObject Recording)"""
+    filename = getattr(recording, "filename", None)
+    if filename:
+        return filename
+    return recording.recording_file.path
+
+def block_cache():
+    """The BlockCache shared by load_call"""
+    global _block_cache
+    if _block_cache is None:
+        _block_cache = BlockCache()
+    return _block_cache
+
+def load_call(call):
+    """Audio of call however it is stored: a packed clip, a wav file, or
+    (when call.filename is None) decoded from its recording at call.offset
+    for call.duration seconds.
+    :returns (audio, frequency)
+    """
+    if call.filename:
+        return load_clip(call.filename)
+    cache = block_cache()
+    return (cache.read(recording_path(call.recording), call.offset,
+        call.duration), cache.frequency)
+
+def export_call(call, outfile):
+    """Writes the audio of call (see load_call) to the wav file outfile"""
+    audio, frequency = load_call(call)
+    scikits.audiolab.wavwrite(np.asarray(audio), outfile, frequency)
+
+
+class BlockCache(object):
+    """
+    Least recently used cache of blocks of audio decoded from recordings
+    (mono, see processing.stream_pcm), for reading calls straight from the
+    recording.  Uses at most max_blocks*block_length*frequency float32
+    samples of memory.
+    """
+    #*Constructor*#
+    def __init__(self, block_length=30, max_blocks=16, frequency=44100):
+        """
+        :block_length: seconds of audio decoded at a time
+        :max_blocks: number of blocks kept
+        :frequency: sample frequency to decode at (the parsers' frequency)
+        """
+        self.block_length = block_length
+        self.max_blocks = max_blocks
+        self.frequency = frequency
+        self.block_size = int(block_length*frequency)
+        self.blocks = collections.OrderedDict()
+
+    #*Public Methods*#
+    def read(self, filename, start, duration):
+        """Audio of filename from start for duration seconds, a view of a
+        cached block if it lies within one block and a copy otherwise.
+        """
+        first = int(start*self.frequency)
+        last = first + int(round(duration*self.frequency))
+        parts = []
+        for index in xrange(first//self.block_size,
+                (max(last, first + 1) - 1)//self.block_size + 1):
+            block = self.block(filename, index)
+            block_start = index*self.block_size
+            parts.append(block[max(first - block_start, 0):
+                max(last - block_start, 0)])
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
+
+    def block(self, filename, index):
+        """Block index of filename, decoding it if it isn't cached"""
+        key = (filename, index)
+        if key in self.blocks:
+            #move to the most recently used end
+            block = self.blocks.pop(key)
+        else:
+            block = np.concatenate([np.array(audio) for audio, offset in
+                processing.stream_pcm(filename, self.block_length,
+                    self.frequency, start=index*self.block_length,
+                    duration=self.block_length, n_buffers=1)] +
+                [np.zeros(0, dtype=np.float32)])
+            while len(self.blocks) >= self.max_blocks:
+                self.blocks.popitem(last=False)
+        self.blocks[key] = block
+        return block
+
+    def clear(self):
+        self.blocks.clear()
+
+
+class ClipStore(object):
+    """
+    Append only container of the call clips of one recording.
+    """
+    #*Constructor*#
+    def __init__(self, path, frequency=None):
+        """
+        :path: base path of the store's files (without extension)
+        :frequency: sample frequency of the clips, needed when the store is
+        created, otherwise it must match the store's
+        """
+        self.path = path
+        self.data_file = path + ".pcm"
+        self.index_file = path + ".idx"
+        self.header_file = path + ".json"
+        if os.path.exists(self.header_file):
+            with open(self.header_file) as f:
+                header = json.load(f)
+            if frequency is not None and int(frequency) != int(header["frequency"]):
+                raise Exception("clips.ClipStore: {} has frequency {}, not {}" \
+                        .format(path, header["frequency"], frequency))
+            self.frequency = header["frequency"]
+            self.dtype = np.dtype(header["dtype"])
+        else:
+            if frequency is None:
+                raise Exception("clips.ClipStore: no store at {}, the " \
+                        "frequency is needed to create one".format(path))
+            self.frequency = frequency
+            self.dtype = np.dtype(np.float32)
+            folder = os.path.dirname(path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            with open(self.header_file, "w") as f:
+                json.dump({"frequency": frequency, "dtype": self.dtype.name}, f)
+        self.data = None
+        self.index = None
+        self.samples = None
+        self.entries = None
+        self.refresh()
+
+    #*Public Methods*#
+    def __len__(self):
+        return self.n_clips
+
+    def append(self, offset, audio):
+        """Adds a clip to the end of the store.
+        :offset: offset of the clip in the recording in seconds
+        :returns name of the clip (see clip_name)
+        """
+        if self.data is None:
+            self.open_for_append()
+        audio = np.asarray(audio, dtype=self.dtype)
+        #positions of the files rather than their sizes, an interrupted
+        #write may have left a tail that is being written over
+        start = self.data.tell()//self.dtype.itemsize
+        index = self.index.tell()//INDEX_DTYPE.itemsize
+        self.data.write(audio.tobytes())
+        entry = np.array([(offset, start, len(audio))], dtype=INDEX_DTYPE)
+        self.index.write(entry.tobytes())
+        self.n_samples = max(self.n_samples, start + len(audio))
+        self.n_clips = index + 1
+        return clip_name(self.path, index)
+
+    def read(self, index):
+        """Samples of clip index, a read only memory map slice (no copy)"""
+        if self.entries is None or index >= len(self.entries):
+            self.flush()
+            self.refresh()
+        if index < 0 or index >= self.n_clips:
+            raise Exception("clips.ClipStore: {} has no clip {}".format(
+                self.path, index))
+        entry = self.entries[index]
+        return self.samples[entry["start"]:entry["start"] + entry["length"]]
+
+    def offsets(self):
+        """Offsets (in seconds) of all the clips"""
+        self.flush()
+        self.refresh()
+        if self.n_clips == 0:
+            return np.zeros(0)
+        return np.array(self.entries["offset"])
+
+    def flush(self):
+        """Makes sure everything appended is written to the files"""
+        if self.data is not None:
+            self.data.flush()
+            self.index.flush()
+
+    def close(self):
+        self.flush()
+        if self.data is not None:
+            self.data.close()
+            self.index.close()
+        self.data = None
+        self.index = None
+        self.samples = None
+        self.entries = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_val, trace):
+        self.close()
+
+    #*Private Methods*#
+    def refresh(self):
+        """Updates the clip count and memory maps from the file sizes, only
+        whole entries and samples count (the tail of an interrupted write is
+        ignored).
+        """
+        self.n_samples = self.file_size(self.data_file)//self.dtype.itemsize
+        self.n_clips = self.file_size(self.index_file)//INDEX_DTYPE.itemsize
+        if self.n_clips:
+            self.entries = np.memmap(self.index_file, dtype=INDEX_DTYPE,
+                    mode='r', shape=(self.n_clips,))
+            if self.n_samples:
+                self.samples = np.memmap(self.data_file, dtype=self.dtype,
+                        mode='r', shape=(self.n_samples,))
+            else:
+                #only empty clips, np.memmap can't map an empty file
+                self.samples = np.zeros(0, dtype=self.dtype)
+        else:
+            self.entries = None
+            self.samples = None
+
+    def open_for_append(self):
+        """Opens the files for appending after the last whole index entry and
+        the samples it refers to.  The tail of any interrupted write is
+        written over rather than cut off, since other processes may have the
+        files memory mapped.
+        """
+        self.refresh()
+        if self.n_clips:
+            last = self.entries[-1]
+            self.n_samples = int(last["start"] + last["length"])
+        else:
+            self.n_samples = 0
+        self.data = self.open_at(self.data_file,
+                self.n_samples*self.dtype.itemsize)
+        self.index = self.open_at(self.index_file,
+                self.n_clips*INDEX_DTYPE.itemsize)
+
+    def open_at(self, filename, position):
+        """filename opened for writing at position, without truncating it"""
+        if not os.path.exists(filename):
+            open(filename, "wb").close()
+        f = open(filename, "r+b")
+        f.seek(position)
+        return f
+
+    def file_size(self, filename):
+        if not os.path.exists(filename):
+            return 0
+        return os.path.getsize(filename)
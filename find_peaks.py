@@ -145,6 +145,114 @@ def detect_peaks(x, mph=None, mpd=1, threshold=0, edge='rising',
     return ind
 
 
+def detect_peaks_2d(x, mpd=1, edge='rising', kpsh=False):
+
+    """Detect peaks in every row of a 2D array at once.
+
+    Vectorized equivalent of calling `detect_peaks(row, mpd=mpd, edge=edge,
+    kpsh=kpsh)` for each row of `x` (e.g. every frame of a spectrogram).
+
+    Parameters
+    ----------
+    x : 2D array_like
+        data, one independent signal per row.  Must not contain NaN's.
+    mpd : positive integer, optional (default = 1)
+        detect peaks that are at least separated by minimum peak distance (in
+        number of data).
+    edge : {None, 'rising', 'falling', 'both'}, optional (default = 'rising')
+        for a flat peak, keep only the rising edge ('rising'), only the
+        falling edge ('falling'), both edges ('both'), or don't detect a
+        flat peak (None).
+    kpsh : bool, optional (default = False)
+        keep peaks with same height even if they are closer than `mpd`.
+
+    Returns
+    -------
+    locs : 2D array of int
+        locs[i, :counts[i]] are the indices of the peaks of row i in
+        increasing order, the remaining entries are -1.  The number of columns
+        is the largest number of peaks found in any row.
+    counts : 1D array of int
+        number of peaks found in each row.
+
+    Notes
+    -----
+    The minimum peak distance is enforced the same way as in `detect_peaks`:
+    peaks are visited from the highest to the lowest and each peak that has
+    not already been removed removes the smaller peaks within `mpd` of it.
+    The loop is over the rank of the peaks rather than over rows, so it runs
+    at most (largest number of peaks in a row) times.  Peaks of exactly the
+    same height are visited from the last to the first, which is what
+    `detect_peaks` does whenever its sort of the peak heights is stable.
+    Its default (quicksort) argsort is not stable, so when peaks within
+    `mpd` of each other have exactly the same height (e.g. integer data)
+    `detect_peaks` may keep a different one of them.  Spectrogram
+    magnitudes practically never tie, and there the results are the same.
+
+    Examples
+    --------
+    >>> x = np.array([[0, 1, 0, 2, 0, 3, 0, 2, 0, 1, 0],
+    ...               [0, 0, 5, 0, 0, 0, 0, 0, 4, 0, 0]])
+    >>> detect_peaks_2d(x, mpd=2)
+    (array([[ 1,  5,  9],
+           [ 2,  8, -1]]), array([3, 2]))
+    """
+
+    x = np.atleast_2d(x).astype('float64')
+    n_rows, n_cols = x.shape
+    if n_cols < 3:
+        return (np.full((n_rows, 0), -1, dtype=int),
+                np.zeros(n_rows, dtype=int))
+    # find indices of all peaks, first and last values cannot be peaks
+    dx = x[:, 1:] - x[:, :-1]
+    before, after = dx[:, :-1], dx[:, 1:]
+    is_peak = np.zeros(x.shape, dtype=bool)
+    if not edge:
+        is_peak[:, 1:-1] = (after < 0) & (before > 0)
+    else:
+        if edge.lower() in ['rising', 'both']:
+            is_peak[:, 1:-1] |= (after <= 0) & (before > 0)
+        if edge.lower() in ['falling', 'both']:
+            is_peak[:, 1:-1] |= (after < 0) & (before >= 0)
+
+    rows, cols = np.nonzero(is_peak)
+    counts = np.bincount(rows, minlength=n_rows)
+    width = counts.max() if rows.size else 0
+    # pack the peaks of each row to the left of a padded matrix
+    starts = np.cumsum(counts) - counts
+    rank = np.arange(rows.size) - starts[rows]
+    locs = np.full((n_rows, width), -1, dtype=int)
+    locs[rows, rank] = cols
+
+    # detect small peaks closer than minimum peak distance
+    if width > 1 and mpd > 1:
+        heights = np.full((n_rows, width), -np.inf)
+        heights[rows, rank] = x[rows, cols]
+        # sort each row by peak height (ties by position), highest first
+        order = np.lexsort((locs, heights))[:, ::-1]
+        row_index = np.arange(n_rows)[:, None]
+        locs = locs[row_index, order]
+        heights = heights[row_index, order]
+        keep = locs >= 0
+        for i in range(width):
+            current = keep[:, i]
+            if not current.any():
+                continue
+            idel = np.abs(locs - locs[:, i:i+1]) <= mpd
+            if kpsh:
+                idel &= heights[:, i:i+1] > heights
+            idel[:, i] = False  # Keep current peak
+            keep &= ~(idel & current[:, None])
+        # remove the small peaks and sort back the indices by their occurrence
+        counts = keep.sum(axis=1)
+        locs = np.where(keep, locs, n_cols)
+        locs.sort(axis=1)
+        locs = locs[:, :counts.max()]
+        locs[locs == n_cols] = -1
+
+    return locs, counts
+
+
 def _plot(x, mph, mpd, threshold, edge, valley, ax, ind):
     """Plot results of the detect_peaks function, see its help."""
     try:
@@ -0,0 +1,152 @@
+"""
+Interval extraction shared by Parser, PikaParser and the preprocessing code.
+
+Turns per frame values (e.g. frame scores) into intervals: smoothing,
+threshold crossing, minimum length filtering and merging of overlapping
+intervals.  Everything is done with np.convolve/np.diff/np.flatnonzero style
+array operations rather than python loops over the frames, and all intervals
+are returned as 2d numpy arrays with one [start, end] row each.
+"""
+import numpy as np
+
+
+def smooth(values, width, weight=.5):
+    """Moving sum of width values times weight, i.e.
+    np.convolve(values, [weight]*width, mode='same').  np.convolve is used
+    rather than a difference of cumulative sums because the latter rounds
+    differently, which changes which frames sit exactly on a threshold.
+    """
+    return np.convolve(values, [weight]*width, mode='same')
+
+def runs(start_mask, continue_mask, open_start=None, base=0):
+    """Finds runs of frames, a run starts at a frame where start_mask is True
+    and lasts until the first frame where continue_mask is False (start_mask
+    should imply continue_mask).
+    :open_start: index of the start of a run that was still going at the end
+    of the previous call, for processing a long series piece by piece
+    :base: index of the first frame, added to all returned indices
+    :returns (starts, ends, open_start) where starts and ends are arrays of
+    the first and last frame of each finished run and open_start is the start
+    of a run still going at the last frame (None if there isn't one)
+    """
+    start_mask = np.asarray(start_mask, dtype=bool)
+    continue_mask = np.asarray(continue_mask, dtype=bool)
+    n = len(continue_mask)
+    first_starts = []
+    first_ends = []
+    skip = 0
+    if open_start is not None:
+        stops = np.flatnonzero(~continue_mask)
+        if len(stops) == 0:
+            return (np.zeros(0, dtype=int), np.zeros(0, dtype=int),
+                    open_start)
+        first_starts.append(open_start)
+        first_ends.append(base + stops[0] - 1)
+        skip = stops[0]
+
+    edges = np.diff(np.concatenate(([0], continue_mask[skip:].astype(np.int8),
+        [0])))
+    run_starts = np.flatnonzero(edges == 1) + skip
+    run_ends = np.flatnonzero(edges == -1) + skip
+    #each run of continue_mask frames begins at its first start_mask frame
+    start_frames = np.flatnonzero(start_mask)
+    if len(start_frames) == 0:
+        start_frames = np.array([n])
+    j = np.searchsorted(start_frames, run_starts)
+    first = start_frames[np.minimum(j, len(start_frames) - 1)]
+    found = (j < len(start_frames)) & (first < run_ends)
+    starts = first[found] + base
+    ends = run_ends[found] - 1 + base
+
+    open_start = None
+    if len(ends) and ends[-1] == base + n - 1:
+        open_start = starts[-1]
+        starts = starts[:-1]
+        ends = ends[:-1]
+    return (np.concatenate((first_starts, starts)).astype(int),
+            np.concatenate((first_ends, ends)).astype(int), open_start)
+
+def threshold_ridges(scores, threshold, open_start=None, base=0):
+    """Ridges of scores above threshold.  A ridge starts at a score above
+    threshold and lasts while the scores are not below threshold.  See runs
+    for the arguments and return value.
+    """
+    scores = np.asarray(scores)
+    return runs(scores > threshold, scores >= threshold, open_start, base)
+
+def ridges_to_seconds(starts, ends, factor, open_start=None, n_frames=None):
+    """Converts ridge frame indices into [start, end] intervals in seconds.
+    A ridge still open at the end of the scores ends at n_frames*factor.
+    """
+    intervals = np.column_stack((np.asarray(starts)*factor,
+        np.asarray(ends)*factor))
+    if open_start is not None:
+        intervals = np.vstack((intervals,
+            [[open_start*factor, n_frames*factor]]))
+    return intervals
+
+def filter_min_length(intervals, min_length):
+    """Returns the intervals that are longer than min_length"""
+    intervals = np.asarray(intervals).reshape(-1, 2)
+    return intervals[intervals[:, 1] - intervals[:, 0] > min_length]
+
+def passing_intervals(frame_scores, factor, width, threshold, min_length,
+        weight=.5):
+    """Smooths frame_scores and returns the intervals (in seconds) where the
+    smoothed scores ridge above threshold for longer than min_length.
+    :factor: seconds per frame
+    :width: number of frames in the smoothing window
+    """
+    scores = smooth(frame_scores, width, weight)
+    starts, ends, open_start = threshold_ridges(scores, threshold)
+    intervals = ridges_to_seconds(starts, ends, factor, open_start,
+            len(scores))
+    return filter_min_length(intervals, min_length)
+
+def ridge_scores(scores, starts, ends):
+    """Peak and mean of scores over each ridge, without a loop over the
+    ridges.
+    :starts: first index of each ridge
+    :ends: last index of each ridge (inclusive)
+    :returns (peaks, means) arrays with one value per ridge
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    starts = np.asarray(starts, dtype=int)
+    ends = np.asarray(ends, dtype=int)
+    if len(starts) == 0:
+        return np.zeros(0), np.zeros(0)
+    #reduceat over [start, end + 1) pairs, the value past the end only
+    #bounds the last ridge
+    bounds = np.column_stack((starts, ends + 1)).ravel()
+    peaks = np.maximum.reduceat(np.append(scores, -np.inf), bounds)[::2]
+    totals = np.concatenate(([0], np.cumsum(scores)))
+    means = (totals[ends + 1] - totals[starts])/(ends + 1 - starts)
+    return peaks, means
+
+def nonzero_intervals(values, factor):
+    """Intervals (in seconds) where values are non-zero.  An interval starts
+    at a positive value and lasts until the next zero value.  The start of
+    each interval is rounded down and the end rounded up to whole seconds.
+    """
+    values = np.asarray(values)
+    starts, ends, open_start = runs(values > 0, values != 0)
+    if open_start is not None:
+        starts = np.append(starts, open_start)
+        ends = np.append(ends, len(values) - 1)
+    return np.column_stack((np.floor(starts*factor),
+        np.ceil((ends + 1)*factor))).astype(int)
+
+def merge_intervals(intervals):
+    """
+    :intervals: intervals that may have overlapping endpoints but
+    where if [a, b] occurs before [c, d] then a <= c.
+    :returns intervals with overlaps combined so that now if
+    [a, b] occurs before [c, d] in the returned array, then b < c.
+    """
+    intervals = np.asarray(intervals).reshape(-1, 2)
+    if len(intervals) == 0:
+        return intervals
+    new_group = np.concatenate(([True],
+        intervals[1:, 0] > intervals[:-1, 1]))
+    last = np.append(np.flatnonzero(new_group)[1:] - 1, len(intervals) - 1)
+    return np.column_stack((intervals[new_group, 0], intervals[last, 1]))
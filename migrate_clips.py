@@ -0,0 +1,133 @@
+import clips
+import sys
+import os
+import glob
+import argparse
+
+if __name__== '__main__':
+    #Got this setup from:
+    #https://www.stavros.io/posts/standalone-django-scripts-definitive-guide/
+    proj_path = "D:/Workspace/pika_project/"
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "pika_project.settings")
+    sys.path.append(proj_path)
+    os.chdir(proj_path)
+
+    from django.core.wsgi import get_wsgi_application
+    application = get_wsgi_application()
+
+from pika_app.models import Recording, Call
+from django.db import transaction
+
+def main(argv=None):
+    """Packs the call wav files of recordings into one clips.ClipStore per
+    recording and points the Calls at their clips, or with --compact rewrites
+    the stores without the clips no Call refers to.
+    """
+    parser = argparse.ArgumentParser(
+            description="Packs the call wav files of recordings into clip " \
+                    "stores")
+    parser.add_argument("recordings", type=int, nargs="*",
+            help="ids of the recordings to convert (default: all)")
+    parser.add_argument("--keep", action="store_true",
+            help="keep the wav files after converting them")
+    parser.add_argument("--compact", action="store_true",
+            help="copy the clips still referred to into new stores and " \
+                    "delete the old ones (don't run while recordings are " \
+                    "being processed)")
+    args = parser.parse_args(argv)
+
+    recordings = Recording.objects.all()
+    if args.recordings:
+        recordings = recordings.filter(id__in=args.recordings)
+    for recording in recordings:
+        if args.compact:
+            compact_recording(recording)
+        else:
+            migrate_recording(recording, keep=args.keep)
+
+def migrate_recording(recording, keep=False):
+    """Appends the audio of each of recording's calls that is still a wav
+    file to the recording's ClipStore (in offset order) and updates the
+    calls in one transaction.  The wav files are deleted afterwards unless
+    keep is True.
+    :returns number of calls converted
+    """
+    calls = [call for call in
+            Call.objects.filter(recording=recording).order_by("offset")
+            if call.filename and not clips.is_packed(call.filename)]
+    if len(calls) == 0:
+        return 0
+    output_path = os.path.join(recording.output_folder(),
+            "calls{}".format(os.sep))
+    store = None
+    wav_files = []
+    with transaction.atomic():
+        for call in calls:
+            if not os.path.exists(call.filename):
+                print "Missing call file {}, skipping it".format(call.filename)
+                continue
+            audio, frequency = clips.load_clip(call.filename)
+            if store is None:
+                store = clips.ClipStore(output_path + "clips", frequency)
+            wav_files.append(call.filename)
+            call.filename = store.append(call.offset, audio)
+            call.save()
+        if store is not None:
+            #the clips must be on disk before the rows are committed
+            store.close()
+    if not keep:
+        for filename in wav_files:
+            os.remove(filename)
+    print "{}: packed {} calls".format(recording, len(wav_files))
+    return len(wav_files)
+
+def compact_recording(recording):
+    """Copies the clips of recording's calls (in offset order) into a new
+    ClipStore, points the calls at it in one transaction and then deletes
+    the recording's other stores.  Reprocessed segments leave the clips of
+    the calls they replaced in the store, this is what gets rid of them.
+    The new store has a new path, so clip names are never reused for
+    different audio.
+    :returns number of clips kept
+    """
+    output_path = os.path.join(recording.output_folder(),
+            "calls{}".format(os.sep))
+    calls = [call for call in
+            Call.objects.filter(recording=recording).order_by("offset")
+            if clips.is_packed(call.filename)]
+    path = new_store_path(output_path + "clips")
+    store = None
+    with transaction.atomic():
+        for call in calls:
+            audio, frequency = clips.load_clip(call.filename)
+            if store is None:
+                store = clips.ClipStore(path, frequency)
+            call.filename = store.append(call.offset, audio)
+            call.save()
+        if store is not None:
+            #the clips must be on disk before the rows are committed
+            store.close()
+    removed = 0
+    for header_file in glob.glob(output_path + "clips*.json"):
+        old_path = os.path.splitext(header_file)[0]
+        if old_path == path:
+            continue
+        clips.close_store(old_path)
+        for extension in (".pcm", ".idx", ".json"):
+            if os.path.exists(old_path + extension):
+                os.remove(old_path + extension)
+        removed += 1
+    print "{}: kept {} clips, removed {} old stores".format(recording,
+            len(calls), removed)
+    return len(calls)
+
+def new_store_path(path):
+    """path with the first .<n> suffix no store exists at yet"""
+    n = 1
+    while os.path.exists("{}.{}.json".format(path, n)):
+        n += 1
+    return "{}.{}".format(path, n)
+
+
+
+if __name__ == "__main__": main()
@@ -0,0 +1,155 @@
+"""
+Processed spectrograms for preprocessing and a compact format for writing
+intervals of them to disk.
+
+An interval is written as two files next to each other: a .npy file with the
+frames and a small .json header with the fft parameters and the times the
+frames cover.  The .npy file can be memory mapped when it is read back (see
+load_interval), so nothing is unpickled and only the frames used are read.
+
+The frames are float32 by default.  With an unsigned integer dtype they are
+quantised linearly to the interval's max (the scale in the header), uint8
+makes the frames about a quarter the size of float32 ones, which at the
+parser's step of 64 samples is still about 4 bytes per sample of audio.  Use
+ProcessedFFT.frames to read them back scaled.
+"""
+import numpy as np
+import json
+import os
+import stft
+
+
+def data_filename(filename):
+    """Name of the .npy frames file for an interval written to filename (any
+    extension of filename is replaced)
+    """
+    return os.path.splitext(filename)[0] + ".npy"
+
+def header_filename(filename):
+    """Name of the .json header file for an interval written to filename"""
+    return os.path.splitext(filename)[0] + ".json"
+
+def load_interval(filename, mmap_mode='r'):
+    """Loads an interval written by ProcessedFFT.serialize_interval.
+    :filename: name of the interval, with any (or no) extension
+    :mmap_mode: passed to np.load, None reads the frames into memory
+    :returns ProcessedFFT with fft set to the frames of the interval (and no
+    audio), its offset is the start of the interval
+    """
+    with open(header_filename(filename)) as f:
+        header = json.load(f)
+    fft = ProcessedFFT(None, header["fft_window"], header["fft_size"],
+            header["step_size"], header["frequency"], offset=header["start"])
+    fft.fft = np.load(data_filename(filename), mmap_mode=mmap_mode)
+    fft.normalized = header["normalized"]
+    fft.scale = header.get("scale", 1.0)
+    return fft
+
+def load_matching_interval(filename, fft_window, fft_size, step_size,
+        frequency):
+    """Loads the interval stored alongside filename (e.g. the spectrogram
+    written with an offset_*.wav file) if there is one with the given fft
+    parameters.
+    :returns ProcessedFFT as load_interval does, or None if there is no
+    interval for filename or it was computed with different parameters
+    """
+    if not os.path.exists(header_filename(filename)):
+        return None
+    fft = load_interval(filename)
+    if (list(fft.fft_window) != list(fft_window) or
+            fft.fft_size != fft_size or fft.step_size != step_size or
+            int(fft.frequency) != int(frequency)):
+        return None
+    return fft
+
+
+class ProcessedFFT(object):
+    """
+    Spectrogram of a piece of audio restricted to the bins in fft_window,
+    one row per frame.
+    """
+    #*Constructor*#
+    def __init__(self, audio, fft_window, fft_size, step_size, frequency,
+            offset=0):
+        """
+        :audio: 1d array of samples, may be None if fft is set directly
+        :fft_window: [first, last) bins of the fft to keep
+        :frequency: sample frequency of audio
+        :offset: time in seconds of the first sample of audio (relative to
+        the recording)
+        """
+        self.audio = audio
+        self.fft_window = list(fft_window)
+        self.fft_size = fft_size
+        self.step_size = step_size
+        self.frequency = frequency
+        self.offset = offset
+        self.factor = self.step_size*1.0/self.frequency
+        self.fft = None
+        self.normalized = False
+        #magnitude of one unit of fft, not 1 for quantised intervals
+        self.scale = 1.0
+
+    #*Public Methods*#
+    def process_fft(self, normalize=True, frames=None):
+        """Computes the magnitude spectrogram of the audio into self.fft.
+        :normalize: if True the spectrogram is divided by its max
+        :frames: the magnitude spectrogram if it is already known (e.g.
+        sliced from a spectrogram_cache entry), used instead of computing it
+        and normalized in place
+        """
+        if frames is not None:
+            self.fft = frames
+        else:
+            self.fft = stft.magnitude_spectrogram(self.audio, self.fft_size,
+                    self.step_size, self.fft_window)
+        self.normalized = normalize
+        if normalize and len(self.fft):
+            max_val = np.amax(self.fft)
+            if max_val > 0:
+                self.fft /= max_val
+        return self.fft
+
+    def interval_frames(self, start, end):
+        """Frames [first, last) covering start to end seconds (relative to the
+        audio)
+        """
+        first = max(int(np.floor(start/self.factor)), 0)
+        last = min(int(np.ceil(end/self.factor)), len(self.fft))
+        return first, last
+
+    def frames(self, first=0, last=None, dtype=np.float64):
+        """Copy of frames [first, last) of fft as dtype, multiplied by the
+        scale if they were quantised
+        """
+        frames = np.array(self.fft[first:last], dtype=dtype)
+        if self.scale != 1:
+            frames *= self.scale
+        return frames
+
+    def serialize_interval(self, start, end, filename, dtype=np.float32):
+        """Writes the frames from start to end seconds (relative to the audio)
+        to filename's .npy and .json files (see data_filename and
+        header_filename).
+        :dtype: dtype to store the frames as, np.float16 for half the size or
+        an unsigned integer type to quantise them (e.g. np.uint8 for a
+        quarter)
+        """
+        first, last = self.interval_frames(start, end)
+        frames = self.frames(first, last)
+        scale = 1.0
+        if np.issubdtype(dtype, np.integer):
+            max_val = np.amax(frames) if frames.size else 0
+            if max_val > 0:
+                scale = max_val/np.iinfo(dtype).max
+            frames = np.rint(frames/scale)
+        np.save(data_filename(filename), frames.astype(dtype))
+        header = {"fft_size": self.fft_size, "step_size": self.step_size,
+                "fft_window": self.fft_window, "frequency": self.frequency,
+                "start": self.offset + first*self.factor,
+                "end": self.offset + last*self.factor,
+                "normalized": self.normalized,
+                "dtype": np.dtype(dtype).name, "scale": scale}
+        with open(header_filename(filename), "w") as f:
+            json.dump(header, f)
+
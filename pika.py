@@ -22,6 +22,7 @@ Usage Example:
 import pika_parser as pp
 import utility as u
 import processing as p
+import spectrogram_cache
 import pika_db_models as db
 import os
 
@@ -50,7 +51,8 @@ def preprocess_collection(collection):
     modifies: creates files in recordingN subfolder of collection's folder where N is the
     id of the recording object in the database so there will be a subfolder for each 
     recording in collection.  Within the subfolder will be audio files named offset_nn.n.wav
-    where nn.n is the offset in seconds of where the file was found in the original recording.
+    where nn.n is the offset in seconds of where the file was found in the original recording,
+    and a segments.csv index of them (see processing.write_segment_index).
     """
     for observation in collection.observations:
         for recording in observation.recordings:
@@ -58,8 +60,16 @@ def preprocess_collection(collection):
             if not os.path.exists(output_path):
                 os.makedirs(output_path)
             
-            for chunk, offset in p.chunk_recording(recording):
-                p.write_active_segments(chunk, output_path, offset)
+            segments = []
+            #the recording's spectrogram is stored once and shared with the
+            #later stages (see spectrogram_cache)
+            cache = spectrogram_cache.default_cache()
+            key = p.file_hash(recording.filename)
+            for chunk, offset in p.stream_pcm(recording.filename, 300):
+                segments += p.write_active_segments(recording.filename,
+                        output_path, offset, audio=chunk, cache=cache,
+                        key=key)
+            p.write_segment_index(output_path, segments)
 
 def identify_and_write_calls(collection):
     for observation in collection.observations:
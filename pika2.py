@@ -4,16 +4,27 @@ import matplotlib.pyplot as plt
 import collections
 import scikits.audiolab
 import processing as p
+import stft
+import spectrogram_cache
+import clips
+import wav_memmap
+import scoring
+import intervals
 import utility as u
 import os
-import mutagen.mp3
-from call_handler import CallHandler
+import multiprocessing
+import itertools
+import hashlib
+import json
+from call_handler import CallHandler, CallList, ThreadedHandler
 
-def verify_call(call):
+def verify_call(call, cache=None):
     """
+    :cache: spectrogram_cache.SpectrogramCache, see call_parser
     """
     print "Before: call {}, verified? {}".format(call, call.verified)
-    parser = Parser(call.filename, None, call.offset, step_size_divisor=64)
+    audio, frequency = clips.load_call(call)
+    parser = call_parser(call, np.asarray(audio), frequency, cache)
     response = parser.verify_call(call)
     print "Response: {}".format(response)
     if response == True:
@@ -27,35 +38,245 @@ def verify_call(call):
     print "After: call {}, verified? {}".format(call, call.verified)
     return True
 
-def parse_mp3(mp3file, handler):
-    info = mutagen.mp3.MP3(mp3file).info
-    total = 0
-    has_count = False
-    #if info.length > 3600:
-    ##TODO I think any reasonable lengthed file can be handled now, but not certain until 
-    ##I verify through testing
-        #raise Exception("File ({}) too long for code to handle - " \
-                #"currently setup to only handle files of less than " \
-                #"60 minutes.  This file is {:.2f} minutes".format(mp3file,
-                    #info.length/60))
-        #Limiting to 1 hour here because larger files should be split
-        #up differently since even at an hour this will create around
-        #600 MB of wav files.  TODO deal with larger files in a 
-        #sensible manner and probably delete the wav file segments
-        #after use.  For now I will leave it like this though since
-        #the wav files will probably be useful for debugging purposes
-    for audio, offset in p.segment_mp3(mp3file, 600):
-        print "parsing {} at offset {}".format(os.path.basename(audio), offset)
-        parser = Parser(audio, handler, offset)
-        parser.identify_calls()
-        try:
-            total += handler.count
-            has_count = True
-        except AttributeError:
-            pass
-        parser.close()
-    if has_count:
-        print "Total count: {}".format(total)
+def call_parser(call, audio, frequency, cache=None):
+    """Parser of the audio of call with the spectrogram of the call computed
+    (filtered), for showing it to a reviewer.  If the recording's spectrogram
+    is in cache (e.g. stored when it was parsed, see StreamingParser) the
+    frames are sliced from it, at the step size of detection.  Otherwise
+    they are computed from audio, at a 64th of the fft size.
+    """
+    key = getattr(call.recording, "content_hash", None)
+    if cache is not None and key is not None:
+        #StreamingParser's step size
+        parser = Parser(audio, None, call.offset, frequency=frequency)
+        spec = cache.lookup(key, parser.fft_size, parser.step_size,
+                parser.fft_window, parser.fft_dtype, parser.frequency)
+        if spec is not None:
+            first, last = spectrogram_cache.frame_range(call.offset,
+                    call.offset + call.duration, parser.step_size,
+                    parser.frequency)
+            parser.offset = first*parser.factor
+            parser.filtered_fft_frames(np.array(spec[first:last]))
+            return parser
+    parser = Parser(audio, None, call.offset, step_size_divisor=64,
+            frequency=frequency)
+    parser.filtered_fft(parser.full_audio)
+    return parser
+
+def parse_mp3(mp3file, handler, block_length=60, workers=None,
+        segment_length=300, duration=None, prefetch=2, cache=None,
+        cache_key=None):
+    """Identifies the calls in mp3file, passing them to handler.  The file is
+    decoded by a single ffmpeg process block_length seconds at a time and fed
+    through a StreamingParser, so calls on the boundaries between blocks are
+    not lost.
+    :workers: if given, mp3file is split into segments of segment_length
+    seconds that are parsed by a pool of this many worker processes (see
+    parse_segment), with workers=1 they are parsed in this process.  The
+    calls are still passed to handler in offset order in this process, and
+    are the same whatever the number of workers.  Segments for which
+    handler.segment_done returns True are skipped, see CallHandler for the
+    other segment hooks.
+    :duration: length of mp3file in seconds, read from the file if not given
+    (only needed with workers)
+    :prefetch: number of blocks decoded ahead of the parser by a decoder
+    thread (see processing.prefetch), the calls are also passed to handler
+    from a writer thread (see ThreadedHandler) so decoding, parsing and
+    saving overlap.  0 does everything in turn in this thread.
+    :cache, cache_key: spectrogram_cache.SpectrogramCache and the content
+    hash of mp3file, the frames are read from the recording's entry if it is
+    cached.  Otherwise the parser stores it as it goes, or with workers it is
+    stored first (decoding the recording once more) so every segment reads
+    its frames from it.
+    """
+    print "parsing {}".format(os.path.basename(mp3file))
+    writer = handler
+    if prefetch:
+        writer = ThreadedHandler(handler)
+    if workers is None:
+        parser = StreamingParser(writer, cache=cache, cache_key=cache_key)
+        parser.identify_calls(prefetch_pcm(mp3file, block_length, prefetch))
+    else:
+        if duration is None:
+            duration = p.audio_length(mp3file)
+        n_segments = int(np.ceil(duration*1.0/segment_length))
+        segments = [(mp3file, i*segment_length, segment_length, block_length,
+            prefetch, cache, cache_key) for i in range(n_segments)]
+        segments = [s for s in segments if not handler.segment_done(s[1], s[2])]
+        if len(segments) < n_segments:
+            print "skipping {} completed segments".format(
+                    n_segments - len(segments))
+        if cache is not None and cache_key is not None and segments:
+            settings = StreamingParser(None)
+            cache.recording_spectrogram(mp3file, cache_key,
+                    settings.fft_size, settings.step_size,
+                    settings.fft_window, settings.fft_dtype,
+                    settings.frequency)
+        if workers == 1:
+            parse_segments(itertools.imap(parse_segment, segments), segments,
+                    writer)
+        else:
+            pool = multiprocessing.Pool(workers)
+            try:
+                #imap returns the segments in order as they finish
+                parse_segments(pool.imap(parse_segment, segments), segments,
+                        writer)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+    try:
+        print "Total count: {}".format(handler.count)
+    except AttributeError:
+        pass
+
+def parse_segments(results, segments, handler):
+    """Passes the calls of each segment in results (from parse_segment) to
+    handler, between its start_segment and segment_complete hooks.
+    """
+    with handler:
+        for segment, calls in itertools.izip(segments, results):
+            handler.start_segment(segment[1], segment[2])
+            for offset, audio in calls:
+                handler.handle_call(offset, audio)
+            handler.segment_complete(segment[1], segment[2])
+
+def prefetch_pcm(filename, block_length, depth, start=0, duration=None):
+    """processing.stream_pcm blocks of filename decoded depth blocks ahead by
+    a decoder thread, with enough buffers that the blocks stay valid while
+    they are parsed.
+    """
+    blocks = p.stream_pcm(filename, block_length, start=start,
+            duration=duration, n_buffers=p.prefetch_buffers(depth))
+    return p.prefetch(blocks, depth)
+
+def parameter_key(segment_length=300):
+    """Identifies the settings parse_mp3 with workers identifies calls with,
+    for telling whether a checkpointed segment needs to be parsed again.
+    :returns sha1 hex digest of the parameters
+    """
+    settings = StreamingParser(None).parameters()
+    settings["segment_length"] = segment_length
+    settings["segment_margin"] = SEGMENT_MARGIN
+    #segments are decoded on the serial parser's chunk grid
+    settings["segment_grid"] = "chunk"
+    return hashlib.sha1(json.dumps(settings, sort_keys=True)).hexdigest()
+
+#seconds of audio decoded either side of a segment in parse_segment (at
+#least, the decoded audio is extended to whole chunks)
+SEGMENT_MARGIN = 5.0
+
+def parse_segment(segment):
+    """Parses one segment of a recording for parse_mp3 with workers, in a
+    worker process.  At least SEGMENT_MARGIN seconds either side of the
+    segment are decoded as well, so calls near its ends are scored in
+    context and calls running past its end are complete.
+
+    The decoded audio starts and ends on the chunk boundaries of a
+    StreamingParser parsing the whole recording, so the segment's frames and
+    normalization chunks are the serial parser's and it finds the same calls
+    with the same offsets (up to rounding).  Only the calls starting inside
+    the segment are kept, so every call belongs to exactly one segment.  With
+    noise_floor="running" the running estimates still start over in every
+    segment, so the calls only match the serial parser's approximately.
+    :segment: (filename, start, length, block_length, prefetch, cache,
+    cache_key) tuple, with start and length in seconds, prefetch the number
+    of blocks decoded ahead (see prefetch_pcm) and cache and cache_key as
+    for parse_mp3 (the entry is read if it is there, never stored)
+    :returns list of (offset, audio) of the calls in offset order
+    """
+    filename, start, length, block_length, prefetch, cache, cache_key = \
+            segment
+    handler = CallList()
+    parser = StreamingParser(handler, cache=cache, cache_key=cache_key)
+    #samples per chunk of frames
+    chunk_size = parser.chunk_frames*parser.step_size
+    first_chunk = max(int(np.floor((start - SEGMENT_MARGIN)*
+        parser.frequency/chunk_size)), 0)
+    last_chunk = int(np.ceil((start + length + SEGMENT_MARGIN)*
+        parser.frequency/chunk_size))
+    decode_start = first_chunk*chunk_size*1.0/parser.frequency
+    parser.offset = decode_start
+    parser.identify_calls(prefetch_pcm(filename, block_length, prefetch,
+        start=decode_start,
+        duration=(last_chunk - first_chunk)*chunk_size*1.0/parser.frequency))
+    return [(offset, audio) for offset, audio in handler.calls
+            if start <= offset < start + length]
+
+
+#record of one call found by detect, times in seconds
+DETECTION_DTYPE = np.dtype([("start", "<f8"), ("end", "<f8"),
+    ("peak_score", "<f8"), ("mean_score", "<f8")])
+
+#detect params that are arguments of StreamingParser rather than attributes
+DETECT_ARGUMENTS = ("step_size_divisor", "noise_floor", "chunk_length",
+        "fft_dtype")
+#detect params that are scoring settings, which can be set after the
+#StreamingParser is constructed (the others, e.g. step_size, determine
+#attributes computed in the constructor)
+DETECT_SETTINGS = ("threshold", "ipd_filters", "base_peak_filter",
+        "max_base_peak", "min_ridge_length", "mpd", "with_negative")
+
+def detect(audio, sample_rate=44100, params=None, offset=0,
+        block_length=60):
+    """Identifies the calls in a whole signal and returns them as one array,
+    with nothing passed to a CallHandler and no call audio copied.  The calls
+    are the ones StreamingParser (and so parse_mp3) identifies.
+    :audio: 1d array of samples (or anything sliceable like one, e.g. a
+    wav_memmap.WavAudio)
+    :sample_rate: sample frequency of audio, needs to be 44100
+    :params: dict of settings to change from the StreamingParser defaults,
+    any of the scoring settings in DETECT_SETTINGS or the StreamingParser
+    arguments in DETECT_ARGUMENTS (e.g. step_size_divisor rather than
+    step_size)
+    :offset: time in seconds of the first sample, added to the call times
+    :block_length: seconds of audio transformed at a time, bounds the memory
+    used for samples and frames
+    :returns structured array of DETECTION_DTYPE in time order, the scores
+    are of the smoothed frame scores over each call
+    """
+    params = dict(params or {})
+    arguments = dict((key, params.pop(key)) for key in DETECT_ARGUMENTS
+            if key in params)
+    scorer = FrameScorer(frequency=sample_rate, **arguments)
+    for key, value in params.items():
+        if key not in DETECT_SETTINGS:
+            raise Exception("pika2.detect: parameter {} can't be set, use " \
+                    "one of {}".format(key, ", ".join(DETECT_SETTINGS +
+                        DETECT_ARGUMENTS)))
+        setattr(scorer, key, value)
+    scorer.build_filter_tables()
+
+    block_size = int(block_length*sample_rate)
+    for start in xrange(0, len(audio), block_size):
+        scorer.feed(audio[start:start + block_size])
+    frame_scores = scorer.finish()
+    if len(frame_scores) == 0:
+        return np.zeros(0, dtype=DETECTION_DTYPE)
+
+    smoothed = intervals.smooth(frame_scores, scorer.smoothing_width())
+    starts, ends, open_start = intervals.threshold_ridges(smoothed,
+            scorer.threshold)
+    if open_start is not None:
+        #like StreamingParser.flush, a ridge still open ends at the last frame
+        starts = np.append(starts, open_start)
+        ends = np.append(ends, len(smoothed) - 1)
+        stops = np.append(ends[:-1], len(smoothed))
+    else:
+        stops = ends
+    keep = stops*scorer.factor - starts*scorer.factor > \
+            scorer.min_ridge_length
+    starts, ends, stops = starts[keep], ends[keep], stops[keep]
+    peaks, means = intervals.ridge_scores(smoothed, starts, ends)
+
+    calls = np.empty(len(starts), dtype=DETECTION_DTYPE)
+    calls["start"] = offset + starts*scorer.factor
+    #the last frames run past the end of the audio
+    calls["end"] = np.minimum(offset + stops*scorer.factor,
+            offset + len(audio)*1.0/sample_rate)
+    calls["peak_score"] = peaks
+    calls["mean_score"] = means
+    return calls
 
 
 class Parser(object):
@@ -66,24 +287,40 @@ class Parser(object):
     
     Long sections of audio are tough on memory usage, so longer audio is
     pre-chopped into 10 second or shorter chunks.  This can cause issues if
-    a pika call is on a bounder between chunks.  If necessary the code could
-    be adjusted to deal with that situation, but for now it will be ignored
-    in favor of getting things working otherwise.
+    a pika call is on a bounder between chunks.  StreamingParser deals with
+    that situation and is what parse_mp3 uses.
     """
     #*Constructor*#
-    def __init__(self, audio_file, handler, offset=0, step_size_divisor=2, debug=False):
+    def __init__(self, audio_file, handler, offset=0, step_size_divisor=2, debug=False,
+            fft_dtype=np.float64, frequency=44100, noise_floor="chunk",
+            audio_dtype=None, mmap=True):
         """
-        :audio_file should be the path to a wav file.
+        :audio_file should be the path to a wav file, or a 1d numpy array of
+        already decoded audio (e.g. a block from processing.stream_pcm).
         :handler should be of type CallHandler
         :offset for if file is a segment of a parent audio file, for
         example if it starts at 240 seconds into the original file the
         offset should be 240
+        :fft_dtype dtype of the spectrogram, np.float32 halves its memory
+        :frequency sample frequency of audio_file when it is an array
+        :noise_floor "chunk" to normalize and noise reduce each chunk with its
+        own max and mean spectrum, or "running" to use running estimates
+        (stft.RunningNoiseFloor) that carry over from chunk to chunk so
+        results don't depend on chunk length
+        :audio_dtype dtype to keep the audio as, e.g. np.float32 for half the
+        memory of the float64 that wav files are read as by default.  Arrays
+        passed as audio_file are only converted if this is given.
+        :mmap if True wav files are memory mapped (wav_memmap.WavAudio) rather
+        than read whole, so only the chunks being parsed are read into memory
         """
-        print audio_file
+        if isinstance(audio_file, basestring):
+            print audio_file
 
         self.offset = offset
+        self.audio_dtype = audio_dtype
+        self.mmap = mmap
 
-        self.full_audio, self.frequency = self.load_audio(audio_file)
+        self.full_audio, self.frequency = self.load_audio(audio_file, frequency)
 
         if not isinstance(handler, CallHandler) and handler is not None:
             raise Exception("pika.Parser called with handler that is not " \
@@ -92,15 +329,24 @@ class Parser(object):
             self.handler = handler
         if int(self.frequency) != 44100:
             raise Exception("pika.Parser: loaded file ({}) with frequency {}." \
-                    "  Frequency should be 44100.".format(audio_file, frequency))
+                    "  Frequency should be 44100.".format(audio_file, self.frequency))
         self.debug = debug
         
         self.fft = None
+        self.fft_dtype = fft_dtype
         self.fft_size = 4096
         self.step_size = int(self.fft_size*1.0/step_size_divisor)
         self.factor = self.step_size*1.0/self.frequency
         self.fft_window = [self.fft_size/32 + 150]
         self.fft_window.append(self.fft_window[0] + 275)
+        if noise_floor == "running":
+            #estimates adapt over about 10 seconds of frames
+            self.noise_floor = stft.RunningNoiseFloor(10.0/self.factor)
+        elif noise_floor == "chunk":
+            self.noise_floor = None
+        else:
+            raise Exception("pika.Parser: unknown noise_floor {}, should be " \
+                    "'chunk' or 'running'".format(noise_floor))
         
         #minimum peak distance for calculating harmonic frequencies
         self.mpd = 40 
@@ -123,9 +369,40 @@ class Parser(object):
         #joint tuning
         self.ipd_filters = [[45, 93], [110, 165]] 
         self.base_peak_filter = [15, 60]
+        #frames whose first peak is at or above this bin are not candidates
+        self.max_base_peak = 120
+
+        #smoothed frame scores must ridge above threshold for longer than
+        #min_ridge_length seconds to be identified as a call
+        #self.threshold = 10.5
+        self.threshold = 8.5
+        #self.threshold = 10.0
+        self.min_ridge_length = .13
+        self.build_filter_tables()
         
         self.interval_finder=self.interval_finder_with_negative
 
+    def parameters(self):
+        """The settings that affect which calls are identified, as a dict"""
+        return {"frequency": self.frequency, "fft_size": self.fft_size,
+                "step_size": self.step_size, "fft_window": self.fft_window,
+                "noise_floor": "chunk" if self.noise_floor is None
+                    else "running",
+                "mpd": self.mpd, "ipd_filters": self.ipd_filters,
+                "base_peak_filter": self.base_peak_filter,
+                "max_base_peak": self.max_base_peak,
+                "threshold": self.threshold,
+                "min_ridge_length": self.min_ridge_length,
+                "smoothing_width": self.smoothing_width()}
+
+    def build_filter_tables(self):
+        """Builds the lookup tables used by score_fft from self.ipd_filters and
+        self.base_peak_filter, needs to be called again if they are changed.
+        """
+        size = self.fft_window[1] - self.fft_window[0]
+        self.ipd_table = scoring.filter_table(self.ipd_filters, size)
+        self.base_peak_table = scoring.filter_table([self.base_peak_filter], size)
+
     def close(self):
         """Handles needed cleanup in particular sets full_audio to None
         """
@@ -146,7 +423,8 @@ class Parser(object):
 
         audio = self.get_audio_interval(interval)
         self.filtered_fft(audio)
-        frame_scores = self.score_fft(with_negative=True)
+        #the per frame loop prints the details of each frame
+        frame_scores = self.score_fft(with_negative=True, reference=True)
         print "Passing intervals {}".format(
                 self.find_passing_intervals(frame_scores))
         self.spectrogram(title=title)
@@ -181,9 +459,16 @@ class Parser(object):
         #self.basic_interval_finder
         if self.debug:
             print "ipd filters: {}".format(self.ipd_filters)
+        fft_buffer = None
+        if self.noise_floor is not None:
+            self.noise_floor.reset()
         with self.handler as handler:
             for chunk, offset in p.segment_audio(self.full_audio, self.frequency):
-                self.filtered_fft(chunk)
+                if fft_buffer is None:
+                    #first chunk is the longest so the buffer fits all chunks
+                    fft_buffer = stft.spectrogram_buffer(len(chunk), self.fft_size,
+                            self.step_size, self.fft_window, self.fft_dtype)
+                self.filtered_fft(chunk, out=fft_buffer)
                 good_intervals = self.interval_finder()
                 for interval in good_intervals:
                     handler.handle_call(self.offset + offset + interval[0],
@@ -192,7 +477,8 @@ class Parser(object):
 
     def verify_call(self, call):
         plt.ion()
-        self.filtered_fft(self.full_audio)
+        if self.fft is None:
+            self.filtered_fft(self.full_audio)
         self.spectrogram("call id: {}, offset {:.0f}:{:2.1f}".format(call.id, 
             np.floor(call.offset/60), call.offset%60))
         response = u.get_verification(call)
@@ -200,45 +486,58 @@ class Parser(object):
         return response
 
     #*Private Methods*#
-    def load_audio(self, audio_file):
+    def load_audio(self, audio_file, frequency=None):
+        if audio_file is None:
+            return audio_file, frequency
+        if isinstance(audio_file, np.ndarray):
+            return p.mono(audio_file, self.audio_dtype), frequency
+        if clips.is_packed(audio_file):
+            audio, frequency = clips.load_clip(audio_file)
+            return p.mono(audio, self.audio_dtype), frequency
         if audio_file[-3:] == "mp3":
             raise Exception("pika.Parser only works directly on wav files" \
                     "to process mp3, use pika.parse_mp3 helper function." )
         elif audio_file[-3:] == "wav":
-            (audio, frequency, nBits) = scikits.audiolab.wavread(audio_file)
-            if audio.ndim == 2: 
-                #get left channel if a stereo file not needed for mono
-                audio = [v[0] for v in audio]
+            if self.mmap:
+                try:
+                    audio = wav_memmap.WavAudio(audio_file,
+                            dtype=self.audio_dtype or np.float64)
+                    return audio, audio.frequency
+                except wav_memmap.UnsupportedFormat:
+                    #e.g. 24 bit pcm, which can't be memory mapped
+                    pass
+            #get left channel if a stereo file not needed for mono
+            audio, frequency = p.load_wav(audio_file,
+                    self.audio_dtype or np.float64)
         return audio, frequency
     
-    def filtered_fft(self, audio=None):
+    def filtered_fft(self, audio=None, out=None):
+        """Computes the normalized, noise reduced spectrogram of audio and
+        stores it in self.fft as a 2d numpy array (one row per frame).
+        :audio: defaults to the full audio
+        :out: optional buffer from stft.spectrogram_buffer to write the
+        spectrogram into, self.fft is then a view of that buffer so it is only
+        valid until the buffer is reused
+        """
         if audio is None:
             audio = self.full_audio
-        first_dim=np.ceil(1.0*(len(audio))/(self.step_size))
-        second_dim = self.fft_window[1] - self.fft_window[0]
-        fft = np.zeros((first_dim, second_dim))
-        for i in xrange(0, len(audio), self.step_size):
-            f = np.absolute(np.fft.fft(audio[i:i+self.fft_size], self.fft_size))
-            f = f[self.fft_window[0]:self.fft_window[1]] 
-            fft[i/self.step_size] = f 
-        
-        #normalize
-        max_val = np.amax(fft)
-        fft = fft/np.max([max_val, .1])
+        fft = stft.magnitude_spectrogram(audio, self.fft_size,
+                self.step_size, self.fft_window, out=out, dtype=self.fft_dtype)
         if self.debug:
-            print "segment max value: {}".format(max_val)
-        
-        #noise-reduction
-        avg_fft = np.sum(fft, axis=0)/len(fft)
-        for i, frame in enumerate(fft):
-            fft[i] = [max(frame[j]-avg_fft[j], 0) for j, v in enumerate(frame)] 
+            print "segment max value: {}".format(np.amax(fft))
         
-        #filter out quiet parts
-        f_mean = np.mean(fft)
-        threshold = .05
+        self.filtered_fft_frames(fft)
+
+    def filtered_fft_frames(self, fft):
+        """Normalizes and noise reduces frames that have already been
+        transformed (in place) and stores them in self.fft.
+        """
+        if self.noise_floor is not None:
+            self.fft = self.noise_floor.filter(fft)
+            return
         #self.fft = [[1 if x > .08 else x for x in f] for f in fft] 
         #self.fft = [[10*x if x <= .1 and x > .01 else x for x in f] for f in fft] 
-        self.fft = [[x if x > f_mean + threshold else 0.0 for x in f] for f in fft] 
+        self.fft = stft.filter_spectrogram(fft, threshold=.05, min_max=.1)
     
     def fft_bin_to_frequency(self, bin_number):
         """self.step_size, self.frequency, and self.fft_window all need to be 
@@ -252,9 +551,23 @@ class Parser(object):
         bin_size = 1.0*self.frequency/self.fft_size
         return (1+bin_number+self.fft_window[0])*bin_size
     
-    def score_fft(self, with_negative=False):
+    def score_fft(self, with_negative=False, reference=False):
         """Scores frames for how likely they seem to be part of a pika call
-        :debug: if True outputs statements to help debug scoring process
+        :with_negative: if True ipds that fail the ipd filters lower the score
+        :reference: if True uses the original per frame loop in
+        score_fft_reference, which should give the same scores
+        :returns 1d array of likeliness scores corresponding to the frames
+        """
+        if reference:
+            return self.score_fft_reference(with_negative)
+        locs, counts = peaks.detect_peaks_2d(self.fft, mpd=self.mpd)
+        return scoring.score_frames(locs, counts, self.ipd_table,
+                self.base_peak_table, with_negative=with_negative,
+                max_base_peak=self.max_base_peak)
+
+    def score_fft_reference(self, with_negative=False):
+        """Per frame loop version of score_fft, kept to check the array based
+        scoring against and for its debug output.
         :returns 1d array of likeliness scores corresponding to the frames
         """
         scores = []
@@ -263,61 +576,59 @@ class Parser(object):
         keep_n = 3
         amount = 0
         for i, frame in enumerate(self.fft):
-            perc_85 = np.percentile(frame, 85)
-            frame_max = np.max(frame)
             score = 0.0
             count = 0
-            if True or (frame_max > 0 and perc_85/frame_max > .05):
-                locs = peaks.detect_peaks(frame, mpd=self.mpd)
-                
-                #tuned for beacon rock
-                #if len(locs) >= 3 and locs[0] < 90: 
-                
-                #tuned for angel's rest
-                #if len(locs) >= 3 and locs[0] < 120 and locs[0] > 25: 
-                
-                #tuned for Herman's Creek
-                #if len(locs) >= 3 and locs[0] < 120: 
-                #having trouble with noise in Herman's Creek -maybe can look at
-                #filter on peak energy vs. trough per frame or perhaps on total
-                #energy per frame since I suspect the pika calls have overall 
-                #higher intensity than the noisy bits
-
-                #joint tuning
-                if len(locs) >= 3 and locs[0] < 120:
-                    ipd = np.convolve(locs, [1, -1])
-                    amount = 5.0/(len(locs) - 2)
-                    if ((ipd[0] >= self.base_peak_filter[0]) and
-                            (ipd[0] <= self.base_peak_filter[1])):
+            locs = peaks.detect_peaks(frame, mpd=self.mpd)
+            
+            #tuned for beacon rock
+            #if len(locs) >= 3 and locs[0] < 90: 
+            
+            #tuned for angel's rest
+            #if len(locs) >= 3 and locs[0] < 120 and locs[0] > 25: 
+            
+            #tuned for Herman's Creek
+            #if len(locs) >= 3 and locs[0] < 120: 
+            #having trouble with noise in Herman's Creek -maybe can look at
+            #filter on peak energy vs. trough per frame or perhaps on total
+            #energy per frame since I suspect the pika calls have overall 
+            #higher intensity than the noisy bits
+
+            #joint tuning
+            if len(locs) >= 3 and locs[0] < self.max_base_peak:
+                ipd = np.convolve(locs, [1, -1])
+                amount = 5.0/(len(locs) - 2)
+                if ((ipd[0] >= self.base_peak_filter[0]) and
+                        (ipd[0] <= self.base_peak_filter[1])):
+                    score += amount
+                else:
+                    score -= amount/2
+
+                for x in ipd[1:-1]:
+                    if any((x >= bot) and (x <= top) 
+                            for bot, top in self.ipd_filters):
                         score += amount
-                    else:
+                        count += 1
+                    elif with_negative:
                         score -= amount/2
+            else:
+                score -= 1
 
-                    for x in ipd[1:-1]:
-                        if any((x >= bot) and (x <= top) 
-                                for bot, top in self.ipd_filters):
-                            score += amount
-                            count += 1
-                        elif with_negative:
-                            score -= amount/2
-                else:
-                    score -= 1
+            if self.debug:
                 if len(n_scores) == keep_n:
                     running_score -= n_scores.popleft()
                 n_scores.append(score)
                 running_score += score
-
-                if self.debug:
-                    if len(locs) != 0:
-                        ipd = np.convolve(locs, [1, -1])
-                        print "t: {:.2f}, {:.1f} | {} | ipd {}, count {}, score {}".format(i*self.factor, running_score, amount, ipd, count, score)
-                        r_max = np.max(frame)
-                        print "t: {:.2f}, 85%: {:.3f}, mean: {:.3f}, sd: {:.3f}".format(
-                                i*self.factor, np.percentile(frame, 85)/r_max,
-                                np.mean(frame)/r_max, np.std(frame)/r_max)
-                        print "t: {:.2f}, f: {}, ipd sd: {:.1f}, mean: {:.1f}, frame max: {:.3f}".format(
-                                i*self.factor, i,
-                                np.std(ipd[1:-1]), np.mean(ipd[1:-1]), frame_max)
+                if len(locs) != 0:
+                    frame_max = np.max(frame)
+                    ipd = np.convolve(locs, [1, -1])
+                    print "t: {:.2f}, {:.1f} | {} | ipd {}, count {}, score {}".format(i*self.factor, running_score, amount, ipd, count, score)
+                    r_max = np.max(frame)
+                    print "t: {:.2f}, 85%: {:.3f}, mean: {:.3f}, sd: {:.3f}".format(
+                            i*self.factor, np.percentile(frame, 85)/r_max,
+                            np.mean(frame)/r_max, np.std(frame)/r_max)
+                    print "t: {:.2f}, f: {}, ipd sd: {:.1f}, mean: {:.1f}, frame max: {:.3f}".format(
+                            i*self.factor, i,
+                            np.std(ipd[1:-1]), np.mean(ipd[1:-1]), frame_max)
 
             scores.append(score)
         return scores
@@ -325,36 +636,19 @@ class Parser(object):
     def find_passing_intervals(self, frame_scores):
         """
         :frame_scores: pika call likelihood scores of fft frames.
-        :returns list of intervals (in seconds) that are identified as 
-        containing a pika call
+        :returns array of intervals (in seconds) that are identified as 
+        containing a pika call, one [start, end] row per interval
+        """
+        return intervals.passing_intervals(frame_scores, self.factor,
+                self.smoothing_width(), self.threshold, self.min_ridge_length)
+
+    def smoothing_width(self):
+        """Number of frames the frame scores are smoothed over before
+        thresholding, fewer frames when the frames are far apart.
         """
         if self.factor > .05:
-            scores = np.convolve(frame_scores,
-                    [.5, .5, .5], mode='same')
-        else:
-            scores = np.convolve(frame_scores,
-                    [.5, .5, .5, .5, .5, .5, .5, .5, .5, .5], mode='same')
-        #if self.debug:
-            #print "frame_scores: {}".format(frame_scores)
-            #print "smoothed scores: {}".format(scores)
-        ridges = []
-        current_ridge = None
-        #threshold = 10.5
-        threshold = 8.5
-        #threshold = 10.0
-        for i, s in enumerate(scores):
-            if current_ridge is not None:
-                if s < threshold:
-                    ridges.append([current_ridge, (i -1)*self.factor])
-                    current_ridge = None
-            else:
-                if s > threshold:
-                    current_ridge = i*self.factor
-        if current_ridge is not None:
-            ridges.append([current_ridge, len(scores)*self.factor])
-        min_ridge_length = .13
-        ridges[:] = [r for r in ridges if r[1] - r[0] > min_ridge_length]
-        return ridges
+            return 3
+        return 10
 
     def spectrogram(self, title=None):
         #plt.figure(figsize=(6, 3))
@@ -377,3 +671,288 @@ class Parser(object):
         #plt.tight_layout()
         plt.show(block=False)
     
+
+
+class StreamingParser(Parser):
+    """
+    Parser for audio that arrives in blocks, e.g. from processing.stream_pcm,
+    so that long recordings can be parsed with small blocks without losing
+    calls on the boundaries between blocks.
+
+    Each fft frame is computed exactly once: the audio after the last full
+    frame is kept until the next block arrives.  The frames are normalized and
+    scored in chunks of chunk_length seconds (like segment_audio chunks in
+    Parser.identify_calls), but the smoothing of the frame scores and any
+    ridge still above threshold carry over from one chunk to the next, so
+    each call is passed to the handler once with its true offset.
+
+    With noise_floor="running" the frames don't wait for a chunk to fill up,
+    they are scored as soon as they are computed, so memory use stays the
+    same whatever the length of the recording.  Only the first frames are
+    held back until the running estimates can be seeded from them (see
+    stft.RunningNoiseFloor), so the calls don't depend on the block size.
+
+    With a spectrogram_cache.SpectrogramCache and the recording's content
+    hash, identify_calls reads the frames from the recording's entry if it
+    is there, and otherwise stores the frames it computes as the entry when
+    it parses a whole recording (offset 0), for the later stages.
+    """
+    #*Constructor*#
+    def __init__(self, handler, offset=0, step_size_divisor=2, debug=False,
+            fft_dtype=np.float64, frequency=44100, chunk_length=10,
+            noise_floor="chunk", audio_dtype=np.float32, cache=None,
+            cache_key=None):
+        """
+        :handler should be of type CallHandler
+        :offset of the first block in the recording in seconds
+        :frequency sample frequency of the blocks
+        :chunk_length seconds of frames normalized together
+        :noise_floor see Parser
+        :audio_dtype dtype the audio waiting for frames and calls is kept as,
+        float32 matches processing.stream_pcm so the blocks aren't converted
+        :cache spectrogram_cache.SpectrogramCache of recording spectrograms
+        :cache_key content hash of the recording the blocks are from (e.g.
+        Recording.content_hash), the cache is only used if given
+        """
+        Parser.__init__(self, None, handler, offset, step_size_divisor, debug,
+                fft_dtype, frequency, noise_floor, audio_dtype=audio_dtype)
+        self.with_negative = True
+        self.cache = cache
+        self.cache_key = cache_key
+        #entry frames are read from (and the frame of self.offset in it), or
+        #FrameWriter the computed frames are stored with, by identify_calls
+        self.cached = None
+        self.cached_start = 0
+        self.cache_writer = None
+        self.chunk_length = chunk_length
+        self.chunk_frames = stft.frame_count(int(chunk_length*self.frequency),
+                self.step_size)
+        if self.noise_floor is None:
+            self.fft_buffer = np.empty((self.chunk_frames,
+                self.fft_window[1] - self.fft_window[0]), dtype=self.fft_dtype)
+        self.reset()
+
+    def reset(self):
+        """Clears the state carried between blocks"""
+        #audio not yet needed for frames or calls, starting at sample
+        #samples_start (relative to self.offset)
+        self.samples = np.zeros(0, dtype=self.audio_dtype)
+        self.samples_start = 0
+        self.total_samples = 0
+        #raw frames waiting for their chunk to fill up
+        self.next_frame = 0
+        self.chunk_filled = 0
+        #frame scores not yet smoothed, starting (width - 1)/2 frames before
+        #frame smoothed_frames
+        lead = (self.smoothing_width() - 1)//2
+        self.scores = np.zeros(self.smoothing_width() - 1 - lead)
+        self.smoothed_frames = 0
+        self.open_start = None
+        #frames held back until the running noise floor is seeded
+        self.warmup_frames = []
+        if self.noise_floor is not None:
+            self.noise_floor.reset()
+
+    def parameters(self):
+        settings = Parser.parameters(self)
+        settings["chunk_length"] = self.chunk_length
+        settings["with_negative"] = self.with_negative
+        return settings
+
+    #*Public Methods*#
+    def identify_calls(self, blocks):
+        """Identifies the calls in blocks, an iterable of (audio, offset) such
+        as processing.stream_pcm returns.  The blocks need to be consecutive,
+        their offsets are not used.
+        """
+        self.open_cache()
+        try:
+            with self.handler:
+                for block, offset in blocks:
+                    self.feed(block)
+                self.flush()
+            if self.cache_writer is not None:
+                self.cache_writer.commit()
+        finally:
+            if self.cache_writer is not None:
+                self.cache_writer.abort()
+            self.cached = None
+            self.cache_writer = None
+
+    def feed(self, block):
+        """Adds the next block of audio, passing any calls that are complete
+        to the handler.
+        """
+        self.samples = np.concatenate((self.samples,
+            np.asarray(block, dtype=self.audio_dtype)))
+        self.total_samples += len(block)
+        start = self.next_frame*self.step_size - self.samples_start
+        self.add_frames(self.raw_frames(start, pad=False))
+        self.trim_samples()
+
+    def flush(self):
+        """Finishes the audio, the frames that run past its end are zero
+        padded like in Parser.  The parser is reset afterwards.
+        """
+        start = self.next_frame*self.step_size - self.samples_start
+        if start < len(self.samples):
+            self.add_frames(self.raw_frames(start, pad=True))
+        if self.warmup_frames:
+            self.score_running()
+        if self.chunk_filled > 0:
+            self.score_chunk()
+        #the smoothing window runs past the last frame into zeros
+        self.smooth_scores(np.zeros((self.smoothing_width() - 1)//2),
+                final=True)
+        if self.open_start is not None:
+            self.handle_ridge(self.open_start, self.next_frame)
+        self.reset()
+
+    #*Private Methods*#
+    def open_cache(self):
+        """Looks up the recording's entry for identify_calls, or starts
+        storing it if the whole recording is being parsed
+        """
+        self.cached = None
+        self.cache_writer = None
+        if self.cache is None or self.cache_key is None:
+            return
+        start = spectrogram_cache.grid_frame(self.offset, self.step_size,
+                self.frequency)
+        if start is None:
+            return
+        self.cached = self.cache.lookup(self.cache_key, self.fft_size,
+                self.step_size, self.fft_window, self.fft_dtype,
+                self.frequency)
+        self.cached_start = start
+        if self.cached is None and start == 0:
+            self.cache_writer = self.cache.writer(self.cache_key,
+                    self.fft_size, self.step_size, self.fft_window,
+                    self.fft_dtype, self.frequency)
+
+    def raw_frames(self, start, pad):
+        """Magnitude frames of self.samples[start:], read from the cached
+        entry if there is one.
+        :pad: see stft.magnitude_spectrogram
+        """
+        audio = self.samples[start:]
+        if self.cached is not None:
+            if pad:
+                n_frames = stft.frame_count(len(audio), self.step_size)
+            else:
+                n_frames = len(stft.frame_audio(audio, self.fft_size,
+                    self.step_size))
+            first = self.cached_start + self.next_frame
+            if first + n_frames <= len(self.cached):
+                return self.cached[first:first + n_frames]
+        raw = stft.magnitude_spectrogram(audio, self.fft_size,
+                self.step_size, self.fft_window, dtype=self.fft_dtype, pad=pad)
+        if self.cache_writer is not None:
+            self.cache_writer.append(raw)
+        return raw
+
+    def add_frames(self, raw):
+        """Copies raw frames into the chunk buffer, scoring every chunk that
+        fills up.  With a running noise floor the frames are scored directly,
+        once there are enough to seed it.
+        """
+        if self.noise_floor is not None:
+            self.next_frame += len(raw)
+            self.warmup_frames.append(raw)
+            if (self.noise_floor.seeded or sum(len(frames) for frames in
+                    self.warmup_frames) >= self.noise_floor.warmup):
+                self.score_running()
+            return
+        used = 0
+        while used < len(raw):
+            n = min(len(raw) - used, self.chunk_frames - self.chunk_filled)
+            self.fft_buffer[self.chunk_filled:self.chunk_filled + n] = \
+                    raw[used:used + n]
+            self.chunk_filled += n
+            self.next_frame += n
+            used += n
+            if self.chunk_filled == self.chunk_frames:
+                self.score_chunk()
+
+    def score_running(self):
+        """Scores the frames waiting for the running noise floor"""
+        raw = np.concatenate(self.warmup_frames)
+        self.warmup_frames = []
+        self.filtered_fft_frames(raw)
+        self.smooth_scores(self.score_fft(with_negative=self.with_negative))
+
+    def score_chunk(self):
+        self.filtered_fft_frames(self.fft_buffer[:self.chunk_filled])
+        self.smooth_scores(self.score_fft(with_negative=self.with_negative))
+        self.chunk_filled = 0
+
+    def smooth_scores(self, frame_scores, final=False):
+        """Smooths the frame scores that have enough neighbors available and
+        looks for ridges in them.
+        """
+        width = self.smoothing_width()
+        self.scores = np.concatenate((self.scores, frame_scores))
+        if len(self.scores) < width:
+            return
+        smoothed = np.convolve(self.scores, [.5]*width, mode='valid')
+        if final:
+            #frames past the end are not scored themselves
+            smoothed = smoothed[:self.next_frame - self.smoothed_frames]
+        starts, ends, self.open_start = intervals.threshold_ridges(smoothed,
+                self.threshold, self.open_start, self.smoothed_frames)
+        for start, end in zip(starts, ends):
+            self.handle_ridge(start, end)
+        self.smoothed_frames += len(smoothed)
+        self.scores = self.scores[len(smoothed):]
+
+    def handle_ridge(self, start, end):
+        """Passes the ridge from frame start to frame end to the handler if it
+        is long enough.
+        """
+        interval = [start*self.factor, end*self.factor]
+        if interval[1] - interval[0] <= self.min_ridge_length:
+            return
+        first = max(int(interval[0]*self.frequency) - self.samples_start, 0)
+        last = int(interval[1]*self.frequency) - self.samples_start
+        self.handler.handle_call(self.offset + interval[0],
+                self.samples[first:last])
+
+    def trim_samples(self):
+        """Drops the audio that is no longer needed for frames or calls"""
+        keep_frame = min(self.next_frame, self.smoothed_frames)
+        if self.open_start is not None:
+            keep_frame = min(keep_frame, self.open_start)
+        drop = keep_frame*self.step_size - self.samples_start
+        if drop > 0:
+            self.samples = self.samples[drop:]
+            self.samples_start += drop
+
+
+class FrameScorer(StreamingParser):
+    """
+    StreamingParser that keeps the frame scores instead of looking for calls
+    in them, for detect.  The frames are computed, normalized and scored
+    exactly as StreamingParser does.
+    """
+    #*Constructor*#
+    def __init__(self, offset=0, **kwargs):
+        StreamingParser.__init__(self, None, offset, **kwargs)
+        self.frame_scores = []
+
+    #*Public Methods*#
+    def finish(self):
+        """Scores the rest of the frames (see StreamingParser.flush).
+        :returns 1d array of the scores of all the frames fed
+        """
+        self.flush()
+        scores = np.concatenate(self.frame_scores + [np.zeros(0)])
+        self.frame_scores = []
+        return scores
+
+    #*Private Methods*#
+    def smooth_scores(self, frame_scores, final=False):
+        if final:
+            return
+        self.frame_scores.append(np.asarray(frame_scores, dtype=np.float64))
+        #the samples of scored frames are no longer needed
+        self.smoothed_frames = self.next_frame
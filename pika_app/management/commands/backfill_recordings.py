@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from pika_app.models import Recording, PROBED_FIELDS
+
+
+class Command(BaseCommand):
+    help = "Probes the files of recordings that haven't been probed yet " \
+            "(duration, sample frequency, channels, bitrate, content hash)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true",
+                help="probe every recording again, not just new ones")
+
+    def handle(self, *args, **options):
+        recordings = Recording.objects.all()
+        if not options["all"]:
+            recordings = recordings.filter(content_hash__isnull=True)
+        total = recordings.count()
+        self.stdout.write("Probing {} recordings".format(total))
+        for i, recording in enumerate(recordings.iterator()):
+            try:
+                recording.probe()
+            except Exception as inst:
+                self.stderr.write("Could not probe {}: {}".format(recording,
+                    inst))
+                continue
+            recording.save(update_fields=PROBED_FIELDS)
+            self.stdout.write("{}/{} {}: {:.1f}s, {} Hz".format(i + 1, total,
+                recording, recording.duration, recording.sample_frequency))
@@ -0,0 +1,149 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Count
+from django.utils import timezone
+from pika_app.models import ProcessingJob
+import process_records
+import spectrogram_cache
+import pika2
+import threading
+import traceback
+import socket
+import time
+import os
+
+
+class Command(BaseCommand):
+    help = "Claims unprocessed recordings one at a time and identifies their " \
+            "calls.  Any number of workers can run at once, each recording " \
+            "is only processed by one of them."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--status", action="store_true",
+                help="print the state of the jobs and exit")
+        parser.add_argument("--workers", type=int, default=1,
+                help="number of processes to parse the segments of each " \
+                        "recording with (default: 1, parse in this process)")
+        parser.add_argument("--segment-length", type=float, default=300,
+                help="length in seconds of the checkpointed segments")
+        parser.add_argument("--lazy-clips", action="store_true",
+                help="only save the call times, the call audio is decoded " \
+                        "from the recording when needed")
+        parser.add_argument("--spectrogram-cache", action="store_true",
+                help="store the recordings' spectrograms in the " \
+                        "spectrogram cache (see spectrogram_cache) for " \
+                        "verification")
+        parser.add_argument("--lease", type=float, default=300,
+                help="seconds a job is held without a heartbeat before " \
+                        "other workers may reclaim it")
+        parser.add_argument("--max-attempts", type=int, default=3,
+                help="times a job is tried before it is marked failed")
+        parser.add_argument("--wait", type=float, default=None,
+                help="when there are no jobs, check again after this many " \
+                        "seconds instead of exiting")
+
+    def handle(self, *args, **options):
+        if options["status"]:
+            self.report(options["max_attempts"])
+            return
+        worker = "{}:{}".format(socket.gethostname(), os.getpid())
+        parameters = pika2.parameter_key(options["segment_length"])
+        while True:
+            ProcessingJob.enqueue()
+            job = ProcessingJob.claim(worker, options["lease"],
+                    options["max_attempts"])
+            if job is None:
+                if options["wait"] is None:
+                    break
+                time.sleep(options["wait"])
+                continue
+            self.run(job, parameters, options)
+
+    def run(self, job, parameters, options):
+        """Processes the recording of job while a Heartbeat renews its lease"""
+        self.stdout.write("{} (attempt {})".format(job, job.attempts))
+        heartbeat = Heartbeat(job, options["lease"])
+        heartbeat.start()
+        try:
+            process_records.process_recording(job.recording, parameters,
+                    workers=options["workers"],
+                    segment_length=options["segment_length"],
+                    lazy=options["lazy_clips"], lease=heartbeat,
+                    store_name="clips.attempt{}".format(job.attempts),
+                    cache=spectrogram_cache.default_cache()
+                        if options["spectrogram_cache"] else None)
+        except Exception:
+            heartbeat.stop()
+            if not heartbeat.held():
+                #ToDB stopped, another worker has the job now
+                self.stderr.write("{}: lease lost, stopped processing".format(
+                    job))
+                return
+            error = traceback.format_exc()
+            self.stderr.write(error)
+            job.fail(error, options["max_attempts"])
+            return
+        heartbeat.stop()
+        if not job.complete():
+            #the calls are saved, but another worker reclaimed the job after
+            #the lease ran out and will redo any unfinished segments
+            self.stderr.write("{}: lease lost before completion".format(job))
+
+    def report(self, max_attempts=3):
+        """Prints the number of jobs in each state and the running jobs"""
+        ProcessingJob.expire(max_attempts)
+        counts = dict(ProcessingJob.objects.values_list("status")
+                .annotate(Count("id")))
+        for status, name in ProcessingJob.STATUSES:
+            self.stdout.write("{:>8}: {}".format(name, counts.get(status, 0)))
+        now = timezone.now()
+        for job in ProcessingJob.objects.filter(status=ProcessingJob.RUNNING) \
+                .select_related("recording").order_by("id"):
+            if job.lease_expires < now:
+                state = "lease expired"
+            else:
+                state = "lease {:.0f}s left".format(
+                        (job.lease_expires - now).total_seconds())
+            self.stdout.write("{} worker {}, last heartbeat {}, {}".format(job,
+                job.worker, job.heartbeat, state))
+        for job in ProcessingJob.objects.filter(status=ProcessingJob.FAILED) \
+                .select_related("recording").order_by("id"):
+            error = job.error.strip().splitlines() if job.error else [""]
+            self.stdout.write("{} after {} attempts: {}".format(job,
+                job.attempts, error[-1]))
+
+
+class Heartbeat(threading.Thread):
+    """Renews the lease of a job every third of the lease until stopped or
+    the lease is lost.  The worker's handler checks held() so it stops
+    writing once another worker may have reclaimed the job.
+    """
+    def __init__(self, job, lease):
+        super(Heartbeat, self).__init__()
+        self.daemon = True
+        self.job = job
+        self.lease = lease
+        self.stopped = threading.Event()
+        self.lost = threading.Event()
+        #time.time() the lease runs out, as of the last renewal
+        self.expires = time.time() + lease
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.lease/3.0):
+                renewed = time.time()
+                if not self.job.renew(self.lease):
+                    self.lost.set()
+                    break
+                self.expires = renewed + self.lease
+        finally:
+            #the thread has its own database connection
+            connection.close()
+
+    def held(self):
+        """False once a renewal failed or the lease ran out without one"""
+        return not self.lost.is_set() and time.time() < self.expires
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
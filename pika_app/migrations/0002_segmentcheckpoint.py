@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pika_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SegmentCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('offset', models.FloatField()),
+                ('length', models.FloatField()),
+                ('parameters', models.CharField(max_length=40)),
+                ('completed', models.DateTimeField(auto_now_add=True)),
+                ('recording', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='pika_app.Recording')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='segmentcheckpoint',
+            unique_together=set([('recording', 'offset', 'length', 'parameters')]),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pika_app', '0002_segmentcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recording',
+            name='channels',
+            field=models.IntegerField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='recording',
+            name='bitrate',
+            field=models.IntegerField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='recording',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, default=None, max_length=40, null=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pika_app', '0003_recording_metadata'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessingJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='pending', max_length=10)),
+                ('worker', models.CharField(blank=True, default=None, max_length=100, null=True)),
+                ('lease_expires', models.DateTimeField(blank=True, default=None, null=True)),
+                ('heartbeat', models.DateTimeField(blank=True, default=None, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True, default=None, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(blank=True, default=None, null=True)),
+                ('recording', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='pika_app.Recording')),
+            ],
+        ),
+    ]
@@ -2,6 +2,9 @@ from __future__ import unicode_literals
 
 from django.db import models
 from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+import datetime
 import os
 import mutagen.mp3
 
@@ -44,6 +47,10 @@ class Collection(models.Model):
     class Meta:
         app_label = "pika_app"
 
+#Recording fields filled in by Recording.probe
+PROBED_FIELDS = ["duration", "sample_frequency", "channels", "bitrate",
+        "content_hash"]
+
 class Recording(models.Model):
     collection = models.ForeignKey(Collection, on_delete=models.CASCADE)
     #filename = models.FilePathField(self.observation.collection.folder) #May need to adjust
@@ -54,14 +61,37 @@ class Recording(models.Model):
     recording_file = models.FileField(upload_to = recording_path)
     duration = models.FloatField(default=None, null=True, blank=True)
     sample_frequency = models.FloatField(default=None, null=True, blank=True)
+    channels = models.IntegerField(default=None, null=True, blank=True)
+    bitrate = models.IntegerField(default=None, null=True, blank=True)
+    content_hash = models.CharField(max_length=40, default=None, null=True,
+            blank=True, db_index=True)
     device = models.CharField(max_length=100, default=None,
             null=True, blank=True)
     notes = models.TextField(default=None, blank=True)
     processed = models.BooleanField(default=False)
 
+    @property
+    def filename(self):
+        return self.recording_file.path
+
     def output_folder(self):
         return os.path.dirname(self.filename) + "/recording{}/".format(self.id)
 
+    def probe(self):
+        """Fills in duration, sample_frequency, channels, bitrate and
+        content_hash from the recording file (see processing.probe)
+        """
+        import processing
+        for field, value in processing.probe(self.filename).items():
+            setattr(self, field, value)
+
+    def metadata(self):
+        """The probed fields as a dict, e.g. for processing.segment_mp3"""
+        return {"duration": self.duration,
+                "sample_frequency": self.sample_frequency,
+                "channels": self.channels, "bitrate": self.bitrate,
+                "content_hash": self.content_hash}
+
 #    def __str__(self):
 #        return self.filename
 ## EA 8/1/16 replaced with alternate below
@@ -69,11 +99,20 @@ class Recording(models.Model):
         return "{}_collection{}_recording{}".format(self.collection.observer.name, self.collection.id, self.id)
 
 
-#    def save(self, *args, **kwargs):
-        #Update duration on save if it hasn't already been initialized
-#        if self.duration is None:
-#            self.duration = mutagen.mp3.MP3(self.filename).info.length
-#        super(Recording, self).save(*args, **kwargs)
+    def save(self, *args, **kwargs):
+        super(Recording, self).save(*args, **kwargs)
+        #probe the file on ingest (once it has been stored) if it hasn't
+        #already been probed, saves of only some fields don't probe
+        if (self.content_hash is None and self.recording_file and
+                kwargs.get("update_fields") is None):
+            try:
+                self.probe()
+            except Exception as inst:
+                #missing or unreadable file, the fields stay null for
+                #backfill_recordings to fill in later
+                print "Could not probe {}: {}".format(self, inst)
+                return
+            super(Recording, self).save(update_fields=PROBED_FIELDS)
 
     class Meta:
         app_label = "pika_app"
@@ -87,7 +126,162 @@ class Call(models.Model):
     filename = models.FilePathField(null=True, blank=True) #May need to adjust
 
     def __str__(self):
+        if self.filename is None:
+            #audio is decoded from the recording, see clips.load_call
+            return "{} call at {:.2f}".format(self.recording, self.offset)
         return self.filename
 
     class Meta:
         app_label = "pika_app"
+
+
+class SegmentCheckpoint(models.Model):
+    """A segment of a recording whose calls have all been identified and
+    saved, so an interrupted run can resume after it.
+    :parameters: key of the parser settings the segment was parsed with
+    (see pika2.parameter_key)
+    """
+    recording = models.ForeignKey(Recording, on_delete=models.CASCADE)
+    offset = models.FloatField()
+    length = models.FloatField()
+    parameters = models.CharField(max_length=40)
+    completed = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "recording{} {}-{}".format(self.recording.id, self.offset,
+                self.offset + self.length)
+
+    class Meta:
+        app_label = "pika_app"
+        unique_together = ("recording", "offset", "length", "parameters")
+
+
+class ProcessingJob(models.Model):
+    """A recording waiting to be (or being) processed by a process_worker.
+    A worker claims a job with a lease which it renews with heartbeats while
+    it works, if the worker dies the lease runs out and another worker
+    reclaims the job (resuming from its SegmentCheckpoints).
+    Claiming and renewing are single conditional UPDATEs, so concurrent
+    workers never hold the same job even on SQLite.
+    """
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUSES = ((PENDING, "Pending"), (RUNNING, "Running"), (DONE, "Done"),
+            (FAILED, "Failed"))
+
+    recording = models.OneToOneField(Recording, on_delete=models.CASCADE)
+    status = models.CharField(max_length=10, choices=STATUSES,
+            default=PENDING, db_index=True)
+    #hostname:pid of the worker holding the lease
+    worker = models.CharField(max_length=100, default=None, null=True,
+            blank=True)
+    lease_expires = models.DateTimeField(default=None, null=True, blank=True)
+    heartbeat = models.DateTimeField(default=None, null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(default=None, null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(default=None, null=True, blank=True)
+
+    def __str__(self):
+        return "job{} {}: {}".format(self.id, self.recording, self.status)
+
+    @classmethod
+    def enqueue(cls):
+        """Adds a job for every unprocessed recording without one.
+        :returns number of jobs added
+        """
+        recordings = Recording.objects.filter(processed=False,
+                processingjob__isnull=True)
+        added = 0
+        for recording in recordings:
+            #another worker may be adding the same job
+            _, created = cls.objects.get_or_create(recording=recording)
+            added += created
+        return added
+
+    @classmethod
+    def claimable(cls, max_attempts=3):
+        """Jobs that are pending or whose worker's lease has run out, and
+        that haven't been tried max_attempts times already
+        """
+        now = timezone.now()
+        return cls.objects.filter(Q(status=cls.PENDING) |
+                Q(status=cls.RUNNING, lease_expires__lt=now),
+                attempts__lt=max_attempts)
+
+    @classmethod
+    def expire(cls, max_attempts=3):
+        """Marks failed the jobs whose worker's lease ran out on their last
+        attempt, which would otherwise stay running with nobody to claim
+        them.
+        :returns number of jobs marked failed
+        """
+        now = timezone.now()
+        return cls.objects.filter(status=cls.RUNNING, lease_expires__lt=now,
+                attempts__gte=max_attempts).update(status=cls.FAILED,
+                        lease_expires=None, finished=now,
+                        error="lease ran out on the last attempt")
+
+    @classmethod
+    def claim(cls, worker, lease=300, max_attempts=3):
+        """Takes the oldest claimable job for worker.  The job is only taken
+        if it is still claimable when it is updated, so if another worker
+        claimed it first the next one is tried.
+        :lease: seconds the job is held without a heartbeat
+        :returns the claimed ProcessingJob or None if there are none left
+        """
+        cls.expire(max_attempts)
+        while True:
+            job_id = cls.claimable(max_attempts).order_by("id") \
+                    .values_list("id", flat=True).first()
+            if job_id is None:
+                return None
+            now = timezone.now()
+            claimed = cls.claimable(max_attempts).filter(id=job_id).update(
+                    status=cls.RUNNING, worker=worker, heartbeat=now,
+                    lease_expires=now + datetime.timedelta(seconds=lease),
+                    attempts=F("attempts") + 1, error=None)
+            if claimed:
+                return cls.objects.get(id=job_id)
+
+    def renew(self, lease=300):
+        """Heartbeat, extends the lease by lease seconds from now.
+        :returns False if the lease was lost (it ran out and another worker
+        reclaimed the job)
+        """
+        now = timezone.now()
+        return self.update_held(heartbeat=now,
+                lease_expires=now + datetime.timedelta(seconds=lease))
+
+    def complete(self):
+        """Marks the job done if this worker still holds it"""
+        return self.update_held(status=self.DONE, lease_expires=None,
+                finished=timezone.now())
+
+    def fail(self, error, max_attempts=3):
+        """Records error (e.g. a traceback) and puts the job back to be
+        claimed again, or marks it failed once it has been tried
+        max_attempts times.
+        """
+        if self.attempts < max_attempts:
+            status, finished = self.PENDING, None
+        else:
+            status, finished = self.FAILED, timezone.now()
+        return self.update_held(status=status, lease_expires=None,
+                error=error, finished=finished)
+
+    def update_held(self, **fields):
+        """Updates fields only if this worker still holds the job.
+        :returns True if it did
+        """
+        updated = ProcessingJob.objects.filter(id=self.id, worker=self.worker,
+                status=self.RUNNING).update(**fields)
+        if updated:
+            for field, value in fields.items():
+                setattr(self, field, value)
+        return bool(updated)
+
+    class Meta:
+        app_label = "pika_app"
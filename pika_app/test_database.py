@@ -0,0 +1,171 @@
+"""
+Tests of the processing that reads and writes the database, these need the
+test database: run them with "python manage.py test pika_app".
+"""
+import datetime
+import tempfile
+import shutil
+import os
+import numpy as np
+import django.test
+from django.utils import timezone
+from pika_app.models import (Observer, Collection, Recording, ProcessingJob,
+        Call, SegmentCheckpoint)
+import process_records
+
+
+def create_recording():
+    """Recording of a collection, already probed so saving doesn't look for
+    the file
+    """
+    observer = Observer.objects.create(name="observer")
+    collection = Collection.objects.create(observer=observer,
+            description="", notes="")
+    return Recording.objects.create(collection=collection,
+            start_time=timezone.now(), recording_file="recording.mp3",
+            content_hash="0"*40, notes="")
+
+
+class ProcessingJobTest(django.test.TestCase):
+    def setUp(self):
+        self.job = ProcessingJob.objects.create(recording=create_recording())
+
+    def run_out(self, job):
+        """Lets the lease of job run out"""
+        ProcessingJob.objects.filter(id=job.id).update(
+                lease_expires=timezone.now() - datetime.timedelta(seconds=1))
+
+    def test_held_job_is_not_claimed(self):
+        job = ProcessingJob.claim("a")
+        self.assertEqual(job.id, self.job.id)
+        self.assertEqual((job.status, job.worker, job.attempts),
+                (ProcessingJob.RUNNING, "a", 1))
+        self.assertIsNone(ProcessingJob.claim("b"))
+        self.assertTrue(job.renew())
+
+    def test_reclaim_after_lease_expires(self):
+        first = ProcessingJob.claim("a")
+        self.run_out(first)
+        second = ProcessingJob.claim("b")
+        self.assertEqual(second.id, first.id)
+        self.assertEqual((second.worker, second.attempts), ("b", 2))
+        self.assertIsNone(ProcessingJob.claim("c"))
+
+    def test_expire_fails_last_attempt(self):
+        job = ProcessingJob.claim("a", max_attempts=2)
+        self.run_out(job)
+        #one attempt left, it can be reclaimed
+        self.assertEqual(ProcessingJob.expire(max_attempts=2), 0)
+        job = ProcessingJob.claim("b", max_attempts=2)
+        self.run_out(job)
+        self.assertEqual(ProcessingJob.expire(max_attempts=2), 1)
+        job = ProcessingJob.objects.get(id=job.id)
+        self.assertEqual(job.status, ProcessingJob.FAILED)
+        self.assertIsNotNone(job.finished)
+        self.assertIsNone(ProcessingJob.claim("c", max_attempts=2))
+
+    def test_update_held_refuses_former_holder(self):
+        first = ProcessingJob.claim("a")
+        self.run_out(first)
+        second = ProcessingJob.claim("b")
+        self.assertFalse(first.renew())
+        self.assertFalse(first.fail("error"))
+        self.assertFalse(first.complete())
+        job = ProcessingJob.objects.get(id=second.id)
+        self.assertEqual((job.status, job.worker, job.error),
+                (ProcessingJob.RUNNING, "b", None))
+        self.assertTrue(second.complete())
+        self.assertEqual(ProcessingJob.objects.get(id=second.id).status,
+                ProcessingJob.DONE)
+
+
+class FailingCheckpoint(object):
+    """Stands in for SegmentCheckpoint in process_records, the checkpoint is
+    written and then the transaction fails
+    """
+    class objects(object):
+        @staticmethod
+        def create(**kwargs):
+            SegmentCheckpoint.objects.create(**kwargs)
+            raise IOError("disk full")
+
+
+class ToDBTest(django.test.TransactionTestCase):
+    """Segments saved by process_records.ToDB, with real transactions so the
+    on_commit hooks run
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings = django.test.override_settings(
+                MEDIA_ROOT=self.directory)
+        self.settings.enable()
+        self.recording = create_recording()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.directory)
+
+    def run_segment(self, offset, length, call_offsets, parameters="a",
+            lazy=False):
+        """Saves calls of a tenth of a second at call_offsets as the calls of
+        the segment from offset, as parse_mp3 with workers does
+        """
+        with process_records.ToDB(self.recording, 44100, parameters,
+                lazy=lazy) as handler:
+            handler.start_segment(offset, length)
+            for call_offset in call_offsets:
+                handler.handle_call(call_offset,
+                        np.zeros(4410, dtype=np.float32))
+            handler.segment_complete(offset, length)
+
+    def offsets(self):
+        return sorted(Call.objects.filter(recording=self.recording)
+                .values_list("offset", flat=True))
+
+    def test_rerun_replaces_unreviewed_calls(self):
+        self.run_segment(0, 30, [1.0, 5.0, 10.0])
+        self.run_segment(30, 30, [40.0])
+        Call.objects.filter(offset=5.0).update(verified=True)
+        #other parameters, e.g. a retuned threshold
+        self.run_segment(0, 30, [1.2, 5.05, 20.0], parameters="b")
+        #the call overlapping the reviewed one is dropped, the other
+        #segment is untouched
+        self.assertEqual(self.offsets(), [1.2, 5.0, 20.0, 40.0])
+        self.assertTrue(Call.objects.get(offset=5.0).verified)
+        self.assertEqual(Call.objects.filter(verified__isnull=True,
+            offset__lt=30).count(), 2)
+
+    def test_segment_done_needs_matching_checkpoint(self):
+        self.run_segment(0, 30, [1.0])
+        handler = process_records.ToDB(self.recording, 44100, "a", lazy=True)
+        self.assertTrue(handler.segment_done(0, 30))
+        self.assertFalse(handler.segment_done(0, 31))
+        self.assertFalse(handler.segment_done(30, 30))
+        other = process_records.ToDB(self.recording, 44100, "b", lazy=True)
+        self.assertFalse(other.segment_done(0, 30))
+        self.assertEqual(SegmentCheckpoint.objects.count(), 1)
+
+    def test_failed_segment_rolls_back(self):
+        self.run_segment(0, 30, [1.0, 5.0])
+        #a call saved as a wav file before the clips were packed
+        wav_file = os.path.join(self.directory, "offset_8.0.wav")
+        with open(wav_file, "wb") as f:
+            f.write("RIFF")
+        Call.objects.create(recording=self.recording, offset=8.0,
+                duration=.1, filename=wav_file)
+        process_records.SegmentCheckpoint = FailingCheckpoint
+        try:
+            self.assertRaises(IOError, self.run_segment, 0, 30, [2.0],
+                    parameters="b")
+        finally:
+            process_records.SegmentCheckpoint = SegmentCheckpoint
+        self.assertEqual(self.offsets(), [1.0, 5.0, 8.0])
+        self.assertFalse(SegmentCheckpoint.objects.filter(
+            parameters="b").exists())
+        self.assertTrue(os.path.exists(wav_file))
+        #the wav file is only removed once the replacement is committed
+        self.run_segment(0, 30, [2.0], parameters="b")
+        self.assertEqual(self.offsets(), [2.0])
+        self.assertTrue(SegmentCheckpoint.objects.filter(
+            parameters="b").exists())
+        self.assertFalse(os.path.exists(wav_file))
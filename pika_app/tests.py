@@ -1,3 +1,972 @@
-from django.test import TestCase
+"""
+Tests of the array based processing against the per frame code it replaced.
 
-# Create your tests here.
+The reference implementations (the original loops) are kept here as the
+oracles, so these only need numpy and the modules under test.  The tests
+that need the database are in test_database.py.
+"""
+import unittest
+import tempfile
+import shutil
+import os
+import numpy as np
+import stft
+import find_peaks as peaks
+import scoring
+import intervals
+import pika2
+import call_handler
+import pfft
+import clips
+import wav_memmap
+import processing
+import pika_parser
+import spectrogram_cache
+import struct
+import collections
+import utility
+import scikits.audiolab
+
+
+def reference_spectrogram(audio, fft_size, step_size, fft_window):
+    """The per frame loop Parser.filtered_fft used before stft"""
+    fft = np.zeros((int(np.ceil(1.0*len(audio)/step_size)),
+        fft_window[1] - fft_window[0]))
+    for i in xrange(0, len(audio), step_size):
+        f = np.absolute(np.fft.fft(audio[i:i+fft_size], fft_size))
+        fft[i/step_size] = f[fft_window[0]:fft_window[1]]
+    return fft
+
+
+class StftTest(unittest.TestCase):
+    def setUp(self):
+        self.audio = np.random.RandomState(0).randn(44100)
+        self.fft_window = [278, 553]
+
+    def test_matches_per_frame_loop(self):
+        for step_size in (2048, 64, 1000):
+            expected = reference_spectrogram(self.audio, 4096, step_size,
+                    self.fft_window)
+            spec = stft.magnitude_spectrogram(self.audio, 4096, step_size,
+                    self.fft_window)
+            self.assertEqual(spec.shape, expected.shape)
+            self.assertLess(np.abs(spec - expected).max(),
+                    1e-12*expected.max())
+
+    def test_short_audio_is_zero_padded(self):
+        audio = self.audio[:3000]
+        expected = reference_spectrogram(audio, 4096, 2048, self.fft_window)
+        spec = stft.magnitude_spectrogram(audio, 4096, 2048, self.fft_window)
+        self.assertTrue(np.allclose(spec, expected, rtol=0, atol=1e-9))
+
+    def test_unpadded_frames_and_out_buffer(self):
+        spec = stft.magnitude_spectrogram(self.audio, 4096, 2048,
+                self.fft_window)
+        unpadded = stft.magnitude_spectrogram(self.audio, 4096, 2048,
+                self.fft_window, pad=False)
+        self.assertEqual(len(unpadded), len(stft.frame_audio(self.audio,
+            4096, 2048)))
+        self.assertTrue(np.array_equal(unpadded, spec[:len(unpadded)]))
+        out = stft.spectrogram_buffer(len(self.audio) + 5000, 4096, 2048,
+                self.fft_window)
+        written = stft.magnitude_spectrogram(self.audio, 4096, 2048,
+                self.fft_window, out=out)
+        self.assertTrue(np.array_equal(written, spec))
+
+
+def stable_detect_peaks(x, mpd):
+    """find_peaks.detect_peaks with a stable sort of the peak heights, so
+    peaks of the same height are visited from the last to the first
+    """
+    x = np.asarray(x, dtype=np.float64)
+    ind = peaks.detect_peaks(x, mpd=1)
+    ind = ind[np.argsort(x[ind], kind="mergesort")][::-1]
+    idel = np.zeros(ind.size, dtype=bool)
+    for i in range(ind.size):
+        if not idel[i]:
+            idel = idel | (ind >= ind[i] - mpd) & (ind <= ind[i] + mpd)
+            idel[i] = 0
+    return np.sort(ind[~idel])
+
+
+class DetectPeaks2dTest(unittest.TestCase):
+    def assert_rows(self, x, mpd, reference):
+        locs, counts = peaks.detect_peaks_2d(x, mpd=mpd)
+        for row, row_locs, count in zip(x, locs, counts):
+            expected = reference(row)
+            self.assertEqual(count, len(expected))
+            self.assertTrue(np.array_equal(row_locs[:count], expected))
+            self.assertTrue((row_locs[count:] == -1).all())
+
+    def test_matches_detect_peaks(self):
+        #spectrogram like rows, no two peaks have the same height
+        x = np.abs(np.random.RandomState(1).randn(300, 275))
+        for mpd in (1, 5, 40):
+            self.assert_rows(x, mpd, lambda row: peaks.detect_peaks(row,
+                mpd=mpd))
+
+    def test_flat_peaks(self):
+        x = np.array([[0, 1, 1, 0, 2, 2, 2, 0, 1, 0],
+            [0, 0, 0, 0, 0, 0, 0, 0, 0, 0]], dtype=float)
+        self.assert_rows(x, 1, lambda row: peaks.detect_peaks(row))
+
+    def test_tied_heights(self):
+        """Tied peaks are visited from the last to the first, as
+        detect_peaks does when its sort is stable.  detect_peaks itself
+        uses an unstable argsort, so it can keep different tied peaks
+        (e.g. for row below, 1 7 15 ... instead of 1 11 21 ...).
+        """
+        row = np.array([2, 3, 0, 2, 0, 2, 1, 3, 0, 3, 2, 3, 0, 1, 1, 2, 0, 2,
+            1, 2, 0, 2, 2, 1, 0, 1, 0, 2, 0, 1, 0, 1, 2, 0, 2, 3, 2, 3, 3],
+            dtype=float)
+        self.assert_rows(row[None], 5, lambda r: stable_detect_peaks(r, 5))
+        x = np.random.RandomState(2).randint(0, 4, (500, 40))
+        self.assert_rows(x, 5, lambda r: stable_detect_peaks(r, 5))
+
+
+def call_audio(seconds, call_times, seed=0, frequency=44100):
+    """Noise with harmonic chirps roughly like pika calls starting at each of
+    call_times (in seconds)
+    """
+    rng = np.random.RandomState(seed)
+    audio = rng.randn(int(seconds*frequency))*.05
+    t = np.arange(int(.25*frequency))*1.0/frequency
+    for start in call_times:
+        f0 = rng.uniform(650, 750)
+        call = sum(np.sin(2*np.pi*f0*k*t) for k in range(1, 10))*.1
+        i = int(start*frequency)
+        audio[i:i + len(call)] += call[:len(audio) - i]
+    return audio
+
+
+class ScoringTest(unittest.TestCase):
+    def setUp(self):
+        audio = call_audio(20, np.arange(.5, 19, 1.3))
+        self.parser = pika2.Parser(audio, None)
+        self.parser.filtered_fft()
+
+    def test_matches_reference_loop(self):
+        for with_negative in (False, True):
+            scores = self.parser.score_fft(with_negative)
+            expected = self.parser.score_fft_reference(with_negative)
+            self.assertTrue(np.allclose(scores, expected, rtol=0,
+                atol=1e-12))
+        #the calls are actually scored, not just -1 everywhere
+        self.assertGreater(np.max(scores), 1)
+
+    def test_filter_settings(self):
+        self.parser.ipd_filters = [[60, 93], [130, 165]]
+        self.parser.base_peak_filter = [30, 60]
+        self.parser.max_base_peak = 90
+        self.parser.build_filter_tables()
+        self.assertTrue(np.allclose(self.parser.score_fft(True),
+            self.parser.score_fft_reference(True), rtol=0, atol=1e-12))
+
+
+class ScoreFramesSweepTest(unittest.TestCase):
+    """Every column of scoring.score_frames_sweep (as sweep.py scores
+    recordings) against scoring.score_frames with that column's settings
+    """
+    def setUp(self):
+        audio = call_audio(20, np.arange(.5, 19, 1.3))
+        self.parser = pika2.Parser(audio, None)
+        self.parser.filtered_fft()
+
+    def test_columns_match_score_frames(self):
+        locs, counts = peaks.detect_peaks_2d(self.parser.fft,
+                mpd=self.parser.mpd)
+        settings = [([[45, 93], [110, 165]], [15, 60], 120, -1, True),
+                ([[52, 70], [110, 135]], [30, 60], 90, -1, False),
+                ([[60, 93], [130, 165]], [30, 60], 120, 25, True)]
+        ipd_tables = [scoring.filter_table(f, 275)
+                for f, b, m, l, n in settings]
+        base_tables = [scoring.filter_table([b], 275)
+                for f, b, m, l, n in settings]
+        swept = scoring.score_frames_sweep(locs, counts, ipd_tables,
+                base_tables, [n for f, b, m, l, n in settings],
+                [m for f, b, m, l, n in settings],
+                [l for f, b, m, l, n in settings])
+        for c, (f, b, m, l, n) in enumerate(settings):
+            self.assertTrue(np.array_equal(swept[:, c], scoring.score_frames(
+                locs, counts, ipd_tables[c], base_tables[c], n, m, l)))
+        #the lower bound excludes frames the other settings score
+        low = (counts >= 3) & (locs[:, 0] <= 25) & (locs[:, 0] < 120)
+        self.assertTrue((swept[low, 2] == -1).all())
+
+    def test_shared_settings_and_small_blocks(self):
+        """Scalar with_negative and max_base_peaks, as sweep.sweep_scores
+        passes them, and frames split over several histogram blocks
+        """
+        locs, counts = peaks.detect_peaks_2d(self.parser.fft,
+                mpd=self.parser.mpd)
+        filters = [[[45, 93], [110, 165]], [[60, 93], [130, 165]]]
+        ipd_tables = [scoring.filter_table(f, 275) for f in filters]
+        base_tables = [scoring.filter_table([[15, 60]], 275)]*2
+        swept = scoring.score_frames_sweep(locs, counts, ipd_tables,
+                base_tables, True, 120, block_frames=37)
+        for c in range(len(filters)):
+            self.assertTrue(np.array_equal(swept[:, c], scoring.score_frames(
+                locs, counts, ipd_tables[c], base_tables[c], True, 120)))
+
+
+def reference_passing_intervals(frame_scores, factor, width, threshold,
+        min_ridge_length):
+    """The ridge loop Parser.find_passing_intervals used before intervals"""
+    scores = np.convolve(frame_scores, [.5]*width, mode='same')
+    ridges = []
+    current_ridge = None
+    for i, s in enumerate(scores):
+        if current_ridge is not None:
+            if s < threshold:
+                ridges.append([current_ridge, (i -1)*factor])
+                current_ridge = None
+        else:
+            if s > threshold:
+                current_ridge = i*factor
+    if current_ridge is not None:
+        ridges.append([current_ridge, len(scores)*factor])
+    return [r for r in ridges if r[1] - r[0] > min_ridge_length]
+
+def reference_get_intervals(segments, factor):
+    """processing.get_intervals and reduce_intervals before intervals"""
+    found = []
+    interval_start = None
+    for i, val in enumerate(segments):
+        if interval_start is None:
+            if val > 0:
+                interval_start = int(np.floor(i*factor))
+        elif val == 0:
+            found.append([interval_start, int(np.ceil(i*factor))])
+            interval_start = None
+    if interval_start is not None:
+        found.append([interval_start, int(np.ceil(factor*len(segments)))])
+    reduced = []
+    interval_start = None
+    for s in found:
+        if interval_start is not None:
+            if s[0] <= interval_end:
+                interval_end = s[1]
+            else:
+                reduced.append([interval_start, interval_end])
+                interval_start = s[0]
+                interval_end = s[1]
+        else:
+            interval_start = s[0]
+            interval_end = s[1]
+    if interval_start is not None:
+        reduced.append([interval_start, found[-1][1]])
+    return reduced
+
+
+class IntervalsTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        #smoothed scores land exactly on the threshold now and then
+        self.scores = np.repeat(rng.choice([-1, 0, 2, 3.5, 4, 5, 6], 600),
+                rng.randint(1, 12, 600))
+
+    def test_passing_intervals_match_loop(self):
+        for width, threshold, min_length in ((3, 8.5, .13), (10, 10.5, .1),
+                (10, 14.0, .0)):
+            expected = reference_passing_intervals(self.scores, .0464,
+                    width, threshold, min_length)
+            found = intervals.passing_intervals(self.scores, .0464, width,
+                    threshold, min_length)
+            self.assertGreater(len(expected), 0)
+            self.assertTrue(np.array_equal(found,
+                np.array(expected).reshape(-1, 2)))
+
+    def test_ridge_open_at_the_end(self):
+        scores = np.concatenate((np.zeros(20), np.full(30, 10.0)))
+        expected = reference_passing_intervals(scores, .05, 3, 8.5, .13)
+        self.assertTrue(np.array_equal(intervals.passing_intervals(scores,
+            .05, 3, 8.5, .13), expected))
+
+    def test_nonzero_and_merge_match_loops(self):
+        rng = np.random.RandomState(4)
+        values = rng.choice([-1, 0, 0, 0, 1, 2], 3000)
+        for factor in (.0464, .5, 1.7):
+            expected = reference_get_intervals(values, factor)
+            found = intervals.merge_intervals(intervals.nonzero_intervals(
+                values, factor))
+            self.assertTrue(np.array_equal(found,
+                np.array(expected).reshape(-1, 2)))
+
+    def test_runs_carry_open_ridge(self):
+        scores = intervals.smooth(self.scores, 3)
+        starts, ends, open_start = intervals.threshold_ridges(scores, 8.5)
+        pieces = []
+        carry = None
+        for first in range(0, len(scores), 137):
+            s, e, carry = intervals.threshold_ridges(
+                    scores[first:first + 137], 8.5, carry, first)
+            pieces.extend(zip(s, e))
+        self.assertEqual(pieces, zip(starts, ends))
+        self.assertEqual(carry, open_start)
+
+
+class IntervalFormatTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fft = pfft.ProcessedFFT(call_audio(3, [1.0]), [278, 553], 4096,
+                64, 44100, offset=12.5)
+        self.fft.process_fft(normalize=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_quantised_round_trip(self):
+        filename = os.path.join(self.directory, "offset_12.5.wav")
+        for dtype, tolerance in ((np.float32, 1e-6), (np.uint8, .5/255)):
+            self.fft.serialize_interval(0, 3, filename, dtype=dtype)
+            loaded = pfft.load_interval(filename)
+            self.assertEqual(loaded.fft.dtype, dtype)
+            self.assertEqual(loaded.offset, 12.5)
+            max_val = np.amax(self.fft.fft)
+            self.assertLessEqual(np.abs(loaded.frames() - self.fft.fft).max(),
+                    tolerance*max_val)
+
+
+class ActiveSegmentsTest(unittest.TestCase):
+    """write_active_segments on a decoded chunk with calls at known times"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = self.directory + os.sep
+        self.call_times = [3.0, 12.4]
+        self.audio = (call_audio(20, self.call_times, seed=3)*.5).astype(
+                np.float32)
+        self.stream_pcm = processing.stream_pcm
+
+    def tearDown(self):
+        processing.stream_pcm = self.stream_pcm
+        shutil.rmtree(self.directory)
+
+    def fake_stream_pcm(self, filename, block_length=600,
+            output_frequency=44100, start=0, duration=None, n_buffers=2):
+        """Yields the chunk 7 seconds at a time in one reused buffer, as
+        stream_pcm does with n_buffers=1
+        """
+        block_size = 7*output_frequency
+        buf = np.zeros(block_size, dtype=np.float32)
+        for i in xrange(0, len(self.audio), block_size):
+            block = self.audio[i:i + block_size]
+            buf[:len(block)] = block
+            yield buf[:len(block)], i*1.0/output_frequency
+
+    def test_segments_and_index(self):
+        segments = processing.write_active_segments("recording.mp3",
+                self.path, 120, audio=self.audio)
+        self.assertEqual(len(segments), len(self.call_times))
+        for (offset, duration, filename), call_time in zip(segments,
+                self.call_times):
+            #whole seconds of the chunk around each call
+            start = offset - 120
+            self.assertEqual(start, int(start))
+            self.assertLessEqual(start, call_time)
+            self.assertGreaterEqual(start + duration, call_time + .25)
+            self.assertLess(duration, 3)
+            self.assertEqual(filename,
+                    self.path + "offset_{}.wav".format(offset))
+            audio, freq = processing.load_wav(filename)
+            self.assertEqual(freq, 44100)
+            expected = self.audio[int(start*44100):
+                    int((start + duration)*44100)]
+            self.assertEqual(len(audio), len(expected))
+            self.assertAlmostEqual(duration, len(expected)/44100.0)
+            self.assertLessEqual(np.abs(audio - expected).max(), 1e-4)
+            #the spectrogram stored next to the wav
+            fft = pfft.load_interval(filename)
+            self.assertEqual(fft.offset, offset)
+            self.assertEqual((fft.fft_size, fft.step_size, fft.frequency),
+                    (4096, 64, 44100))
+            self.assertFalse(fft.normalized)
+            reference = stft.magnitude_spectrogram(expected, 4096, 64,
+                    fft.fft_window)
+            self.assertEqual(fft.fft.shape, reference.shape)
+            self.assertTrue(np.allclose(fft.frames(), reference, rtol=1e-5,
+                atol=1e-4))
+        processing.write_segment_index(self.path, segments)
+        self.assertEqual(processing.read_segment_index(self.path), segments)
+
+    def test_decodes_file_once(self):
+        expected = processing.write_active_segments("recording.mp3",
+                self.path, 120, audio=self.audio)
+        processing.stream_pcm = self.fake_stream_pcm
+        self.assertTrue(np.array_equal(processing.decode_audio(
+            "recording.mp3"), self.audio))
+        path = os.path.join(self.directory, "decoded") + os.sep
+        os.mkdir(path)
+        segments = processing.write_active_segments("recording.mp3", path,
+                120)
+        self.assertEqual([(offset, duration) for offset, duration, filename
+            in segments], [(offset, duration) for offset, duration, filename
+                in expected])
+        self.assertIsNone(processing.read_segment_index(path))
+
+
+class FailingHandler(call_handler.CallList):
+    def handle_call(self, offset, audio):
+        raise IOError("disk full")
+
+
+class ThreadedHandlerTest(unittest.TestCase):
+    def test_calls_are_passed_on_in_order(self):
+        handler = call_handler.CallList()
+        with call_handler.ThreadedHandler(handler, depth=2) as threaded:
+            for i in range(10):
+                threaded.handle_call(i, np.full(3, i))
+        self.assertEqual([offset for offset, audio in handler.calls],
+                range(10))
+
+    def test_writer_error_is_raised(self):
+        def parse():
+            with call_handler.ThreadedHandler(FailingHandler()) as threaded:
+                threaded.handle_call(0, np.zeros(3))
+        self.assertRaises(IOError, parse)
+
+    def test_parser_error_is_not_replaced(self):
+        def parse():
+            with call_handler.ThreadedHandler(FailingHandler()) as threaded:
+                threaded.handle_call(0, np.zeros(3))
+                #let the writer fail first
+                threaded.thread.join(.5)
+                raise KeyError("parser")
+        self.assertRaises(KeyError, parse)
+
+
+class ToFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "calls.wav")
+        rng = np.random.RandomState(10)
+        #offsets in seconds at 1000 samples per second, the second call
+        #starts between samples and the third overlaps it
+        self.calls = [(.5, rng.uniform(-.5, .5, 100)),
+                (1.2345, rng.uniform(-.5, .5, 50)),
+                (1.25, rng.uniform(-.5, .5, 30))]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, condensed):
+        handler = call_handler.ToFile(self.filename, 1000,
+                condensed=condensed, gap_block_length=.1)
+        with handler:
+            for offset, audio in self.calls:
+                handler.handle_call(offset, audio)
+        return handler
+
+    def assert_audio(self, expected):
+        audio, frequency = processing.load_wav(self.filename)
+        self.assertEqual(frequency, 1000)
+        self.assertEqual(len(audio), len(expected))
+        #pcm16
+        self.assertTrue(np.allclose(audio, expected, rtol=0, atol=1e-4))
+
+    def test_calls_at_their_offsets(self):
+        self.write(False)
+        (first, a), (second, b), (third, c) = self.calls
+        #600 to 1234 is a gap of whole samples, the overlapping call follows
+        #straight on from the one before
+        expected = np.concatenate([np.zeros(500), a, np.zeros(634), b, c])
+        self.assert_audio(expected)
+        self.assertFalse(os.path.exists(os.path.join(self.directory,
+            "calls_index.csv")))
+
+    def test_condensed_index(self):
+        handler = self.write(True)
+        self.assert_audio(np.concatenate([audio for offset, audio in
+            self.calls]))
+        self.assertEqual(handler.index_filename(),
+                os.path.join(self.directory, "calls_index.csv"))
+        with open(handler.index_filename()) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], "offset,position,duration")
+        index = np.array([map(float, line.split(",")) for line in lines[1:]])
+        self.assertTrue(np.allclose(index, [[.5, 0, .1], [1.2345, .1, .05],
+            [1.25, .15, .03]], rtol=0, atol=1e-6))
+
+
+def write_wav(filename, data, bits, audio_format=1, frequency=44100,
+        channels=1):
+    """Writes data (bytes of the samples, interleaved if there is more than
+    one channel) as a wav file
+    """
+    fmt = struct.pack("<HHIIHH", audio_format, channels, frequency,
+            frequency*channels*bits//8, channels*bits//8, bits)
+    with open(filename, "wb") as f:
+        f.write(struct.pack("<4sI4s", "RIFF", 36 + len(data), "WAVE"))
+        f.write(struct.pack("<4sI", "fmt ", len(fmt)) + fmt)
+        f.write(struct.pack("<4sI", "data", len(data)) + data)
+
+
+class WavAudioTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "audio.wav")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_pcm16(self):
+        samples = np.array([0, 16384, -32768, 32767], dtype="<i2")
+        write_wav(self.filename, samples.tobytes(), 16)
+        audio = wav_memmap.WavAudio(self.filename)
+        self.assertEqual(audio.frequency, 44100)
+        self.assertTrue(np.array_equal(audio[:], samples/32768.0))
+
+    def test_unsupported_format(self):
+        write_wav(self.filename, "\0"*30, 24)
+        self.assertRaises(wav_memmap.UnsupportedFormat, wav_memmap.WavAudio,
+                self.filename)
+        #other problems aren't mistaken for an unsupported format
+        with open(self.filename, "wb") as f:
+            f.write("not a wav file")
+        try:
+            wav_memmap.WavAudio(self.filename)
+        except wav_memmap.UnsupportedFormat:
+            self.fail("a broken file was reported as an unsupported format")
+        except Exception:
+            pass
+
+
+class StereoWavTest(unittest.TestCase):
+    """Stereo wav files are loaded as their left channel"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "stereo.wav")
+        rng = np.random.RandomState(4)
+        samples = rng.randint(-32768, 32768, size=(2*44100, 2)).astype("<i2")
+        write_wav(self.filename, samples.tobytes(), 16, channels=2)
+        self.left = samples[:, 0]/32768.0
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assert_left_channel(self, audio, dtype):
+        self.assertEqual(audio.ndim, 1)
+        self.assertEqual(audio.dtype, dtype)
+        self.assertTrue(audio.flags["C_CONTIGUOUS"])
+        self.assertTrue(np.array_equal(audio, self.left.astype(dtype)))
+
+    def test_load_wav(self):
+        for dtype in (np.float64, np.float32):
+            audio, freq = processing.load_wav(self.filename, dtype)
+            self.assertEqual(freq, 44100)
+            self.assert_left_channel(audio, dtype)
+        #what the per sample list used to give
+        stereo, freq = scikits.audiolab.wavread(self.filename)[:2]
+        self.assertTrue(np.array_equal(processing.load_wav(self.filename)[0],
+            [v[0] for v in stereo]))
+
+    def test_mono(self):
+        stereo = np.column_stack((self.left, -self.left))
+        self.assert_left_channel(processing.mono(stereo, np.float32),
+                np.float32)
+        self.assertTrue(np.array_equal(processing.mono(stereo, channel=1),
+            -self.left))
+        #no copy of audio that is already a contiguous channel
+        self.assertIs(processing.mono(self.left), self.left)
+
+    def test_parsers_keep_dtype(self):
+        for mmap in (False, True):
+            parser = pika2.Parser(self.filename, None, mmap=mmap,
+                    audio_dtype=np.float32, fft_dtype=np.float32)
+            self.assert_left_channel(np.asarray(parser.full_audio[:]),
+                    np.float32)
+            parser.filtered_fft()
+            self.assertEqual(parser.fft.dtype, np.float32)
+        parser = pika_parser.PikaParser(None, self.filename, None,
+                audio_dtype=np.float32)
+        self.assert_left_channel(parser.full_audio, np.float32)
+
+
+class ClipStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "clips")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_append_after_interrupted_write(self):
+        rng = np.random.RandomState(8)
+        audio = [rng.randn(n).astype(np.float32) for n in (300, 0, 50, 120)]
+        with clips.ClipStore(self.path, 44100) as store:
+            store.append(1.5, audio[0])
+            store.append(2.0, audio[1])
+        #samples and half an index entry of a clip that was never committed
+        with open(self.path + ".pcm", "ab") as f:
+            f.write(rng.randn(500).astype(np.float32).tobytes())
+        with open(self.path + ".idx", "ab") as f:
+            f.write("\0"*(clips.INDEX_DTYPE.itemsize//2))
+        reader = clips.ClipStore(self.path)
+        first = reader.read(0)
+        with clips.ClipStore(self.path) as store:
+            self.assertEqual(len(store), 2)
+            self.assertEqual(store.append(3.0, audio[2]),
+                    clips.clip_name(self.path, 2))
+            store.append(4.0, audio[3])
+        #the files were written over, not cut short under the reader's maps
+        self.assertTrue(np.array_equal(first, audio[0]))
+        store = clips.ClipStore(self.path)
+        self.assertEqual(len(store), 4)
+        for index, samples in enumerate(audio):
+            self.assertTrue(np.array_equal(store.read(index), samples))
+        self.assertTrue(np.array_equal(store.offsets(), [1.5, 2.0, 3.0, 4.0]))
+
+
+def stream_calls(audio, block_length, settings=None, **kwargs):
+    """Offsets and lengths of the calls StreamingParser finds in audio fed
+    block_length seconds at a time
+    :settings: dict of attributes to set on the parser (e.g. threshold)
+    """
+    handler = call_handler.CallList()
+    parser = pika2.StreamingParser(handler, **kwargs)
+    for key, value in (settings or {}).items():
+        setattr(parser, key, value)
+    parser.build_filter_tables()
+    block_size = int(block_length*44100)
+    parser.identify_calls((audio[i:i + block_size], i/44100.0)
+            for i in xrange(0, len(audio), block_size))
+    return [(offset, len(audio)) for offset, audio in handler.calls]
+
+
+class BlockCacheTest(unittest.TestCase):
+    """BlockCache.read with the decoding replaced by slices of an array"""
+    def setUp(self):
+        #10.5 seconds at 100 Hz in 2 second blocks of 200 samples
+        self.audio = np.arange(1050, dtype=np.float32)
+        self.cache = clips.BlockCache(block_length=2, max_blocks=2,
+                frequency=100)
+        self.decoded = []
+        self.stream_pcm = clips.processing.stream_pcm
+        clips.processing.stream_pcm = self.fake_stream_pcm
+        self.block_cache = clips._block_cache
+
+    def tearDown(self):
+        clips.processing.stream_pcm = self.stream_pcm
+        clips._block_cache = self.block_cache
+
+    def fake_stream_pcm(self, filename, block_length=600,
+            output_frequency=44100, start=0, duration=None, n_buffers=2):
+        """Yields the audio from start a second at a time in one reused
+        buffer, as stream_pcm does with n_buffers=1
+        """
+        self.decoded.append((filename, start))
+        first = int(round(start*output_frequency))
+        last = len(self.audio)
+        if duration is not None:
+            last = min(first + int(round(duration*output_frequency)), last)
+        buf = np.zeros(output_frequency, dtype=np.float32)
+        for i in xrange(first, last, output_frequency):
+            block = self.audio[i:min(i + output_frequency, last)]
+            buf[:len(block)] = block
+            yield buf[:len(block)], i*1.0/output_frequency
+
+    def test_read_within_block(self):
+        audio = self.cache.read("recording.mp3", 2.5, 1.0)
+        self.assertTrue(np.array_equal(audio, self.audio[250:350]))
+        #a view of the cached block, not a copy
+        self.assertIs(audio.base, self.cache.blocks[("recording.mp3", 1)])
+        self.assertEqual(self.decoded, [("recording.mp3", 2)])
+        audio = self.cache.read("recording.mp3", 2.0, 2.0)
+        self.assertTrue(np.array_equal(audio, self.audio[200:400]))
+        self.assertEqual(len(self.decoded), 1)
+
+    def test_read_spanning_blocks(self):
+        audio = self.cache.read("recording.mp3", 3.5, 1.0)
+        self.assertTrue(np.array_equal(audio, self.audio[350:450]))
+        self.assertEqual(self.decoded, [("recording.mp3", 2),
+            ("recording.mp3", 4)])
+
+    def test_read_at_end(self):
+        audio = self.cache.read("recording.mp3", 9.5, 2.0)
+        self.assertTrue(np.array_equal(audio, self.audio[950:]))
+        self.assertEqual(len(self.cache.blocks[("recording.mp3", 5)]), 50)
+        self.assertEqual(len(self.cache.read("recording.mp3", 10.5, .5)), 0)
+
+    def test_least_recently_used_evicted(self):
+        self.cache.read("recording.mp3", 0, 1)
+        self.cache.read("recording.mp3", 2, 1)
+        #used again, so block 1 is now the least recently used
+        self.cache.read("recording.mp3", .5, 1)
+        self.cache.read("recording.mp3", 4, 1)
+        self.assertEqual(list(self.cache.blocks), [("recording.mp3", 0),
+            ("recording.mp3", 2)])
+        self.assertEqual(len(self.decoded), 3)
+        self.assertTrue(np.array_equal(self.cache.read("recording.mp3", 2.5,
+            1), self.audio[250:350]))
+        self.assertEqual(self.decoded[-1], ("recording.mp3", 2))
+        self.assertEqual(list(self.cache.blocks), [("recording.mp3", 2),
+            ("recording.mp3", 1)])
+
+    def test_load_call(self):
+        clips._block_cache = self.cache
+        Recording = collections.namedtuple("Recording", ["filename"])
+        Call = collections.namedtuple("Call", ["filename", "recording",
+            "offset", "duration"])
+        audio, frequency = clips.load_call(Call(None,
+            Recording("recording.mp3"), 1.5, 1.0))
+        self.assertEqual(frequency, 100)
+        self.assertTrue(np.array_equal(audio, self.audio[150:250]))
+
+
+class StreamingParserTest(unittest.TestCase):
+    def setUp(self):
+        #calls straddling the 10 second chunk boundaries
+        self.call_times = [2.0, 9.9, 15.3, 19.85, 29.95, 33.1]
+        self.audio = call_audio(40, self.call_times, seed=5).astype(
+                np.float32)
+
+    def test_block_size_does_not_change_calls(self):
+        expected = stream_calls(self.audio, 40)
+        self.assertGreater(len(expected), 0)
+        for block_length in (1, 7.3, 10):
+            self.assertEqual(stream_calls(self.audio, block_length), expected)
+
+    def test_running_noise_floor_block_size_does_not_change_calls(self):
+        expected = stream_calls(self.audio, 40, noise_floor="running")
+        self.assertGreater(len(expected), 0)
+        for block_length in (1, 7.3, 10):
+            self.assertEqual(stream_calls(self.audio, block_length,
+                noise_floor="running"), expected)
+
+    def test_running_noise_floor_seed(self):
+        """The estimates only depend on the first warmup frames"""
+        spec = np.abs(np.random.RandomState(6).randn(500, 275))
+        whole = stft.RunningNoiseFloor(100).filter(spec.copy())
+        blocks = stft.RunningNoiseFloor(100)
+        blocks.seed(spec)
+        pieces = [blocks.filter(spec[i:i + 37].copy())
+                for i in xrange(0, len(spec), 37)]
+        self.assertTrue(np.allclose(np.concatenate(pieces), whole, rtol=0,
+            atol=1e-9))
+
+    def test_calls_on_chunk_boundaries_are_found(self):
+        offsets = np.array([offset for offset, length in
+            stream_calls(self.audio, 60)])
+        for time in self.call_times:
+            self.assertLess(np.min(np.abs(offsets - time)), .3)
+
+
+class DetectTest(unittest.TestCase):
+    def setUp(self):
+        self.call_times = [2.0, 9.9, 15.3, 19.85, 29.95, 33.1]
+        self.audio = call_audio(40, self.call_times, seed=5).astype(
+                np.float32)
+
+    def assert_matches_stream(self, params, settings=None, **kwargs):
+        calls = pika2.detect(self.audio, params=params, block_length=7)
+        expected = stream_calls(self.audio, 40, settings, **kwargs)
+        self.assertGreater(len(expected), 0)
+        self.assertTrue(np.allclose(calls["start"],
+            [offset for offset, length in expected], rtol=0, atol=1e-9))
+        self.assertTrue((calls["end"] > calls["start"]).all())
+        self.assertTrue((calls["peak_score"] >= calls["mean_score"]).all())
+        return calls
+
+    def test_starts_match_stream(self):
+        self.assert_matches_stream(None)
+
+    def test_params(self):
+        default = self.assert_matches_stream(None)
+        #a threshold only some of the calls reach
+        threshold = float(np.median(default["peak_score"]))
+        strict = self.assert_matches_stream({"threshold": threshold},
+                {"threshold": threshold})
+        self.assertLess(len(strict), len(default))
+        self.assertGreater(len(strict), 0)
+        self.assert_matches_stream({"step_size_divisor": 4},
+                step_size_divisor=4)
+
+    def test_structural_params_are_rejected(self):
+        for params in ({"smoothing_width": 5}, {"step_size": 128},
+                {"fft_window": [200, 475]}, {"no_such_setting": 1}):
+            self.assertRaises(Exception, pika2.detect, self.audio,
+                    params=params)
+
+    def test_ridge_scores_match_loop(self):
+        scores = np.random.RandomState(9).randn(500)
+        starts = np.array([0, 10, 57, 200, 499])
+        ends = np.array([4, 10, 120, 350, 499])
+        peaks, means = intervals.ridge_scores(scores, starts, ends)
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            self.assertEqual(peaks[i], scores[start:end + 1].max())
+            self.assertAlmostEqual(means[i], scores[start:end + 1].mean(),
+                    places=10)
+        peaks, means = intervals.ridge_scores(scores, [], [])
+        self.assertEqual((len(peaks), len(means)), (0, 0))
+
+
+class SpectrogramCacheTest(unittest.TestCase):
+    """The entry stored while a recording is parsed is what the later stages
+    read, with no spectrogram computed
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = spectrogram_cache.SpectrogramCache(self.directory)
+        self.audio = call_audio(40, [2.0, 9.9, 15.3, 29.95], seed=5).astype(
+                np.float32)
+        self.magnitude_spectrogram = stft.magnitude_spectrogram
+
+    def tearDown(self):
+        stft.magnitude_spectrogram = self.magnitude_spectrogram
+        shutil.rmtree(self.directory)
+
+    def no_spectrograms(self, *args, **kwargs):
+        raise AssertionError("spectrogram computed instead of read")
+
+    def test_parsing_stores_entry_for_later_stages(self):
+        expected = stream_calls(self.audio, 7)
+        segments, fft = processing.find_active_segments(None,
+                audio=self.audio, freq=44100)
+        self.assertIsNone(self.cache.lookup("recording", 4096, 2048,
+            [278, 553]))
+        self.assertEqual(stream_calls(self.audio, 7, cache=self.cache,
+            cache_key="recording"), expected)
+        entry = self.cache.lookup("recording", 4096, 2048, [278, 553])
+        self.assertTrue(np.allclose(entry, stft.magnitude_spectrogram(
+            self.audio, 4096, 2048, [278, 553]), rtol=0, atol=1e-9))
+
+        stft.magnitude_spectrogram = self.no_spectrograms
+        #preprocessing slices the frames of a chunk by frame offset
+        cached_segments, cached_fft = processing.find_active_segments(
+                "recording.mp3", audio=self.audio[20*44100:], freq=44100,
+                cache=self.cache, key="recording", offset=20)
+        first = spectrogram_cache.frame_range(20, 40, 2048)[0]
+        self.assertTrue(np.allclose(cached_fft.fft*np.amax(entry[first:]),
+            entry[first:], rtol=0, atol=1e-9))
+        cached_segments, cached_fft = processing.find_active_segments(
+                "recording.mp3", audio=self.audio, freq=44100,
+                cache=self.cache, key="recording")
+        self.assertTrue(np.array_equal(cached_segments, segments))
+        #parsing again and verification read it too
+        self.assertEqual(stream_calls(self.audio, 7, cache=self.cache,
+            cache_key="recording"), expected)
+        offset, length = expected[1]
+        call = collections.namedtuple("Call", ["recording", "offset",
+            "duration"])(collections.namedtuple("Recording",
+                ["content_hash"])("recording"), offset, length/44100.0)
+        parser = pika2.call_parser(call, self.audio[int(offset*44100):
+            int(offset*44100) + length], 44100, self.cache)
+        first, last = spectrogram_cache.frame_range(call.offset,
+                call.offset + call.duration, 2048)
+        self.assertEqual(len(parser.fft), last - first)
+
+
+class ParallelSegmentsTest(unittest.TestCase):
+    """parse_mp3 with workers against the serial StreamingParser, with the
+    decoding replaced by slices of an array
+    """
+    def setUp(self):
+        #calls straddling the 30 second segment boundaries
+        self.call_times = [5.0, 29.8, 30.16, 44.0, 59.95, 60.3, 89.9, 104.0]
+        self.audio = call_audio(110, self.call_times, seed=7).astype(
+                np.float32)
+        self.stream_pcm = pika2.p.stream_pcm
+        pika2.p.stream_pcm = self.fake_stream_pcm
+
+    def tearDown(self):
+        pika2.p.stream_pcm = self.stream_pcm
+
+    def fake_stream_pcm(self, filename, block_length=600,
+            output_frequency=44100, start=0, duration=None, n_buffers=2):
+        first = int(round(start*output_frequency))
+        last = len(self.audio)
+        if duration is not None:
+            last = min(first + int(round(duration*output_frequency)), last)
+        block_size = int(block_length*output_frequency)
+        for i in xrange(first, last, block_size):
+            yield (self.audio[i:min(i + block_size, last)],
+                    i*1.0/output_frequency)
+
+    def parse(self, **kwargs):
+        handler = call_handler.CallList()
+        pika2.parse_mp3("recording.mp3", handler, block_length=7, duration=110,
+                **kwargs)
+        return [(offset, len(audio)) for offset, audio in handler.calls]
+
+    def assert_same_calls(self, calls, expected):
+        """Same calls, the offsets of calls in later segments are computed
+        from the segment's start so they can differ by rounding
+        """
+        self.assertEqual(len(calls), len(expected))
+        for (offset, length), (expected_offset, expected_length) in zip(
+                calls, expected):
+            self.assertAlmostEqual(offset, expected_offset, places=6)
+            self.assertLessEqual(abs(length - expected_length), 1)
+
+    def test_segments_match_serial(self):
+        expected = self.parse()
+        self.assertGreaterEqual(len(expected), len(self.call_times))
+        self.assert_same_calls(self.parse(workers=1, segment_length=30),
+                expected)
+        self.assert_same_calls(self.parse(workers=1, segment_length=17,
+            prefetch=0), expected)
+
+
+class FakeFfplay(object):
+    """Stands in for the subprocess.Popen of ffplay, recording what is
+    written to it.  Like ffplay, it only exits at the end of stdin when
+    started with -autoexit.
+    """
+    def __init__(self, args, stdin=None):
+        self.args = args
+        self.written = []
+        self.closed = False
+        self.stdin = self
+
+    def write(self, data):
+        self.written.append(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def poll(self):
+        return None
+
+    def wait(self):
+        if not (self.closed and "-autoexit" in self.args):
+            raise AssertionError("ffplay would never exit")
+        return 0
+
+
+class PcmPlayerTest(unittest.TestCase):
+    def setUp(self):
+        self.processes = []
+        self.popen = utility.subprocess.Popen
+        utility.subprocess.Popen = self.fake_popen
+
+    def tearDown(self):
+        utility.subprocess.Popen = self.popen
+
+    def fake_popen(self, args, **kwargs):
+        self.processes.append(FakeFfplay(args, **kwargs))
+        return self.processes[-1]
+
+    def test_close_returns(self):
+        audio = np.full(100, .01, dtype=np.float32)
+        with utility.PcmPlayer(padding=.01) as player:
+            player.play(audio, 44100)
+            player.play(audio, 44100, vol_mult=40)
+            #a different frequency needs a new ffplay
+            player.play(audio, 8000)
+        self.assertEqual(len(self.processes), 2)
+        first, second = self.processes
+        self.assertTrue(first.closed and second.closed)
+        self.assertEqual(first.args[first.args.index("-ar") + 1], "44100")
+        self.assertEqual(second.args[second.args.index("-ar") + 1], "8000")
+        samples = np.frombuffer("".join(first.written), dtype=np.float32)
+        #both plays queued, each followed by the padding
+        self.assertEqual(len(samples), 2*(100 + 441))
+        self.assertTrue(np.allclose(samples[:100], .2))
+        self.assertTrue(np.allclose(samples[541:641], .4))
+        self.assertFalse(samples[100:541].any())
+
+
+if __name__ == "__main__":
+    unittest.main()
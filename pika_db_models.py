@@ -22,6 +22,7 @@ import sys
 import os
 import glob
 import numpy as np
+import processing
 
 def init_db():
     #db_filename = os.path.abspath('pika.db')
@@ -130,7 +131,12 @@ class Recording(SQLObject):
         lexicographically that way we get e.g. offset_37.0.wav before 
         offset_201.0.wav where as the order would be reversed in the 
         lexicographic sort.
+        The segment index written by preprocessing is used if there is one.
         """
+        segments = processing.read_segment_index(self.output_folder())
+        if segments is not None:
+            return np.array([filename for offset, duration, filename
+                in segments])
         wav_files = np.array(glob.glob(self.output_folder() + "offset_*.wav"))
         base_files = [os.path.basename(f) for f in wav_files]
         audio_offsets = np.array([float(f[7:f.find(".w")]) for f in base_files])
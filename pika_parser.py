@@ -4,6 +4,10 @@ import numpy as np
 import matplotlib.pyplot as plt
 import scikits.audiolab
 import processing as p
+import stft
+import pfft
+import clips
+import intervals
 import os
 
 
@@ -25,17 +29,38 @@ class PikaParser(object):
     """
     #*Constructor*#
     def __init__(self, recording, audio_file, database, debug=False,
-            mpd=None, ipd_filters=None):
+            mpd=None, ipd_filters=None, audio_dtype=np.float64):
         """Audio should be a single channel of raw audio data.
+        :audio_dtype: dtype the audio is loaded as, np.float32 halves the
+        memory used
         """
         self.recording = recording
-        self.full_audio = self.load_audio(audio_file)
+        self.audio_file = audio_file
+        self.audio_dtype = audio_dtype
         self.db = database
-        self.frequency = self.recording.bitrate
+        #the frequency the file was written at (e.g. resampled by
+        #processing.write_active_segments), recording.bitrate is the mp3's
+        #bit rate, not a sample frequency
+        self.frequency = clips.clip_frequency(audio_file)
         self.debug = debug
         self.fft_size = 4096
         self.step_size = self.fft_size/64
         self.factor = self.step_size*1.0/self.frequency
+        self.fft_window = [self.fft_size/32 + 150]
+        self.fft_window.append(self.fft_window[0] + 275)
+
+        #spectrogram written with the audio during preprocessing (see
+        #processing.write_active_segments), the audio is then only read for
+        #the calls found
+        self.preprocessed = None
+        if not clips.is_packed(audio_file):
+            self.preprocessed = pfft.load_matching_interval(audio_file,
+                    self.fft_window, self.fft_size, self.step_size,
+                    self.frequency)
+        if self.preprocessed is None:
+            self.full_audio = self.load_audio(audio_file)
+        else:
+            self.full_audio = None
 
         if mpd is None:
         #minimum peak distance for calculating harmonic frequencies
@@ -53,8 +78,19 @@ class PikaParser(object):
 
     #*Public Methods*#
     def identify_and_write_calls(self):
+        if self.preprocessed is not None:
+            for fft, offset in self.preprocessed_chunks():
+                frame_scores = self.score_fft(
+                        stft.filter_spectrogram(fft, threshold=.05))
+                good_intervals = self.find_passing_intervals(frame_scores)
+                self.write_calls(None, offset, good_intervals)
+            return
+        fft_buffer = None
         for chunk, offset in p.segment_audio(self.full_audio, self.frequency):
-            fft = self.filtered_fft(chunk)
+            if fft_buffer is None:
+                fft_buffer = stft.spectrogram_buffer(len(chunk), self.fft_size,
+                        self.step_size, self.fft_window)
+            fft = self.filtered_fft(chunk, out=fft_buffer)
             frame_scores = self.score_fft(fft)
             good_intervals = self.find_passing_intervals(frame_scores)
             self.write_calls(chunk, offset, good_intervals)
@@ -70,35 +106,41 @@ class PikaParser(object):
 
     #*Private Methods*#
     def load_audio(self, audio_file):
-        (audio, bitrate, nBits) = scikits.audiolab.wavread(audio_file)
-        if audio.ndim == 2:
-            #get left channel if a stereo file not needed for mono
-            audio = [v[0] for v in audio]
-        return audio
-
-    def filtered_fft(self, audio):
-        first_dim=np.ceil(1.0*(len(audio))/(self.step_size))
-        second_dim = 275
-        fft = np.zeros((first_dim, second_dim))
-        for i in xrange(0, len(audio), self.step_size):
-            f = np.absolute(np.fft.fft(audio[i:i+self.fft_size], self.fft_size))
-            f = f[self.fft_size/32:self.fft_size/2][150:425] #This will need
-                                        #to be changed if fft_size changes!
-            fft[i/self.step_size] = f
-
-        #normalize
-        max_val = np.amax(fft)
-        fft = fft/max_val
-
-        #noise-reduction
-        avg_fft = np.sum(fft, axis=0)/len(fft)
-        for i, frame in enumerate(fft):
-            fft[i] = [max(frame[j]-avg_fft[j], 0) for j, v in enumerate(frame)]
-
-        #filter out quiet parts
-        f_mean = np.mean(fft)
-        threshold = .05
-        return [[x if x > f_mean + threshold else 0.0 for x in f] for f in fft]
+        if clips.is_packed(audio_file):
+            return p.mono(clips.load_clip(audio_file)[0], self.audio_dtype)
+        #left channel if a stereo file, not needed for mono
+        return p.load_wav(audio_file, self.audio_dtype)[0]
+
+    def preprocessed_chunks(self, segment_length=10):
+        """iterator: like processing.segment_audio but over the frames of the
+        preprocessed spectrogram, yielding a copy of segment_length seconds
+        of frames (to be filtered in place) and their offset in seconds.
+
+        These are not the frames the audio path scores.  The preprocessed
+        frames run straight on across the chunk boundaries on one grid from
+        the start of the segment, while segment_audio chunks start every
+        segment_length*frequency samples (not a multiple of the step) with
+        their last frames zero padded.  So the chunks are normalized over
+        slightly different frames and their frames drift apart by part of a
+        step every chunk, and calls near the chunk boundaries or close to
+        the threshold can come out differently.
+        """
+        fft = self.preprocessed.fft
+        n_frames = stft.frame_count(int(segment_length*self.frequency),
+                self.step_size)
+        for start in xrange(0, len(fft), n_frames):
+            yield (self.preprocessed.frames(start, start + n_frames),
+                    start*self.factor)
+
+    def filtered_fft(self, audio, out=None):
+        """Returns the normalized, noise reduced spectrogram of audio as a 2d
+        numpy array.
+        :out: optional buffer from stft.spectrogram_buffer to write the
+        spectrogram into instead of allocating a new array
+        """
+        fft = stft.magnitude_spectrogram(audio, self.fft_size,
+                self.step_size, self.fft_window, out=out)
+        return stft.filter_spectrogram(fft, threshold=.05)
 
     def score_fft(self, fft):
         """Scores frames for how likely they seem to be part of a pika call
@@ -107,9 +149,10 @@ class PikaParser(object):
         :returns 1d array of likeliness scores corresponding to the frames
         """
         scores = []
+        all_locs, counts = peaks.detect_peaks_2d(fft, mpd=self.mpd)
         for i, frame in enumerate(fft):
             score = 0.0
-            locs = peaks.detect_peaks(frame, mpd=self.mpd)
+            locs = all_locs[i, :counts[i]]
             if self.debug:
                 if len(locs) != 0:
                     ipd = np.convolve(locs, [1, -1])
@@ -129,52 +172,44 @@ class PikaParser(object):
     def find_passing_intervals(self, frame_scores):
         """
         :frame_scores: pika call likelihood scores of fft frames.
-        :returns list of intervals that are likely to contain a pika call
+        :returns array of intervals that are likely to contain a pika call
         """
-        scores = np.convolve(frame_scores,
-                [.5, .5, .5, .5, .5, .5, .5, .5, .5, .5], mode='same')
-        ridges = []
-        current_ridge = None
-        threshold = 10.5
-        for i, s in enumerate(scores):
-            if current_ridge is not None:
-                if s < threshold:
-                    ridges.append([current_ridge, (i -1)*self.factor])
-                    current_ridge = None
-            else:
-                if s > threshold:
-                    current_ridge = i*self.factor
-        if current_ridge is not None:
-            ridges.append([current_ridge, len(scores)*self.factor])
-        min_ridge_length = .1
-        ridges[:] = [r for r in ridges if r[1] - r[0] > min_ridge_length]
-        return ridges
+        return intervals.passing_intervals(frame_scores, self.factor, 10,
+                threshold=10.5, min_length=.1)
 
     def write_calls(self, audio, offset, intervals):
         """
+        :audio: audio that the intervals are relative to, if None the calls
+        are read from self.audio_file
         :offset: offset of audio with respect to the original recording
         :intervals: list of intervals in seconds (e.g. [[2.4,2.71], [5.9,6.18]])
         where audio contains identified pika calls
 
-        Creates Call objects for each of the intervals and writes the call audio
-        as a wav file into a call subdirectory of the recording directory with
-        filename callN.wav where N is the call id in the database.
+        Creates Call objects for each of the intervals and appends the call
+        audio to the clips.ClipStore in the calls subdirectory of the
+        recording directory, the Call filename is the name of its clip.
         """
 
         output_path = self.recording.output_folder() + "calls/"
-        if not os.path.exists(output_path):
-            os.makedirs(output_path)
-
-        for interval in intervals:
-            c_offset = float(offset + interval[0])
-            c_duration = float(interval[1] - interval[0])
-            c = self.db.Call(recording=self.recording, offset=c_offset,
-                    duration=c_duration, filename="temp")
-            c.filename = output_path + "call{}.wav".format(c.id)
-            scikits.audiolab.wavwrite( np.asarray(audio[
-                        int(interval[0]*self.frequency)
-                        :int(interval[1]*self.frequency)
-                        ]), c.filename, self.frequency)
+        with clips.ClipStore(output_path + "clips", self.frequency) as store:
+            for interval in intervals:
+                c_offset = float(offset + interval[0])
+                c_duration = float(interval[1] - interval[0])
+                c_filename = store.append(c_offset,
+                        self.call_audio(audio, offset, interval))
+                self.db.Call(recording=self.recording, offset=c_offset,
+                        duration=c_duration, filename=c_filename)
+
+    def call_audio(self, audio, offset, interval):
+        """Audio of the call at interval (in seconds) relative to audio, which
+        starts offset seconds into self.audio_file.  If audio is None only
+        the call is read from self.audio_file.
+        """
+        if audio is None:
+            return p.read_wav_interval(self.audio_file, offset + interval[0],
+                    offset + interval[1], self.audio_dtype)
+        return np.asarray(audio[int(interval[0]*self.frequency)
+                :int(interval[1]*self.frequency)])
 
     def spectrogram(self, fft, label=None):
         plt.imshow(np.asarray([f for f in fft]).T,
@@ -81,6 +81,9 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        #seconds to wait for another process' write lock (e.g. other
+        #process_worker commands) before failing with "database is locked"
+        'OPTIONS': {'timeout': 30},
     }
 }
 
@@ -1,7 +1,11 @@
 import pika2 as p
 import call_handler as ch
+import clips
+import spectrogram_cache
 import sys
 import os
+import errno
+import argparse
 import scikits.audiolab
 import numpy as np
 
@@ -16,9 +20,29 @@ if __name__== '__main__':
     from django.core.wsgi import get_wsgi_application
     application = get_wsgi_application()
 
-from pika_app.models import Recording, Call
+from pika_app.models import Recording, Call, SegmentCheckpoint
+from django.db import transaction
 
 def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description="Identifies the calls in unprocessed recordings")
+    parser.add_argument("--workers", type=int, default=1,
+            help="number of processes to parse the segments of each " \
+                    "recording with (default: 1, parse in this process)")
+    parser.add_argument("--segment-length", type=float, default=300,
+            help="length in seconds of the checkpointed segments")
+    parser.add_argument("--lazy-clips", action="store_true",
+            help="only save the call times, the call audio is decoded " \
+                    "from the recording when needed")
+    parser.add_argument("--spectrogram-cache", action="store_true",
+            help="store the recordings' spectrograms in the spectrogram " \
+                    "cache (see spectrogram_cache) for verification")
+    args = parser.parse_args(argv)
+    cache = None
+    if args.spectrogram_cache:
+        cache = spectrogram_cache.default_cache()
+    parameters = p.parameter_key(args.segment_length)
+
     recordings = Recording.objects.filter(processed=False)
     #TODO before processing, have interface which states number of files
     #to be processed and total length of recordings (and maybe estimate
@@ -26,18 +50,70 @@ def main(argv=None):
     print "Will be processing {} recordings".format(len(recordings))
 
     for recording in recordings:
-        recording.sample_frequency = 44100 #FIXME Need to automatically
-        #update when creating the recording object
-        handler = ToDB(recording, recording.sample_frequency)
-        #handler = ch.CallCounter()
-        p.parse_mp3(recording.filename, handler)
-        recording.processed = True
+        process_recording(recording, parameters, workers=args.workers,
+                segment_length=args.segment_length, lazy=args.lazy_clips,
+                cache=cache)
+
+def process_recording(recording, parameters, workers=1, segment_length=300,
+        lazy=False, lease=None, store_name="clips", cache=None):
+    """Identifies the calls in recording, saves them to the database and
+    marks the recording processed.  Segments completed by an earlier
+    (interrupted) run with the same parameters are skipped.
+    :parameters: key of the parser settings (see pika2.parameter_key)
+    :lease, store_name: passed to ToDB
+    :cache: spectrogram_cache.SpectrogramCache the recording's spectrogram is
+    read from or stored in (see pika2.parse_mp3)
+    """
+    if recording.content_hash is None:
+        #recordings added before the metadata was probed at ingest
         recording.save()
+    #calls are decoded at the parsers' frequency whatever the recording's
+    #sample frequency is (see processing.stream_pcm)
+    handler = ToDB(recording, 44100, parameters, lazy=lazy, lease=lease,
+            store_name=store_name)
+    #handler = ch.CallCounter()
+    p.parse_mp3(recording.filename, handler, workers=workers,
+            segment_length=segment_length, duration=recording.duration,
+            cache=cache, cache_key=recording.content_hash)
+    recording.processed = True
+    recording.save()
+
+def remove_files(filenames):
+    """Deletes the files that still exist"""
+    for filename in filenames:
+        if os.path.exists(filename):
+            os.remove(filename)
 
 class ToDB(ch.CallHandler):
-    def __init__(self, recording, frequency):
+    """Saves calls to the database, buffering them so that each segment's
+    calls are inserted with one bulk_create in a single transaction (together
+    with its checkpoint).  Without segments the calls are saved on exit.
+    The call audio is appended to the recording's clips.ClipStore and the
+    Call filename is the clip name, so the rows are complete before they
+    have ids.
+    """
+    def __init__(self, recording, frequency, parameters=None, lazy=False,
+            lease=None, store_name="clips"):
+        """
+        :parameters: key of the parser settings (pika2.parameter_key) the
+        segment checkpoints are recorded with
+        :lazy: if True no audio is saved, the Call filenames are None and
+        clips.load_call decodes the calls from the recording
+        :lease: object whose held() method returns False once this process
+        no longer holds the recording (e.g. process_worker.Heartbeat),
+        nothing is written after that
+        :store_name: name of the ClipStore in the recording's calls folder.
+        Workers that may lose their lease use one per claim, so audio still
+        buffered when the lease is lost can't land in the store of the
+        worker that reclaimed the recording (migrate_clips.py --compact
+        merges them)
+        """
         self.recording = recording
         self.frequency = frequency
+        self.parameters = parameters
+        self.lazy = lazy
+        self.lease = lease
+        self.calls = []
         
         self.output_path = os.path.join(self.recording.output_folder(),
                 "calls{}".format(os.sep))
@@ -47,26 +123,91 @@ class ToDB(ch.CallHandler):
             except OSError as exc: # Guard against race condition
                 if exc.errno != errno.EEXIST:
                     raise
+        self.store = None
+        if not self.lazy:
+            self.store = clips.ClipStore(self.output_path + store_name,
+                    self.frequency)
             
     
     def handle_call(self, offset, audio):
         #print "{}, {}".format(len(audio), self.frequency)
         duration = len(audio)*1.0/self.frequency
-        call = Call(recording=self.recording, offset=offset,
-                duration = duration, filename="temp")
-        call.save()
-
-        call.filename = self.output_path + "call{}.wav".format(call.id)
-        call.save()
-        scikits.audiolab.wavwrite(np.asarray(audio), call.filename,
-                self.frequency)
+        self.check_lease()
+        filename = None
+        if self.store is not None:
+            filename = self.store.append(offset, audio)
+        self.calls.append(Call(recording=self.recording, offset=offset,
+                duration=duration, filename=filename))
     
+    def segment_done(self, offset, length):
+        return SegmentCheckpoint.objects.filter(recording=self.recording,
+                offset=offset, length=length,
+                parameters=self.parameters).exists()
+
+    def start_segment(self, offset, length):
+        self.check_lease()
+        self.calls = []
+
+    def segment_complete(self, offset, length):
+        """Replaces any calls saved for the segment earlier (e.g. by an
+        interrupted run or with other parameters) with the buffered calls
+        and checkpoints the segment, all in one transaction.  Reviewed calls
+        (verified set) are kept along with their audio, and buffered calls
+        overlapping them are dropped so the review isn't repeated.
+        """
+        self.check_lease()
+        with transaction.atomic():
+            old_calls = Call.objects.filter(recording=self.recording,
+                offset__gte=offset, offset__lt=offset + length)
+            reviewed = [(call.offset, call.offset + call.duration) for call in
+                    old_calls.filter(verified__isnull=False)]
+            self.calls = [call for call in self.calls if not any(
+                call.offset < end and call.offset + call.duration > start
+                for start, end in reviewed)]
+            self.flush(old_calls.filter(verified__isnull=True))
+            SegmentCheckpoint.objects.create(recording=self.recording,
+                    offset=offset, length=length, parameters=self.parameters)
+
+    def flush(self, old_calls=None):
+        """Bulk inserts the buffered calls, deleting old_calls (a queryset)
+        first along with any wav files they had.  The wav files are only
+        removed once the transaction commits, so a rollback never leaves rows
+        pointing at missing files.  Old packed clips stay in the store,
+        unreferenced, until migrate_clips.py compacts it.
+        """
+        #the clips must be on disk before rows refer to them
+        if self.store is not None:
+            self.store.flush()
+        if old_calls is not None:
+            wav_files = [call.filename for call in old_calls
+                    if call.filename and not clips.is_packed(call.filename)]
+            old_calls.delete()
+            transaction.on_commit(lambda: remove_files(wav_files))
+        Call.objects.bulk_create(self.calls)
+        self.calls = []
+
+    def check_lease(self):
+        """Raises an exception, stopping the parse, if the lease was lost"""
+        if self.lease is not None and not self.lease.held():
+            raise Exception("process_records.ToDB: lease on {} lost, " \
+                    "another worker may be processing it".format(
+                        self.recording))
+
     def __enter__(self):
+        self.calls = []
         return self
 
     def __exit__(self, exception_type, exception_val, trace):
+        #calls outside of segments (parse_mp3 without workers)
+        try:
+            if exception_type is None and len(self.calls):
+                self.check_lease()
+                with transaction.atomic():
+                    self.flush()
+        finally:
+            if self.store is not None:
+                self.store.close()
         return
 
 
-
 if __name__ == "__main__": main()    
@@ -7,28 +7,41 @@ import time
 import os
 import glob
 import subprocess
+import io
+import itertools
+import threading
+import Queue
+import sys
 import mutagen.mp3
+import intervals
+import hashlib
+import pfft
 
 
-def segment_mp3(filename, segment_length=300, output_frequency=44100):
+def segment_mp3(filename, segment_length=300, output_frequency=44100,
+        metadata=None):
     """
     Parses mp3 into .wav files and yields audio and offset of the segments to be iterated over 
     :filename: path of mp3 to returns segments of
     :segment_length: in seconds the length of the segments (last segment will
     probably be less than segment_length
+    :metadata: dict with the duration and sample_frequency of filename (e.g.
+    from probe or the fields of its Recording), probed if not given
     """
     offset = 0
     step_size = int(segment_length) #in seconds
     outfile = "temp.wav"
-    info = mutagen.mp3.MP3(filename).info
-    if output_frequency is not None and info.sample_rate != output_frequency:
+    if metadata is None:
+        metadata = probe(filename, content_hash=False)
+    if (output_frequency is not None and
+            metadata["sample_frequency"] != output_frequency):
         resample = True
     else:
         resample = False
 
-    while offset < info.length:
+    while offset < metadata["duration"]:
         next_offset = offset + step_size
-        end = min(int(info.length), next_offset)
+        end = min(int(metadata["duration"]), next_offset)
         length = end - offset
         try:
             if resample:
@@ -45,7 +58,170 @@ def segment_mp3(filename, segment_length=300, output_frequency=44100):
         offset = next_offset
 
 
-def write_active_segments(filename, path, offset, frequency=44100):
+def stream_pcm(filename, block_length=600, output_frequency=44100, start=0,
+        duration=None, n_buffers=2):
+    """iterator: decodes filename with a single ffmpeg process, reading mono
+    float32 pcm (the left channel) from its stdout pipe block_length seconds at
+    a time.  Yields (block, offset) where offset is the position of block in
+    filename in seconds.  Nothing is written to disk.
+
+    The blocks are views of n_buffers preallocated arrays that are reused in
+    turn, so a block is overwritten n_buffers - 1 blocks later.  Copy any
+    audio that needs to be kept longer than that.
+    :filename: path of audio file (anything ffmpeg can decode, e.g. mp3)
+    :block_length: length of the blocks in seconds (the last block will
+    probably be shorter)
+    :output_frequency: sample frequency to decode at, ffmpeg resamples if the
+    file has a different frequency
+    :start: position in seconds to start decoding from
+    :duration: number of seconds to decode, defaults to the rest of the file
+    """
+    command = ["ffmpeg", "-loglevel", "0"]
+    if start:
+        command += ["-ss", str(start)]
+    command += ["-channel_layout", "stereo", "-i", filename,
+            "-af", "pan=mono|c0=c0", "-ar", str(output_frequency)]
+    if duration is not None:
+        command += ["-t", str(duration)]
+    command += ["-f", "f32le", "-acodec", "pcm_f32le", "pipe:1"]
+
+    block_size = int(block_length*output_frequency)
+    buffers = [np.empty(block_size, dtype=np.float32) for i in range(n_buffers)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    stream = io.open(process.stdout.fileno(), "rb", closefd=False)
+    finished = False
+    try:
+        offset = start
+        for i in itertools.count():
+            block = buffers[i % n_buffers]
+            n_samples = read_samples(stream, block)
+            if n_samples == 0:
+                break
+            yield block[:n_samples], offset
+            offset += n_samples*1.0/output_frequency
+            if n_samples < block_size:
+                break
+        finished = True
+    finally:
+        process.stdout.close()
+        if not finished and process.poll() is None:
+            process.kill()
+        process.wait()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+def audio_length(filename):
+    """Length of the mp3 file filename in seconds"""
+    return mutagen.mp3.MP3(filename).info.length
+
+def probe(filename, content_hash=True):
+    """Reads the metadata of the mp3 file filename, for storing with its
+    recording so it doesn't need to be read again.
+    :content_hash: if False the (slower) hash of the file is left out
+    :returns dict of duration (seconds), sample_frequency, channels, bitrate
+    (bits per second) and content_hash (sha1 hex digest of the file)
+    """
+    info = mutagen.mp3.MP3(filename).info
+    metadata = {"duration": info.length, "sample_frequency": info.sample_rate,
+            "channels": info.channels, "bitrate": info.bitrate}
+    if content_hash:
+        metadata["content_hash"] = file_hash(filename)
+    return metadata
+
+def file_hash(filename, block_size=2**20):
+    """sha1 hex digest of the contents of filename, read block_size bytes at
+    a time
+    """
+    digest = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def prefetch(iterable, depth=2):
+    """iterator: the items of iterable, produced by a background thread that
+    stays up to depth items ahead of the consumer, so e.g. decoding the next
+    blocks of stream_pcm overlaps with processing the current one.  At most
+    depth items wait in the queue, so memory stays bounded.  Exceptions in
+    the thread are raised in the consumer.
+
+    With stream_pcm the producer can be depth + 1 blocks ahead of the block
+    being processed, so give stream_pcm n_buffers=depth + 2 (see
+    prefetch_buffers) or copy the blocks.
+    """
+    if depth < 1:
+        for item in iterable:
+            yield item
+        return
+    queue = Queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    #marks the end of the items, or wraps an exception from the producer
+    end = object()
+
+    def put(item):
+        """Waits for room in the queue, gives up if the consumer stopped"""
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((None, item)):
+                    break
+        except Exception:
+            put((end, sys.exc_info()))
+        else:
+            put((end, None))
+        finally:
+            #closes e.g. the ffmpeg process of stream_pcm if the consumer
+            #stopped early
+            close = getattr(iterable, "close", None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            marker, item = queue.get()
+            if marker is end:
+                if item is not None:
+                    raise item[0], item[1], item[2]
+                break
+            yield item
+    finally:
+        stopped.set()
+        thread.join()
+
+def prefetch_buffers(depth):
+    """n_buffers stream_pcm needs for its blocks to stay valid while they are
+    processed behind prefetch(..., depth)
+    """
+    return depth + 2
+
+def read_samples(stream, block):
+    """Fills block (a numpy array) with data read from stream, stopping early
+    only at the end of the stream.
+    :returns number of samples read
+    """
+    raw = memoryview(block.view(np.uint8))
+    filled = 0
+    while filled < len(raw):
+        n_bytes = stream.readinto(raw[filled:])
+        if not n_bytes:
+            break
+        filled += n_bytes
+    return filled//block.itemsize
+
+def write_active_segments(filename, path, offset, frequency=44100, audio=None,
+        fft_size=4096, step_size=64, fft_dtype=np.float32, cache=None,
+        key=None):
     """
     Processes audio file to find parts of the file that are active - i.e. the parts that aren't 
     just background noise.  Outputs files to path folder with file named offset_{}.wav where the
@@ -61,37 +237,153 @@ def write_active_segments(filename, path, offset, frequency=44100):
     since frequency effects the frequencies in the fft it might be better to default to a fixed
     rate.  I chose 44100 here because that is a common sample frequency and I suspect that we
     will mostly be using recordings at that sample frequency or higher.
+    :audio: if given, the already decoded audio (at frequency) to find the
+    active segments of, e.g. a block from stream_pcm.  Otherwise filename
+    is decoded (and resampled to frequency) once with decode_audio.  Either
+    way the segments are sliced from the decoded audio, there is no ffmpeg
+    call per segment.
+    :fft_size, step_size: the spectrogram of each segment is written next
+    to its wav file (offset_{}.npy and offset_{}.json, see pfft) at this
+    resolution so that the parser can load it instead of computing it.  The
+    defaults match PikaParser.
+    :fft_dtype: dtype the spectrograms are stored as (see
+    pfft.ProcessedFFT.serialize_interval).  np.uint8 is a quarter the size
+    of the float32 default but is quantised to each interval's max, so a
+    loud transient can cost quiet calls.  The parser scores the stored
+    frames instead of the audio and they are chunked differently (see
+    PikaParser.preprocessed_chunks), so even at float32 the calls found can
+    differ slightly from those found from the wav
+    :cache, key: passed to find_active_segments
+    :returns list of (offset, duration, wav filename) of the segments written,
+    for write_segment_index
     """
-    intervals, fft = find_active_segments(filename)
+    if audio is None:
+        audio = decode_audio(filename, frequency)
+    intervals, fft = find_active_segments(filename, audio=audio, freq=frequency,
+            cache=cache, key=key, offset=offset)
     if len(intervals) == 0:
         print "No active segments found in {}".format(filename)
-        return
+        return []
+    segments = []
     for i, interval in enumerate(intervals):
         print "i: {}, interval: {}".format(i, interval)
         outfile = path + "offset_{}.wav".format(offset + interval[0])
-        pkl_outfile = path + "offset_{}.pkl".format(offset + interval[0])
         try:
-            fft.serialize_interval(interval[0], interval[1], pkl_outfile)
-            with open(os.devnull, 'w') as f:
-                subprocess.check_call(["ffmpeg", "-loglevel", "0", '-channel_layout', 'stereo', "-i", filename,
-                    "-ar", str(frequency), "-ss", str(interval[0]), "-t", str(interval[1]-interval[0]), outfile])
+            segment = audio[int(interval[0]*frequency):
+                int(interval[1]*frequency)]
+            scikits.audiolab.wavwrite(segment, outfile, frequency)
+            segment_fft = pfft.ProcessedFFT(segment, fft.fft_window,
+                    fft_size, step_size, frequency,
+                    offset=offset + interval[0])
+            segment_fft.process_fft(normalize=False)
+            segment_fft.serialize_interval(0, len(segment)*1.0/frequency,
+                    outfile, dtype=fft_dtype)
+            segments.append((offset + interval[0],
+                len(segment)*1.0/frequency, outfile))
         except Exception as inst:
             print "There was an exception writing temp file {} in write_active_segments:".format(outfile)
             print type(inst)
             print inst.args
             print inst
+    return segments
+
+def segment_index_filename(path):
+    """Name of the index of the active segments written to the folder path"""
+    return path + "segments.csv"
+
+def write_segment_index(path, segments):
+    """Writes the index of the active segments in the folder path.
+    :segments: (offset, duration, wav filename) of each segment, as returned
+    by write_active_segments
+    """
+    with open(segment_index_filename(path), "w") as f:
+        f.write("offset,duration,filename\n")
+        for offset, duration, filename in sorted(segments):
+            f.write("{},{:.6f},{}\n".format(offset, duration,
+                os.path.basename(filename)))
+
+def read_segment_index(path):
+    """:returns list of (offset, duration, wav filename) of the active
+    segments in the folder path, in offset order, or None if there is no
+    index
+    """
+    if not os.path.exists(segment_index_filename(path)):
+        return None
+    segments = []
+    with open(segment_index_filename(path)) as f:
+        f.readline()
+        for line in f:
+            offset, duration, filename = line.rstrip("\n").split(",", 2)
+            segments.append((float(offset), float(duration),
+                os.path.join(path, filename)))
+    return segments
 
-def load_wav(filename):
-    (snd, freq, nbits) = scikits.audiolab.wavread(filename)
-    if snd.ndim == 2:
-        snd = [v[0] for v in snd]
-    return snd, freq
+def decode_audio(filename, frequency=44100):
+    """Decodes the whole of filename (the left channel), resampled to
+    frequency, with one ffmpeg process.
+    :returns 1d float32 array
+    """
+    blocks = [np.array(block) for block, offset in
+            stream_pcm(filename, 60, frequency, n_buffers=1)]
+    return np.concatenate(blocks + [np.zeros(0, dtype=np.float32)])
+
+def mono(audio, dtype=None, channel=0):
+    """Returns channel of audio (if it has more than one) as a contiguous 1d
+    numpy array, only copying if the channel isn't already contiguous or
+    has a different dtype.
+    :dtype: dtype to return, defaults to the dtype of audio
+    """
+    audio = np.asarray(audio)
+    if audio.ndim == 2:
+        audio = audio[:, channel]
+    return np.ascontiguousarray(audio, dtype=dtype)
+
+def load_wav(filename, dtype=np.float64):
+    """Reads the wav file filename straight into an array of dtype (e.g.
+    np.float32 for half the memory).
+    :returns (audio, frequency) where audio is the left channel
+    """
+    f = scikits.audiolab.Sndfile(filename, 'r')
+    try:
+        snd = f.read_frames(f.nframes, dtype=dtype)
+        freq = f.samplerate
+    finally:
+        f.close()
+    return mono(snd), freq
+
+def wav_frequency(filename):
+    """Sample frequency of the wav file filename, read from its header"""
+    f = scikits.audiolab.Sndfile(filename, 'r')
+    try:
+        return f.samplerate
+    finally:
+        f.close()
     
-def find_active_segments(filename, verbose=0, fft=None, audio=None, freq=None):
+def read_wav_interval(filename, start, end, dtype=np.float64):
+    """Reads only the samples from start to end seconds of the wav file
+    filename (the left channel if it is stereo).
+    """
+    f = scikits.audiolab.Sndfile(filename, 'r')
+    try:
+        first = int(start*f.samplerate)
+        last = min(int(end*f.samplerate), f.nframes)
+        f.seek(first)
+        audio = f.read_frames(max(last - first, 0), dtype=dtype)
+    finally:
+        f.close()
+    return mono(audio)
+
+def find_active_segments(filename, verbose=0, fft=None, audio=None, freq=None,
+        cache=None, key=None, offset=0):
     """Returns array of intervals of audio that have magnitude above a threshold
     background noise.  If a segment of the audio is more than .5 seconds from
     a sound over the threshold it will not be included in the output
     :filename: audio file to be used - should be wav file
+    :cache, key: spectrogram_cache.SpectrogramCache and the content hash of
+    filename (the recording audio is part of), if given the frames are
+    sliced from the recording's entry (stored first if needed), so they
+    start on its grid up to a step before audio does
+    :offset: position of audio in filename in seconds, for the cache
     :returns: array of intervals e.g. [[5, 157], [990, 1105]] of time in seconds
     (floor of start value, ceiling of end value) corresponding to louder sections
     of the audio, as well as the windowed, filtered fft used to find the 
@@ -113,7 +405,11 @@ def find_active_segments(filename, verbose=0, fft=None, audio=None, freq=None):
     
     if fft is None:
         fft = pfft.ProcessedFFT(snd, window, fft_size, step_size, freq)
-        fft.process_fft()
+        frames = None
+        if cache is not None and key is not None:
+            frames, start = cache.frames(filename, key, fft_size, step_size,
+                    window, offset, offset + len(snd)*1.0/freq)
+        fft.process_fft(frames=frames)
 
     threshold_distance = 10 #.5*freq/step_size #seconds worth of steps
     factor = step_size*1.0/freq
@@ -143,50 +439,21 @@ def get_intervals(segments, factor):
     some value derived from the fft of audio data.
     :factor: value to convert between position in the segments list and
     position in the audio file in seconds.
-    :returns list of intervals (with endpoints rounded to integer values)
+    :returns array of intervals (with endpoints rounded to integer values)
     corresponding to the times in the audio file where the values in segments 
     are non-zero.  Before being returned calls reduce_intervals to combine
     segments with overlap that result from the rounding of the endpoints.
     """
-    intervals = []
-    interval_start = None
-    for i, val in enumerate(segments):
-        if interval_start is None:
-            if val > 0:
-                interval_start = int(np.floor(i*factor))
-        elif val == 0:
-            intervals.append([interval_start, int(np.ceil(i*factor))])
-            interval_start = None
-    if interval_start is not None:
-        intervals.append([interval_start, int(np.ceil(factor*len(segments)))])
-    #print intervals
-    return reduce_intervals(intervals)
+    return reduce_intervals(intervals.nonzero_intervals(segments, factor))
     
-def reduce_intervals(intervals):
+def reduce_intervals(interval_list):
     """
-    :intervals: a list of intervals that may have overlapping endpoints but
+    :interval_list: a list of intervals that may have overlapping endpoints but
     where if [a, b] occurs before [c, d] in the list then a <= c.
-    :returns list of intervals with overlaps combined so that now if
-    [a, b] occurs before [c, d] in the returned list, then b < c.
+    :returns array of intervals with overlaps combined so that now if
+    [a, b] occurs before [c, d] in the returned array, then b < c.
     """
-    reduced_intervals = []
-    interval_start = None
-    for s in intervals:
-        if interval_start is not None:
-            if s[0] <= interval_end:
-                #print "Overlap old {}, new {}".format(current_segment_end, s)
-                interval_end = s[1]
-            else:
-                #print "NO overlap old {}, new {}".format(current_segment_end, s)
-                reduced_intervals.append([interval_start, interval_end])
-                interval_start = s[0]
-                interval_end = s[1]
-        else:
-            interval_start = s[0]
-            interval_end = s[1]
-    if interval_start is not None:
-        reduced_intervals.append([interval_start, intervals[-1][1]])
-    return reduced_intervals
+    return intervals.merge_intervals(interval_list)
 
 def segment_audio(audio, freq, segment_length=10):
     """iterator: iterates through audio segment_length seconds at a time
@@ -197,6 +464,8 @@ def segment_audio(audio, freq, segment_length=10):
     an existing (unloaded) audio file, writes chunks of that audio to a
     temporary file and yields that temporary file and the offset (in seconds)
     of it within the original file.
+    :audio: anything with a length that can be sliced, e.g. an array or a
+    wav_memmap.WavAudio (then only one segment is in memory at a time)
     """
     offset = 0
     step_size = int(segment_length*freq) #in samples
@@ -237,8 +506,12 @@ def chunk_recording(recording, segment_length=300, output_frequency=44100):
     offset = 0
     step_size = int(segment_length) #in seconds
     outfile = "temp/temp.wav"
-    info = mutagen.mp3.MP3(recording.filename).info
-    if output_frequency is not None and info.sample_rate != output_frequency:
+    #the Django Recording stores the sample frequency when it is probed
+    sample_frequency = getattr(recording, "sample_frequency", None)
+    if sample_frequency is None:
+        sample_frequency = probe(recording.filename,
+                content_hash=False)["sample_frequency"]
+    if output_frequency is not None and sample_frequency != output_frequency:
         resample = True
     else:
         resample = False
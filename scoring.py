@@ -0,0 +1,116 @@
+"""
+Array based frame scoring for Parser.score_fft.
+
+Frames are scored from their harmonic peak locations (see
+find_peaks.detect_peaks_2d).  The ipd and base peak filters are turned into
+boolean lookup tables once, so scoring a whole spectrogram is a handful of
+array operations instead of a python loop over frames and filters.
+"""
+import numpy as np
+
+
+def filter_table(filters, size):
+    """Boolean lookup table for a list of [bottom, top] filter ranges.
+    :filters: list of inclusive ranges, e.g. [[45, 93], [110, 165]]
+    :size: length of the table, should be more than the largest value looked
+    up (the number of fft bins in the window is always enough)
+    :returns array where table[d] is True if bottom <= d <= top for any of the
+    filters
+    """
+    values = np.arange(size)
+    table = np.zeros(size, dtype=bool)
+    for bot, top in filters:
+        table |= (values >= bot) & (values <= top)
+    return table
+
+def score_frames(locs, counts, ipd_table, base_table, with_negative=False,
+        max_base_peak=120, min_base_peak=-1, weight=5.0):
+    """Scores frames for how likely they seem to be part of a pika call.
+    Gives the same scores as the per frame loop in Parser.score_fft (up to
+    floating point rounding, the loop accumulates the score one peak at a
+    time).
+    :locs: -1 padded peak locations, one row per frame (from
+    find_peaks.detect_peaks_2d)
+    :counts: number of peaks in each row of locs
+    :ipd_table: filter_table of the inter peak distance filters
+    :base_table: filter_table of the base peak filter
+    :with_negative: if True inter peak distances that fail every filter lower
+    the score
+    :max_base_peak: frames whose first peak is not below this bin score -1
+    :min_base_peak: frames whose first peak is not above this bin score -1,
+    the default -1 doesn't exclude any
+    :weight: total score shared out between the peaks of a frame
+    :returns 1d array of likeliness scores corresponding to the frames
+    """
+    locs = np.asarray(locs)
+    counts = np.asarray(counts)
+    if locs.shape[1] < 3:
+        return np.full(len(locs), -1.0)
+    first = locs[:, 0]
+    candidate = ((counts >= 3) & (first < max_base_peak) &
+            (first > min_base_peak))
+    amount = weight/np.maximum(counts - 2, 1)
+
+    base_hit = base_table[np.clip(first, 0, len(base_table) - 1)]
+    scores = np.where(base_hit, amount, -amount/2)
+
+    ipd = np.diff(locs, axis=1)
+    in_frame = np.arange(ipd.shape[1]) < (counts - 1)[:, None]
+    hits = ipd_table[np.clip(ipd, 0, len(ipd_table) - 1)] & in_frame
+    n_hits = hits.sum(axis=1)
+    scores += amount*n_hits
+    if with_negative:
+        scores -= amount/2*(counts - 1 - n_hits)
+    return np.where(candidate, scores, -1.0)
+
+def score_frames_sweep(locs, counts, ipd_tables, base_tables,
+        with_negative=False, max_base_peaks=120, min_base_peaks=-1,
+        weight=5.0, block_frames=4096):
+    """Scores frames with many filter settings in one pass, e.g. for tuning
+    the filters to a site.  Column c of the result is what score_frames
+    returns with the c'th settings.  The inter peak distances of each frame
+    are counted into a histogram, so the ipd hits of every setting are one
+    matrix product with the stacked filter tables.
+    :ipd_tables: 2d array with one ipd filter_table per setting
+    :base_tables: 2d array with one base peak filter_table per setting
+    :with_negative: a bool or one bool per setting
+    :max_base_peaks: a bin or one bin per setting
+    :min_base_peaks: a bin or one bin per setting
+    :block_frames: frames whose histograms are built at a time, bounds the
+    memory used
+    :returns 2d array of scores, one row per frame and one column per setting
+    """
+    locs = np.asarray(locs)
+    counts = np.asarray(counts)
+    ipd_tables = np.asarray(ipd_tables, dtype=bool)
+    base_tables = np.asarray(base_tables, dtype=bool)
+    n_settings = len(ipd_tables)
+    with_negative = np.broadcast_to(with_negative, (n_settings,))
+    max_base_peaks = np.broadcast_to(max_base_peaks, (n_settings,))
+    min_base_peaks = np.broadcast_to(min_base_peaks, (n_settings,))
+    if locs.ndim < 2 or locs.shape[1] < 3:
+        return np.full((len(locs), n_settings), -1.0)
+    first = locs[:, 0]
+    candidate = ((counts >= 3)[:, None] & (first[:, None] < max_base_peaks) &
+            (first[:, None] > min_base_peaks))
+    amount = (weight/np.maximum(counts - 2, 1))[:, None]
+
+    base_hit = base_tables[:, np.clip(first, 0,
+        base_tables.shape[1] - 1)].T
+    scores = np.where(base_hit, amount, -amount/2)
+
+    size = ipd_tables.shape[1]
+    tables = ipd_tables.T.astype(np.float64)
+    ipd = np.clip(np.diff(locs, axis=1), 0, size - 1)
+    in_frame = np.arange(ipd.shape[1]) < (counts - 1)[:, None]
+    n_hits = np.empty((len(locs), n_settings))
+    for start in xrange(0, len(locs), block_frames):
+        end = min(start + block_frames, len(locs))
+        rows, columns = np.nonzero(in_frame[start:end])
+        histogram = np.bincount(rows*size + ipd[start:end][rows, columns],
+                minlength=(end - start)*size).reshape(end - start, size)
+        n_hits[start:end] = histogram.dot(tables)
+    scores += amount*n_hits
+    misses = (counts - 1)[:, None] - n_hits
+    scores -= np.where(with_negative, amount/2*misses, 0)
+    return np.where(candidate, scores, -1.0)
@@ -0,0 +1,277 @@
+"""
+On disk cache of the magnitude spectrograms of whole recordings (see
+stft.magnitude_spectrogram), shared by the processing stages.
+
+An entry holds the frames of one recording decoded at 44100 (by
+processing.stream_pcm) on a fixed grid: frame i starts at sample
+i*step_size of the recording and the frames running past its end are zero
+padded, exactly as stft.magnitude_spectrogram returns them for the whole
+recording.  Entries are keyed on the recording's content hash
+(Recording.content_hash, see processing.file_hash) and the fft parameters
+(fft_size, step_size, fft_window, dtype), so a stage that needs frames of a
+recording slices them from the entry by frame offset (see frame_range)
+whatever block, segment or clip of the recording it is looking at:
+
+    pika2.StreamingParser  computes the entry while it parses a whole
+                           recording (or reads it if already there)
+    processing.write_active_segments  slices each decoded chunk's frames for
+                           find_active_segments
+    verification.VerificationSession  slices the frames of each call if
+                           the recording's entry is there
+
+The detection parameters (pika2.StreamingParser's, step_size of 2048) are
+what those stages share, at about a byte per sample of audio.
+
+The frames are stored raw (no .npy header, the number of frames follows
+from the file size) since a stage streaming a recording doesn't know how
+many frames there will be.  They are written to a temporary file and moved
+into place once complete, so other processes never see part of an entry,
+and read back as read only memory maps so taking a slice only reads those
+frames from disk.  The cache is bounded in size, when it grows past
+max_bytes the least recently used entries (by file modification time, which
+is updated on every hit) are deleted.
+
+The cached spectrograms are the unfiltered magnitudes, since normalizing and
+noise reduction depend on how the frames are chunked.  Copy the frames out
+of the memory map before filtering them in place.
+"""
+import numpy as np
+import tempfile
+import glob
+import os
+import stft
+import processing
+
+#extension of the entry files
+EXTENSION = ".frames"
+
+
+def default_cache():
+    """SpectrogramCache in the pika_spectrograms folder of the temp directory,
+    or the folder in the PIKA_SPECTROGRAM_CACHE environment variable if set.
+    """
+    directory = os.environ.get("PIKA_SPECTROGRAM_CACHE",
+            os.path.join(tempfile.gettempdir(), "pika_spectrograms"))
+    return SpectrogramCache(directory)
+
+def frame_range(start, end, step_size, frequency=44100):
+    """Frames [first, last) on the grid of an entry covering start to end
+    seconds of the recording, the first frame starts at or before start.
+    """
+    first = max(int(np.floor(start*frequency/step_size)), 0)
+    last = max(int(np.ceil(end*frequency/step_size)), first)
+    return first, last
+
+def grid_frame(offset, step_size, frequency=44100):
+    """Frame of an entry starting at offset seconds into the recording, or
+    None if no frame starts there.
+    """
+    sample = offset*frequency
+    frame = int(round(sample/step_size))
+    if abs(frame*step_size - sample) > 1e-3:
+        return None
+    return frame
+
+
+class SpectrogramCache(object):
+    """
+    Size bounded, least recently used cache of recording spectrograms on
+    disk.
+    """
+    #*Constructor*#
+    def __init__(self, directory, max_bytes=2*1024**3):
+        """
+        :directory: folder to keep the entry files in, created if needed
+        :max_bytes: total size the cached files are trimmed back to
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                #another process may have created it first
+                if not os.path.isdir(self.directory):
+                    raise
+
+    #*Public Methods*#
+    def lookup(self, key, fft_size, step_size, fft_window, dtype=np.float64,
+            frequency=44100):
+        """Spectrogram of the recording with content hash key if it is in the
+        cache.
+        :returns read only memory map, one row per frame, or None
+        """
+        path = self.path(key, fft_size, step_size, fft_window, dtype,
+                frequency)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+        n_bins = fft_window[1] - fft_window[0]
+        n_frames = size//(n_bins*np.dtype(dtype).itemsize)
+        try:
+            if n_frames == 0:
+                spec = np.zeros((0, n_bins), dtype=dtype)
+            else:
+                spec = np.memmap(path, dtype=dtype, mode='r',
+                        shape=(n_frames, n_bins))
+            #mark as recently used
+            os.utime(path, None)
+        except (IOError, OSError):
+            #evicted by another process in the meantime
+            return None
+        return spec
+
+    def recording_spectrogram(self, filename, key, fft_size, step_size,
+            fft_window, dtype=np.float64, frequency=44100, block_length=60):
+        """Spectrogram of the recording filename, decoded and stored first if
+        it isn't in the cache yet.
+        :key: content hash of filename (e.g. Recording.content_hash)
+        :returns read only memory map, one row per frame
+        """
+        spec = self.lookup(key, fft_size, step_size, fft_window, dtype,
+                frequency)
+        if spec is None:
+            writer = self.writer(key, fft_size, step_size, fft_window, dtype,
+                    frequency)
+            try:
+                for block, offset in processing.stream_pcm(filename,
+                        block_length, frequency):
+                    writer.feed(block)
+                writer.finish()
+            finally:
+                writer.abort()
+            spec = self.lookup(key, fft_size, step_size, fft_window, dtype,
+                    frequency)
+        return spec
+
+    def frames(self, filename, key, fft_size, step_size, fft_window, start,
+            end, dtype=np.float64, frequency=44100):
+        """Copies the frames of the recording filename covering start to end
+        seconds (see frame_range) out of its entry so they can be filtered in
+        place, storing the entry first if needed.
+        :returns (frames, time in seconds of the first frame)
+        """
+        spec = self.recording_spectrogram(filename, key, fft_size, step_size,
+                fft_window, dtype, frequency)
+        first, last = frame_range(start, end, step_size, frequency)
+        return np.array(spec[first:last]), first*step_size*1.0/frequency
+
+    def writer(self, key, fft_size, step_size, fft_window, dtype=np.float64,
+            frequency=44100):
+        """FrameWriter storing the entry of the recording with content hash
+        key as its frames are computed
+        """
+        return FrameWriter(self, self.path(key, fft_size, step_size,
+            fft_window, dtype, frequency), fft_size, step_size, fft_window,
+            dtype)
+
+    def path(self, key, fft_size, step_size, fft_window, dtype=np.float64,
+            frequency=44100):
+        """File the spectrogram with the given recording key and parameters
+        is stored in.
+        """
+        name = "{}_{}_{}_{}_{}-{}_{}{}".format(key, int(frequency), fft_size,
+                step_size, fft_window[0], fft_window[1], np.dtype(dtype).name,
+                EXTENSION)
+        return os.path.join(self.directory, name)
+
+    def clear(self):
+        """Deletes all of the cached spectrograms"""
+        for path in glob.glob(os.path.join(self.directory, "*" + EXTENSION)):
+            self.remove(path)
+
+    #*Private Methods*#
+    def evict(self, keep=None):
+        """Deletes the least recently used spectrograms until the cache is no
+        bigger than max_bytes.
+        :keep: path of a file not to delete (e.g. the one just stored)
+        """
+        files = []
+        for path in glob.glob(os.path.join(self.directory, "*" + EXTENSION)):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for mtime, size, path in files)
+        for mtime, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            self.remove(path)
+            total -= size
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            #already removed, or still open on windows
+            pass
+
+
+class FrameWriter(object):
+    """
+    Writes the frames of a recording to a temporary file in order as they are
+    computed, and moves it into place as the cache entry once all of them
+    have been written.
+    """
+    #*Constructor*#
+    def __init__(self, cache, path, fft_size, step_size, fft_window, dtype):
+        self.cache = cache
+        self.path = path
+        self.fft_size = fft_size
+        self.step_size = step_size
+        self.fft_window = fft_window
+        self.dtype = np.dtype(dtype)
+        self.temp_path = "{}.{}.tmp".format(path, os.getpid())
+        self.output = open(self.temp_path, "wb")
+        #samples fed but not yet used for frames (see feed)
+        self.samples = np.zeros(0, dtype=np.float32)
+
+    #*Public Methods*#
+    def append(self, frames):
+        """Writes the next frames of the recording"""
+        self.output.write(np.ascontiguousarray(frames,
+            dtype=self.dtype).tobytes())
+
+    def feed(self, block):
+        """Computes and writes the frames of the next block of audio, keeping
+        the samples of the frames that need the next block
+        """
+        self.samples = np.concatenate((self.samples, block))
+        frames = stft.magnitude_spectrogram(self.samples, self.fft_size,
+                self.step_size, self.fft_window, dtype=self.dtype, pad=False)
+        self.append(frames)
+        self.samples = self.samples[len(frames)*self.step_size:]
+
+    def finish(self):
+        """Writes the zero padded frames at the end of audio fed with feed and
+        commits the entry
+        """
+        if len(self.samples):
+            self.append(stft.magnitude_spectrogram(self.samples,
+                self.fft_size, self.step_size, self.fft_window,
+                dtype=self.dtype))
+        self.samples = np.zeros(0, dtype=np.float32)
+        self.commit()
+
+    def commit(self):
+        """Moves the frames written into place as the cache entry"""
+        self.output.close()
+        try:
+            os.rename(self.temp_path, self.path)
+        except OSError:
+            #on windows rename fails if another process stored it first
+            if not os.path.exists(self.path):
+                raise
+        self.cache.evict(keep=self.path)
+        self.abort()
+
+    def abort(self):
+        """Deletes the frames written if they weren't committed"""
+        if not self.output.closed:
+            self.output.close()
+        if os.path.exists(self.temp_path):
+            self.cache.remove(self.temp_path)
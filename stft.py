@@ -0,0 +1,266 @@
+"""
+Short-time Fourier transform helpers used by the parsers.
+
+The spectrogram is computed by framing the audio with a strided view (no copy
+of the samples is made for frames that lie completely inside the audio) and
+running one batched real FFT over a block of frames at a time.  Only the bins
+inside the requested frequency window are kept.
+"""
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+def frame_count(n_samples, step_size):
+    """Number of frames produced for n_samples of audio, a frame starts at
+    every multiple of step_size that is inside the audio.
+    """
+    return int(np.ceil(1.0*n_samples/step_size))
+
+def frame_audio(audio, fft_size, step_size):
+    """Returns a 2d view of audio where row i is audio[i*step_size:
+    i*step_size + fft_size].  Only the frames that fit completely inside the
+    audio are included, no data is copied.
+    :audio: 1d numpy array
+    """
+    audio = np.asarray(audio)
+    if audio.ndim != 1:
+        raise Exception("stft.frame_audio expects 1d audio, got array with " \
+                "shape {}".format(audio.shape))
+    if len(audio) < fft_size:
+        n_frames = 0
+    else:
+        n_frames = (len(audio) - fft_size)//step_size + 1
+    stride = audio.strides[0]
+    return as_strided(audio, shape=(n_frames, fft_size),
+            strides=(step_size*stride, stride))
+
+def spectrogram_buffer(n_samples, fft_size, step_size, fft_window,
+        dtype=np.float64):
+    """Allocates an array large enough to hold the spectrogram of n_samples of
+    audio, for passing as the out argument of magnitude_spectrogram so that
+    chunks of the same (or smaller) length can reuse it.
+    """
+    return np.empty((frame_count(n_samples, step_size),
+        fft_window[1] - fft_window[0]), dtype=dtype)
+
+def magnitude_spectrogram(audio, fft_size, step_size, fft_window,
+        block_frames=512, out=None, dtype=np.float64, pad=True):
+    """Magnitude of the fft of audio restricted to the bins in fft_window.
+    Frames start every step_size samples and frames running past the end of
+    the audio are zero padded, so the result matches taking
+    np.absolute(np.fft.fft(audio[i:i+fft_size], fft_size)) for every i in
+    xrange(0, len(audio), step_size) and keeping bins
+    fft_window[0]:fft_window[1].  The values agree with that per frame loop to
+    within 1e-12 of the spectrogram's maximum value (they only differ by
+    floating point rounding in the fft).
+    :audio: 1d numpy array of samples
+    :fft_size: number of samples per frame
+    :step_size: number of samples between the starts of consecutive frames
+    :fft_window: [first, last) bins of the fft to keep, last must be no more
+    than fft_size/2 + 1
+    :block_frames: number of frames transformed per batched rfft call, bounds
+    the memory used for the full complex spectrum of a block
+    :out: optional 2d array (see spectrogram_buffer) with at least as many
+    rows as there are frames, the spectrogram is written into its first rows
+    instead of a newly allocated array
+    :dtype: dtype of the returned array when out is not given
+    :pad: if False the frames running past the end of the audio are left out
+    (for audio arriving in blocks, where those frames are computed once the
+    next block is available)
+    :returns 2d array with one row per frame and fft_window[1] - fft_window[0]
+    columns
+    """
+    audio = np.asarray(audio)
+    if fft_window[1] > fft_size//2 + 1:
+        raise Exception("stft.magnitude_spectrogram: fft_window {} extends " \
+                "past the last real fft bin {}".format(fft_window, fft_size//2))
+    frames = frame_audio(audio, fft_size, step_size)
+    if pad:
+        n_frames = frame_count(len(audio), step_size)
+    else:
+        n_frames = len(frames)
+    if out is None:
+        spec = np.empty((n_frames, fft_window[1] - fft_window[0]), dtype=dtype)
+    else:
+        if (len(out) < n_frames or
+                out.shape[1] != fft_window[1] - fft_window[0]):
+            raise Exception("stft.magnitude_spectrogram: buffer of shape {} " \
+                    "cannot hold {} frames of {} bins".format(out.shape,
+                        n_frames, fft_window[1] - fft_window[0]))
+        spec = out[:n_frames]
+
+    for start in xrange(0, len(frames), block_frames):
+        block = frames[start:start + block_frames]
+        spec[start:start + len(block)] = np.absolute(
+                np.fft.rfft(block, fft_size)[:, fft_window[0]:fft_window[1]])
+
+    #frames that run past the end of the audio are zero padded, at most
+    #fft_size/step_size of them so a padded copy of the tail is cheap
+    first_partial = len(frames)
+    if first_partial < n_frames:
+        tail = np.zeros((n_frames - first_partial)*step_size + fft_size,
+                dtype=audio.dtype)
+        remaining = audio[first_partial*step_size:]
+        tail[:len(remaining)] = remaining
+        tail_frames = frame_audio(tail, fft_size, step_size)[
+                :n_frames - first_partial]
+        spec[first_partial:] = np.absolute(
+                np.fft.rfft(tail_frames, fft_size)[:, fft_window[0]:fft_window[1]])
+    return spec
+
+def filter_spectrogram(spec, threshold=.05, min_max=None):
+    """Normalizes, noise reduces and removes the quiet parts of a magnitude
+    spectrogram in place (no per element python loops and no copies of the
+    spectrogram are made).
+    :spec: 2d float array with one row per frame, modified in place
+    :threshold: values that are not more than threshold above the mean of the
+    noise reduced spectrogram are set to zero
+    :min_max: if given the spectrogram is divided by max(its max, min_max)
+    rather than just its max, to avoid blowing up near silent audio
+    :returns spec
+    """
+    if len(spec) == 0:
+        return spec
+    #normalize
+    max_val = np.amax(spec)
+    if min_max is not None:
+        max_val = max(max_val, min_max)
+    spec /= max_val
+
+    #noise-reduction
+    avg_fft = np.sum(spec, axis=0)/len(spec)
+    spec -= avg_fft
+    np.maximum(spec, 0, out=spec)
+
+    #filter out quiet parts
+    f_mean = np.mean(spec)
+    spec[spec <= f_mean + threshold] = 0.0
+    return spec
+
+def exponential_average(values, alpha, initial):
+    """Exponential moving average along the first axis of values,
+    average[t] = (1 - alpha)*average[t-1] + alpha*values[t], starting from
+    average[-1] = initial.  Computed in closed form with cumulative sums over
+    blocks short enough that the rescaling stays well conditioned.
+    :returns array of the same shape as values
+    """
+    values = np.asarray(values, dtype=np.float64)
+    averages = np.empty_like(values)
+    decay = 1.0 - alpha
+    if decay <= 0:
+        averages[:] = values
+        return averages
+    if decay < 1:
+        block = max(1, int(np.log(1e6)/-np.log(decay)))
+    else:
+        block = max(1, len(values))
+    previous = np.asarray(initial, dtype=np.float64)
+    for start in xrange(0, len(values), block):
+        x = values[start:start + block]
+        powers = decay**np.arange(1, len(x) + 1)
+        shape = (len(x),) + (1,)*(x.ndim - 1)
+        powers = powers.reshape(shape)
+        #average[t] = decay^(t+1)*previous + alpha*sum_s decay^(t-s)*x[s]
+        sums = np.cumsum(x/powers, axis=0)*powers
+        averages[start:start + len(x)] = powers*previous + alpha*sums
+        previous = averages[start + len(x) - 1]
+    return averages
+
+def running_max(values, decay, initial):
+    """Peak hold with exponential decay, level[t] = max(decay*level[t-1],
+    values[t]) starting from level[-1] = initial, computed without a python
+    loop by taking a cumulative maximum in the log domain.
+    """
+    values = np.maximum(np.asarray(values, dtype=np.float64), 1e-300)
+    steps = np.arange(len(values))
+    log_decay = np.log(decay)
+    levels = np.maximum.accumulate(np.log(values) - steps*log_decay) + \
+            steps*log_decay
+    levels = np.maximum(levels, np.log(max(initial, 1e-300)) +
+            (steps + 1)*log_decay)
+    return np.exp(levels)
+
+
+class RunningNoiseFloor(object):
+    """
+    Incremental version of filter_spectrogram for scoring frames as they are
+    produced with constant memory.  Instead of the max, mean noise floor and
+    mean of a whole chunk it uses running estimates that only depend on the
+    frames seen so far:
+        normalizer: the largest frame maximum, decaying exponentially
+        noise floor: exponential moving average of each (normalized) bin
+        quiet threshold: exponential moving average of the frame means of
+        the noise reduced spectrogram, plus threshold
+    The estimates start from the statistics of the first warmup frames (see
+    seed), whatever blocks the frames arrive in, so the same frames are
+    always filtered the same way.  Callers feeding frames in small blocks
+    should hold the first warmup frames back until they have them all (as
+    pika2.StreamingParser does).
+    """
+    def __init__(self, time_constant, threshold=.05, min_max=.1, warmup=None):
+        """
+        :time_constant: number of frames over which the estimates adapt (the
+        weight of a frame falls by a factor of e after this many frames)
+        :threshold: see filter_spectrogram
+        :min_max: see filter_spectrogram
+        :warmup: number of frames the estimates are seeded from, defaults to
+        time_constant
+        """
+        self.alpha = 1.0 - np.exp(-1.0/time_constant)
+        self.threshold = threshold
+        self.min_max = min_max
+        if warmup is None:
+            warmup = int(np.ceil(time_constant))
+        self.warmup = max(int(warmup), 1)
+        self.reset()
+
+    def reset(self):
+        self.level = None
+        self.floor = None
+        self.mean = None
+
+    @property
+    def seeded(self):
+        return self.level is not None
+
+    def seed(self, spec):
+        """Starts the estimates from the first warmup frames of spec (all of
+        them if there are fewer), the way filter_spectrogram would filter
+        those frames as one chunk.  spec is not modified.
+        """
+        spec = np.asarray(spec[:self.warmup], dtype=np.float64)
+        self.level = np.amax(spec)
+        normalized = spec/max(self.level, self.min_max)
+        self.floor = np.mean(normalized, axis=0)
+        self.mean = np.mean(np.maximum(normalized - self.floor, 0))
+
+    def filter(self, spec):
+        """Normalizes, noise reduces and removes the quiet parts of the next
+        block of frames in place, updating the running estimates.
+        :spec: 2d float array with one row per frame, modified in place
+        :returns spec
+        """
+        if len(spec) == 0:
+            return spec
+        if not self.seeded:
+            self.seed(spec)
+        #normalize
+        frame_max = np.amax(spec, axis=1)
+        levels = running_max(frame_max, 1.0 - self.alpha, self.level)
+        self.level = levels[-1]
+        spec /= np.maximum(levels, self.min_max)[:, None]
+
+        #noise-reduction
+        if self.floor is None:
+            self.floor = np.mean(spec, axis=0)
+        floors = exponential_average(spec, self.alpha, self.floor)
+        self.floor = floors[-1]
+        spec -= floors
+        np.maximum(spec, 0, out=spec)
+
+        #filter out quiet parts
+        frame_mean = np.mean(spec, axis=1)
+        means = exponential_average(frame_mean, self.alpha, self.mean)
+        self.mean = means[-1]
+        spec[spec <= (means + self.threshold)[:, None]] = 0.0
+        return spec
@@ -0,0 +1,218 @@
+"""
+Parameter sweep for tuning the call scoring to a site.
+
+Each recording is decoded, transformed and its harmonic peaks found once
+(by a PeakCollector, which runs the same StreamingParser front end as
+pika2.parse_mp3).  Every combination of scoring settings is then scored from
+those peaks in one pass (scoring.score_frames_sweep), and the calls each
+setting would find are compared against the reviewed Calls of the
+recording.  The results are reported per site (Collection) as precision and
+recall:
+
+    recall     reviewed true calls (verified=True) overlapped by a detection,
+               over all the reviewed true calls
+    precision  detections overlapping a true call, over the detections
+               overlapping any reviewed call (detections that overlap no
+               reviewed call can't be judged and are counted separately)
+
+The peaks depend on the spectrogram settings (fft size, step size, noise
+floor and mpd), those are the pika2.StreamingParser defaults and are not
+swept.
+"""
+import pika2
+import call_handler as ch
+import find_peaks as peaks
+import scoring
+import intervals
+import numpy as np
+import collections
+import itertools
+import argparse
+import sys
+import os
+
+if __name__== '__main__':
+    #Got this setup from:
+    #https://www.stavros.io/posts/standalone-django-scripts-definitive-guide/
+    proj_path = "D:/Workspace/pika_project/"
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "pika_project.settings")
+    sys.path.append(proj_path)
+    os.chdir(proj_path)
+
+    from django.core.wsgi import get_wsgi_application
+    application = get_wsgi_application()
+
+from pika_app.models import Recording, Call
+
+#the filter tunings that used to be commented out in pika2.Parser, by site
+#(min_base_peak -1 is no lower bound on the first peak)
+TUNINGS = collections.OrderedDict([
+    ("joint", {"ipd_filters": [[45, 93], [110, 165]],
+        "base_peak_filter": [15, 60], "max_base_peak": 120,
+        "min_base_peak": -1}),
+    ("beacon rock", {"ipd_filters": [[52, 70], [110, 135]],
+        "base_peak_filter": [30, 60], "max_base_peak": 90,
+        "min_base_peak": -1}),
+    ("angel's rest", {"ipd_filters": [[60, 93], [130, 165]],
+        "base_peak_filter": [30, 60], "max_base_peak": 120,
+        "min_base_peak": 25}),
+    ("herman's creek", {"ipd_filters": [[45, 80], [130, 165]],
+        "base_peak_filter": [15, 60], "max_base_peak": 120,
+        "min_base_peak": -1}),
+    ])
+THRESHOLDS = [8.5, 10.0, 10.5]
+MIN_RIDGE_LENGTHS = [.13]
+
+#peak locations of every frame of a recording (see find_peaks.detect_peaks_2d)
+#and the parser settings they were found with
+Peaks = collections.namedtuple("Peaks", ["locs", "counts", "n_bins",
+    "factor", "smoothing_width", "offset"])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description="Scores recordings with reviewed calls with many " \
+                    "settings and reports precision and recall per site")
+    parser.add_argument("recordings", type=int, nargs="*",
+            help="ids of the recordings to use (default: all with " \
+                    "reviewed calls)")
+    parser.add_argument("--tunings", nargs="+", choices=TUNINGS.keys(),
+            default=TUNINGS.keys(), help="filter tunings to try")
+    parser.add_argument("--thresholds", type=float, nargs="+",
+            default=THRESHOLDS, help="ridge thresholds to try")
+    parser.add_argument("--min-ridge-lengths", type=float, nargs="+",
+            default=MIN_RIDGE_LENGTHS, help="minimum call lengths to try")
+    args = parser.parse_args(argv)
+
+    recordings = Recording.objects.filter(call__verified__isnull=False) \
+            .distinct().select_related("collection")
+    if args.recordings:
+        recordings = recordings.filter(id__in=args.recordings)
+    settings = [dict(TUNINGS[name], tuning=name, threshold=threshold,
+        min_ridge_length=min_length) for name, threshold, min_length in
+        itertools.product(args.tunings, args.thresholds,
+            args.min_ridge_lengths)]
+
+    #counts for each site, one row per setting
+    sites = collections.OrderedDict()
+    for recording in recordings:
+        calls = Call.objects.filter(recording=recording,
+                verified__isnull=False)
+        reviewed = [(call.offset, call.offset + call.duration, call.verified)
+                for call in calls]
+        counts = sweep_recording(recording.filename, settings, reviewed)
+        site = str(recording.collection)
+        sites[site] = sites.get(site, 0) + counts
+    report(sites, settings)
+
+def sweep_recording(filename, settings, reviewed):
+    """Scores filename with every setting and evaluates the detections.
+    :settings: list of dicts with ipd_filters, base_peak_filter,
+    max_base_peak, min_base_peak, threshold and min_ridge_length
+    :reviewed: list of (start, end, verified) of the reviewed calls
+    :returns array of evaluate counts, one row per setting
+    """
+    found = collect_peaks(filename)
+    scores = sweep_scores(found, settings)
+    return np.array([evaluate(detect(scores[:, c], found,
+        setting["threshold"], setting["min_ridge_length"]), reviewed)
+        for c, setting in enumerate(settings)])
+
+def collect_peaks(filename, block_length=60, prefetch=2):
+    """Decodes filename and finds the peaks of every frame, once.
+    :returns Peaks
+    """
+    collector = PeakCollector(ch.CallList())
+    collector.identify_calls(pika2.prefetch_pcm(filename, block_length,
+        prefetch))
+    return collector.peaks()
+
+def sweep_scores(found, settings):
+    """Frame scores of found (Peaks) with every setting, scored in one pass.
+    :returns 2d array, one row per frame and one column per setting
+    """
+    ipd_tables = [scoring.filter_table(s["ipd_filters"], found.n_bins)
+            for s in settings]
+    base_tables = [scoring.filter_table([s["base_peak_filter"]],
+        found.n_bins) for s in settings]
+    return scoring.score_frames_sweep(found.locs, found.counts, ipd_tables,
+            base_tables, with_negative=True,
+            max_base_peaks=[s["max_base_peak"] for s in settings],
+            min_base_peaks=[s["min_base_peak"] for s in settings])
+
+def detect(frame_scores, found, threshold, min_ridge_length):
+    """Intervals (in seconds from the start of the recording) a
+    StreamingParser would identify as calls from frame_scores.
+    """
+    return found.offset + intervals.passing_intervals(frame_scores,
+            found.factor, found.smoothing_width, threshold, min_ridge_length)
+
+def evaluate(detections, reviewed):
+    """Compares detected intervals with the reviewed calls.
+    :reviewed: list of (start, end, verified) of the reviewed calls
+    :returns array of (true calls found, true calls, detections of true
+    calls, detections of false calls only, unreviewed detections)
+    """
+    detections = np.asarray(detections).reshape(-1, 2)
+    reviewed = np.asarray(reviewed, dtype=float).reshape(-1, 3)
+    #overlaps[i, j] is True if detection i overlaps reviewed call j
+    overlaps = ((detections[:, None, 0] < reviewed[None, :, 1]) &
+            (detections[:, None, 1] > reviewed[None, :, 0]))
+    true_calls = reviewed[:, 2] == 1
+    hits_true = overlaps[:, true_calls].any(axis=1)
+    hits_any = overlaps.any(axis=1)
+    return np.array([overlaps[:, true_calls].any(axis=0).sum(),
+        true_calls.sum(), hits_true.sum(), (hits_any & ~hits_true).sum(),
+        (~hits_any).sum()])
+
+def report(sites, settings):
+    """Prints precision and recall of each setting for each site"""
+    for site, counts in sites.items():
+        print site
+        print "{:>16} {:>9} {:>9} {:>9} {:>9} {:>10}".format("tuning",
+                "threshold", "min len", "precision", "recall", "unreviewed")
+        for setting, (found, true_calls, true_hits, false_hits,
+                unreviewed) in zip(settings, counts):
+            judged = true_hits + false_hits
+            precision = true_hits*1.0/judged if judged else float("nan")
+            recall = found*1.0/true_calls if true_calls else float("nan")
+            print "{:>16} {:>9.2f} {:>9.2f} {:>9.3f} {:>9.3f} {:>10}".format(
+                    setting["tuning"], setting["threshold"],
+                    setting["min_ridge_length"], precision, recall,
+                    unreviewed)
+
+
+class PeakCollector(pika2.StreamingParser):
+    """
+    StreamingParser that keeps the peak locations of every frame instead of
+    scoring them, so the frames are normalized and noise reduced exactly as
+    pika2.parse_mp3 does but can be scored with any settings afterwards.
+    """
+    #*Constructor*#
+    def __init__(self, handler, **kwargs):
+        pika2.StreamingParser.__init__(self, handler, **kwargs)
+        self.blocks = []
+
+    #*Public Methods*#
+    def score_fft(self, with_negative=False, reference=False):
+        locs, counts = peaks.detect_peaks_2d(self.fft, mpd=self.mpd)
+        self.blocks.append((locs, counts))
+        #nothing reaches the threshold, so no calls are identified
+        return np.zeros(len(counts))
+
+    def peaks(self):
+        """The peaks of all the frames so far, as Peaks"""
+        width = max([3] + [locs.shape[1] for locs, counts in self.blocks])
+        locs = np.full((sum(len(c) for l, c in self.blocks), width), -1,
+                dtype=int)
+        start = 0
+        for block, counts in self.blocks:
+            locs[start:start + len(block), :block.shape[1]] = block
+            start += len(block)
+        counts = np.concatenate([c for l, c in self.blocks] +
+                [np.zeros(0, dtype=int)])
+        return Peaks(locs, counts, self.fft_window[1] - self.fft_window[0],
+                self.factor, self.smoothing_width(), self.offset)
+
+
+
+if __name__ == "__main__": main()
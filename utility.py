@@ -9,6 +9,8 @@ import datetime
 import os
 import re
 import mutagen.mp3
+import numpy as np
+import clips
 
 def confirm(prompt):
     while True:
@@ -20,11 +22,16 @@ def confirm(prompt):
         else:
             print "invalid input, should be 'y' or 'n' but got {}".format(value)
 
-def get_verification(call, with_audio=True):
-    """Return false if quit otherwise return True when valid response given"""
+def get_verification(call, with_audio=True, play=None):
+    """Return false if quit otherwise return True when valid response given
+    :play: function playing the call at a volume multiplier, defaults to
+    play_call
+    """
     volume_mult = 20
+    if play is None:
+        play = lambda vol_mult: play_call(call, vol_mult)
     if with_audio:
-        play_audio(call.filename, volume_mult)
+        play(volume_mult)
     while True:
         print "Verify as pika call?"
         r = raw_input("(Y)es/(N)o/(S)kip/(R)eplay/(L)ouder/(Q)uit (then press enter)")
@@ -39,11 +46,86 @@ def get_verification(call, with_audio=True):
             return "s"
         elif r == "l":
             volume_mult += 20
-            play_audio(call.filename, volume_mult)
+            play(volume_mult)
         elif r == "r":
-            play_audio(call.filename, volume_mult)
+            play(volume_mult)
 
 
+def play_call(call, vol_mult=20):
+    """Plays the audio of call however it is stored (see clips.load_call)"""
+    if call.filename and not clips.is_packed(call.filename):
+        play_audio(call.filename, vol_mult)
+    else:
+        audio, frequency = clips.load_call(call)
+        play_pcm(audio, frequency, vol_mult)
+
+def play_pcm(audio, frequency, vol_mult=20):
+    """Plays audio (a 1d array of samples) by piping it to ffplay as raw
+    float32 pcm, without writing it to a file.
+    """
+    process = subprocess.Popen(["ffplay", "-nodisp", "-autoexit",
+        "-loglevel", "0", "-f", "f32le", "-ar", str(int(frequency)),
+        "-ac", "1", "-af", "volume={}".format(vol_mult), "-i", "pipe:0"],
+        stdin=subprocess.PIPE)
+    try:
+        process.stdin.write(np.asarray(audio, dtype=np.float32).tobytes())
+    finally:
+        process.stdin.close()
+        process.wait()
+
+class PcmPlayer(object):
+    """
+    Plays arrays of samples through one ffplay process that is kept open
+    between plays, so replaying doesn't wait for ffplay to start each time.
+    The volume is applied to the samples in numpy.  play returns once the
+    audio has (mostly) been taken by ffplay, like play_pcm, so a replay or a
+    louder play is queued behind audio that is still playing rather than
+    restarting it.  close waits for the queued audio to finish.
+    """
+    #*Constructor*#
+    def __init__(self, padding=.25):
+        """
+        :padding: seconds of silence written after each clip, so the end of
+        the clip is pushed through ffplay's buffers
+        """
+        self.padding = padding
+        self.process = None
+        self.frequency = None
+
+    #*Public Methods*#
+    def play(self, audio, frequency, vol_mult=20):
+        if (self.process is None or self.process.poll() is not None or
+                frequency != self.frequency):
+            self.close()
+            self.start(frequency)
+        samples = np.asarray(audio, dtype=np.float32)*np.float32(vol_mult)
+        np.clip(samples, -1, 1, out=samples)
+        self.process.stdin.write(samples.tobytes())
+        self.process.stdin.write(self.silence.tobytes())
+        self.process.stdin.flush()
+
+    def close(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+        self.process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_val, trace):
+        self.close()
+
+    #*Private Methods*#
+    def start(self, frequency):
+        self.frequency = frequency
+        self.silence = np.zeros(int(self.padding*frequency), dtype=np.float32)
+        #-autoexit so ffplay exits at the end of stdin and close returns
+        self.process = subprocess.Popen(["ffplay", "-nodisp", "-autoexit",
+            "-loglevel", "0", "-fflags", "nobuffer", "-f", "f32le",
+            "-ar", str(int(frequency)), "-ac", "1", "-i", "pipe:0"],
+            stdin=subprocess.PIPE)
+
 def play_audio(audio, vol_mult=20, start=0, duration=60):
     subprocess.call(["ffplay", "-nodisp", "-autoexit",
         "-ss", str(start), "-t", str(duration),
@@ -0,0 +1,101 @@
+"""
+Verification of identified calls by a reviewer, with the next calls prepared
+in the background.
+
+A VerificationSession loads the audio of the next few calls and computes
+their spectrograms in a background thread (see processing.prefetch) while
+the reviewer listens to and looks at the current call, so moving on to the
+next call doesn't wait on decoding or FFTs.  The audio of the current call
+is kept in memory and played through one utility.PcmPlayer, so replaying it
+louder only multiplies the cached samples.
+"""
+import numpy as np
+import matplotlib.pyplot as plt
+import collections
+import itertools
+import clips
+import processing
+import utility as u
+import pika2
+
+#a call ready for review: its audio (float32), sample frequency and a
+#pika2.Parser with the spectrogram of the call already computed
+PreparedCall = collections.namedtuple("PreparedCall",
+        ["call", "audio", "frequency", "parser"])
+
+
+class VerificationSession(object):
+    """
+    Asks the reviewer to verify each of a list of calls in turn, saving the
+    responses to the calls' verified field.
+    """
+    #*Constructor*#
+    def __init__(self, calls, prefetch=3, cache=None):
+        """
+        :calls: Calls to verify (e.g. a QuerySet, use select_related("recording")
+        so the recordings aren't queried from the background thread)
+        :prefetch: number of calls prepared ahead of the one being reviewed
+        :cache: spectrogram_cache.SpectrogramCache the spectrograms of the
+        calls are sliced from when their recording's spectrogram was stored
+        there (e.g. while it was parsed), see pika2.call_parser
+        """
+        #evaluated here so the database is only queried in this thread
+        self.calls = list(calls)
+        self.prefetch = prefetch
+        self.cache = cache
+        self.player = u.PcmPlayer()
+
+    #*Public Methods*#
+    def run(self):
+        """Reviews the calls until they run out or the reviewer quits.
+        :returns False if the reviewer quit, True otherwise
+        """
+        print "Will be processing {} calls".format(len(self.calls))
+        plt.ion()
+        prepared_calls = processing.prefetch(
+                itertools.imap(self.prepare, self.calls), self.prefetch)
+        try:
+            for prepared in prepared_calls:
+                if not self.review(prepared):
+                    return False
+            return True
+        finally:
+            prepared_calls.close()
+            self.player.close()
+            plt.close()
+
+    def review(self, prepared):
+        """Shows and plays one prepared call, saving the response.
+        :returns False if the reviewer quit
+        """
+        call = prepared.call
+        print "Before: call {}, verified? {}".format(call, call.verified)
+        self.show(prepared)
+        response = u.get_verification(call, play=lambda vol_mult:
+                self.player.play(prepared.audio, prepared.frequency, vol_mult))
+        print "Response: {}".format(response)
+        if response == "q":
+            return False
+        if response == True or response == False:
+            call.verified = response
+            call.save()
+        print "After: call {}, verified? {}".format(call, call.verified)
+        return True
+
+    #*Private Methods*#
+    def prepare(self, call):
+        """Loads the audio and computes the spectrogram of call, in the
+        background thread.
+        """
+        audio, frequency = clips.load_call(call)
+        #copied so the samples don't depend on clip stores or block caches
+        audio = np.array(audio, dtype=np.float32)
+        parser = pika2.call_parser(call, audio, frequency, self.cache)
+        return PreparedCall(call, audio, frequency, parser)
+
+    def show(self, prepared):
+        """Draws the spectrogram of the prepared call in the reused figure"""
+        call = prepared.call
+        plt.clf()
+        prepared.parser.spectrogram("call id: {}, offset {:.0f}:{:2.1f}"
+                .format(call.id, np.floor(call.offset/60), call.offset%60))
@@ -1,4 +1,6 @@
 import pika2 as p
+import spectrogram_cache
+from verification import VerificationSession
 import call_handler as ch
 import sys
 import os
@@ -51,10 +53,9 @@ def main(argv=None):
         else:
             calls = Call.objects.filter(verified__isnull=True)
 
-        print "Will be processing {} calls".format(len(calls))
-
-        for call in calls:
-            if not p.verify_call(call): #Means user response was to quit
-                return
+        #the next calls are loaded while the current one is reviewed
+        session = VerificationSession(calls.select_related("recording"),
+                cache=spectrogram_cache.default_cache())
+        session.run()
 
 if __name__ == "__main__": main()    
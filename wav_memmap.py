@@ -0,0 +1,141 @@
+"""
+Memory mapped access to the samples of wav files.
+
+WavAudio parses the RIFF header of a wav file and maps one channel of its
+data chunk with np.memmap, so a chunk of audio is only read from disk when
+it is sliced.  Slices are scaled to floats the same way libsndfile (and so
+scikits.audiolab.wavread) does, so WavAudio can be used wherever a loaded
+audio array is sliced, e.g. processing.segment_audio or
+Parser.get_audio_interval.
+"""
+import numpy as np
+import struct
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+class UnsupportedFormat(ValueError):
+    """Raised by WavAudio for wav files whose samples can't be memory mapped
+    (e.g. 24 bit pcm), which can still be loaded with processing.load_wav
+    """
+
+class WavAudio(object):
+    """
+    One channel of a wav file, sliceable like a 1d array of floats.
+    Supports 8, 16 and 32 bit pcm and 32 and 64 bit float data (24 bit pcm
+    can't be mapped as an array, use processing.load_wav for those).
+    """
+    #*Constructor*#
+    def __init__(self, filename, channel=0, dtype=np.float64):
+        """
+        :filename: path of the wav file
+        :channel: channel to read, 0 is the left channel
+        :dtype: float dtype of the slices returned
+        """
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        (audio_format, self.n_channels, self.frequency, bits, data_offset,
+                data_size) = self.read_header()
+        if channel >= self.n_channels:
+            raise Exception("wav_memmap.WavAudio: {} has {} channels, no " \
+                    "channel {}".format(filename, self.n_channels, channel))
+
+        if audio_format == WAVE_FORMAT_PCM and bits in (8, 16, 32):
+            sample_dtype = {8: np.uint8, 16: np.dtype("<i2"),
+                    32: np.dtype("<i4")}[bits]
+        elif audio_format == WAVE_FORMAT_IEEE_FLOAT and bits in (32, 64):
+            sample_dtype = {32: np.dtype("<f4"), 64: np.dtype("<f8")}[bits]
+        else:
+            raise UnsupportedFormat("wav_memmap.WavAudio: {} has " \
+                    "unsupported format {} with {} bits per sample".format(
+                        filename, audio_format, bits))
+        #libsndfile's int to float scaling
+        self.bias = 128 if bits == 8 else 0
+        if audio_format == WAVE_FORMAT_PCM:
+            self.scale = 1.0/2**(bits - 1)
+        else:
+            self.scale = None
+
+        frame_bytes = self.n_channels*np.dtype(sample_dtype).itemsize
+        n_frames = data_size//frame_bytes
+        if n_frames == 0:
+            self.samples = np.zeros(0, dtype=sample_dtype)
+            return
+        frames = np.memmap(filename, dtype=sample_dtype, mode='r',
+                offset=data_offset, shape=(n_frames, self.n_channels))
+        #strided view of the channel, nothing is read yet
+        self.samples = frames[:, channel]
+
+    #*Public Methods*#
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, key):
+        """Slices (or single samples) of the channel as floats, only the
+        samples in the slice are read.
+        """
+        return self.to_float(self.samples[key])
+
+    def __array__(self, dtype=None):
+        """The whole channel as an array, e.g. for np.asarray"""
+        audio = self[:]
+        if dtype is not None:
+            audio = audio.astype(dtype, copy=False)
+        return audio
+
+    @property
+    def duration(self):
+        """Length in seconds"""
+        return len(self)*1.0/self.frequency
+
+    #*Private Methods*#
+    def to_float(self, samples):
+        audio = np.asarray(samples, dtype=self.dtype)
+        if self.bias:
+            audio -= self.bias
+        if self.scale is not None:
+            audio *= self.scale
+        return audio
+
+    def read_header(self):
+        """Parses the RIFF chunks of the file up to the data chunk.
+        :returns (format, channels, sample frequency, bits per sample,
+        offset of the data, size of the data in bytes)
+        """
+        with open(self.filename, "rb") as f:
+            riff, riff_size, wave = struct.unpack("<4sI4s", f.read(12))
+            if riff != "RIFF" or wave != "WAVE":
+                raise Exception("wav_memmap.WavAudio: {} is not a RIFF wave " \
+                        "file".format(self.filename))
+            fmt = None
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    raise Exception("wav_memmap.WavAudio: no data chunk in " \
+                            "{}".format(self.filename))
+                chunk_id, chunk_size = struct.unpack("<4sI", header)
+                if chunk_id == "fmt ":
+                    body = f.read(chunk_size)
+                    (audio_format, channels, frequency, byte_rate,
+                            block_align, bits) = struct.unpack("<HHIIHH",
+                                    body[:16])
+                    if audio_format == WAVE_FORMAT_EXTENSIBLE:
+                        #the format is the first 2 bytes of the sub format
+                        audio_format = struct.unpack("<H", body[24:26])[0]
+                    fmt = (audio_format, channels, frequency, bits)
+                elif chunk_id == "data":
+                    if fmt is None:
+                        raise Exception("wav_memmap.WavAudio: data chunk " \
+                                "before fmt chunk in {}".format(self.filename))
+                    data_offset = f.tell()
+                    f.seek(0, 2)
+                    #the size is often wrong in files that weren't finished
+                    data_size = min(chunk_size, f.tell() - data_offset)
+                    return fmt + (data_offset, data_size)
+                else:
+                    f.seek(chunk_size, 1)
+                #chunks are padded to an even number of bytes
+                if chunk_size % 2:
+                    f.seek(1, 1)